@@ -0,0 +1,86 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController(object):
+    # Load shedding in front of the expensive handlers, decided when the
+    # webhook arrives, before an event is queued or handled. When too many
+    # admitted events are still in flight (queued or running), or the event
+    # queue is too deep, an event is answered right away with a cheap "busy"
+    # reply instead of starting a GPT or OpenCV job that would only make the
+    # backlog worse.
+    #
+    #   @handler.add(MessageEvent, message=TextMessage)
+    #   @admission.admit(reply_busy)
+    #   def handle_message(event): ...
+    #
+    #   admitted, shed = admission.admit_events(payload.events, handler.find_handler,
+    #                                           dedup.is_duplicate)
+    #
+    # Each admitted event holds its slot until done(event), called once it
+    # has been handled; events of handlers without admit() take none, and
+    # neither do redeliveries of events already taken, which dedup drops
+    # rather than having them answered as busy.
+
+    def __init__(self, max_in_flight=32, max_queue_depth=None, queue_depth=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.queue_depth = queue_depth
+        self._lock = threading.Lock()
+        # id(event) -> event, for the admitted events still in flight
+        self._held = {}
+        self._admitted = 0
+        self._shed = 0
+
+    def _try_acquire(self, event):
+        with self._lock:
+            overloaded = len(self._held) >= self.max_in_flight
+            if not overloaded and self.max_queue_depth is not None and self.queue_depth is not None:
+                overloaded = self.queue_depth() >= self.max_queue_depth
+            if overloaded:
+                self._shed += 1
+                return False
+            self._held[id(event)] = event
+            self._admitted += 1
+            return True
+
+    def done(self, event):
+        # Frees the slot `event` was admitted with, if any
+        with self._lock:
+            self._held.pop(id(event), None)
+
+    def admit(self, busy_reply):
+        # Handler decorator: the handler's events go through admit_events(),
+        # and `busy_reply(event)` answers the ones that are shed. Handlers
+        # wrapped around this one must keep its attributes (functools.wraps).
+        def decorator(func):
+            func.admission = (self, busy_reply)
+            return func
+        return decorator
+
+    def admit_events(self, events, find_handler, duplicate=None):
+        # Returns (admitted events, [(shed event, busy_reply)]), in order.
+        # `duplicate(event)` tells redeliveries apart; it must not claim the
+        # event, the handler's dedup does that.
+        admitted, shed = [], []
+        for event in events:
+            gate = getattr(find_handler(event), 'admission', None)
+            if (gate is None or gate[0] is not self or (duplicate is not None and duplicate(event))
+                    or self._try_acquire(event)):
+                admitted.append(event)
+            else:
+                logger.warning("Pipeline saturated, shedding event")
+                shed.append((event, gate[1]))
+        return admitted, shed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._held),
+                "max_in_flight": self.max_in_flight,
+                "max_queue_depth": self.max_queue_depth,
+                "admitted": self._admitted,
+                "shed": self._shed,
+            }
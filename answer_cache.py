@@ -0,0 +1,95 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Rough per-entry bookkeeping (dict slot, tuple, key strings) added to the
+# encoded sizes when counting bytes
+ENTRY_OVERHEAD = 200
+
+ROUTES = ('search', 'direct')
+
+
+def normalize_query(query):
+    # NFKC folds full-width forms (and other compatibility characters) into
+    # their plain equivalents; then case, whitespace and punctuation are
+    # dropped, so "天氣？", "天氣" and " 天氣 " share an entry
+    text = unicodedata.normalize('NFKC', query).casefold()
+    return ''.join(ch for ch in text
+                   if not ch.isspace() and not unicodedata.category(ch).startswith('P'))
+
+
+class AnswerCache(object):
+    # Answers keyed on the normalized query and the route that produced them
+    # ('search' or 'direct'). Search answers are about current events and
+    # expire sooner. An LRU bounded by the approximate bytes it holds.
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, search_ttl=600, direct_ttl=86400):
+        self.max_bytes = max_bytes
+        self.ttls = {'search': search_ttl, 'direct': direct_ttl}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = {route: 0 for route in ROUTES}
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+
+    def _remove(self, key):
+        answer, expires_at, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, query):
+        # Looked up before routing, so both routes are tried; a fresh search
+        # answer wins over a direct one
+        normalized = normalize_query(query)
+        if not normalized:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            for route in ROUTES:
+                key = (route, normalized)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    self._remove(key)
+                    self._expired += 1
+                    continue
+                self._entries.move_to_end(key)
+                self._hits[route] += 1
+                return entry[0]
+            self._misses += 1
+            return None
+
+    def put(self, query, route, answer):
+        normalized = normalize_query(query)
+        if not normalized or not answer:
+            return
+        key = (route, normalized)
+        size = len(normalized.encode('utf-8')) + len(answer.encode('utf-8')) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (answer, time.monotonic() + self.ttls[route], size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            hits = sum(self._hits.values())
+            lookups = hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": dict(self._hits),
+                "misses": self._misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+                "expired": self._expired,
+                "evictions": self._evictions,
+            }
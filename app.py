@@ -1,64 +1,169 @@
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, abort, jsonify
+from linebot import LineBotApi
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import *
-from openai import OpenAI
 import os
-from search import google_search , should_search
-import sqlite3
+import uuid
+from functools import partial
+from line_http import ResilientHttpClient
+from services import Services
+from streaming import SentenceChunker, deliver
+from ratelimit import per_user
+from users_db import save_user_to_db
 from flask import send_file
+from flask.logging import default_handler
 from image_processing import *
+from webhook_handler import AppWebhookHandler, event_key
+from event_queue import EventQueue
+from admission import AdmissionController
+import app_logging
+from app_logging import setup_logging, log_payload, correlation_id
+import atexit
+import signal
+import sys
+
+# Log records are written as JSON lines by a background thread
+setup_logging(level=os.environ.get('LOG_LEVEL', 'INFO'))
 
 app = Flask(__name__)
+app.logger.removeHandler(default_handler)
+
+# Configuration and the components shared with async_app.py; see services.py
+services = Services()
+BODY_LOG_SAMPLE_RATE = services.body_log_sample_rate
+BODY_LOG_MAX_BYTES = services.body_log_max_bytes
+upstreams = services.upstreams
+clients = services.clients
+answer_cache = services.answer_cache
+semantic_cache = services.semantic_cache
+limiter = services.limiter
+models = services.models
+pipeline = services.pipeline
+conversations = services.conversations
+deadlines = services.deadlines
+dedup = services.dedup
+STREAMING = services.streaming
+STREAM_FIRST_CHARS = services.stream_first_chars
+STREAM_CHUNK_CHARS = services.stream_chunk_chars
+BUSY_MESSAGE = services.busy_message
+atexit.register(clients.close)
+if semantic_cache is not None:
+    atexit.register(semantic_cache.save)
 
 # LINE API setup
-line_bot_api = LineBotApi(os.environ['CHANNEL_ACCESS_TOKEN'])
-handler = WebhookHandler(os.environ['CHANNEL_SECRET'])
+line_bot_api = LineBotApi(services.channel_access_token,
+                          http_client=partial(ResilientHttpClient, upstreams['line']))
+# Events of one user/group/room run in order, different sources run in
+# parallel on up to WEBHOOK_CONCURRENCY threads
+handler = AppWebhookHandler(
+    services.channel_secret,
+    concurrency=int(os.environ.get('WEBHOOK_CONCURRENCY', 1)),
+    lazy=services.lazy_events,
+)
 
-# OpenAI API setup
-API_KEY = os.environ['OPENAI_API_KEY']
-GOOGLE_API_KEY = os.environ['GOOGLE_API_KEY']
-SEARCH_ENGINE_ID = os.environ['SEARCH_ENGINE_ID']
+# Webhook mode: 'sync' handles events inside the request, 'queue' acknowledges
+# right away and hands the events to a pool of worker threads
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', 4))
+
+def dispatch(event, destination=None):
+    try:
+        handler.dispatch(event, destination)
+    finally:
+        admission.done(event)
 
-# Connect to your database
-DATABASE = 'line_bot_users.db'
+event_queue = EventQueue(
+    dispatch,
+    maxsize=int(os.environ.get('EVENT_QUEUE_SIZE', 1000)),
+    workers=EVENT_WORKERS,
+)
+atexit.register(event_queue.shutdown)
 
-def create_connection():
-    conn = sqlite3.connect(DATABASE)
-    return conn
+# Load shedding: over these limits, text and image messages get BUSY_MESSAGE
+# as an immediate reply from the callback instead of a GPT or OpenCV job. By
+# default no more events are admitted than there are threads to run them: the
+# queue's workers, the handler's pool, or else the gunicorn threads less one
+# left free for busy replies.
+if WEBHOOK_MODE == 'queue':
+    default_in_flight = EVENT_WORKERS
+elif handler.concurrency > 1:
+    default_in_flight = handler.concurrency
+else:
+    default_in_flight = max(1, int(os.environ.get('GUNICORN_THREADS', 8)) - 1)
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', default_in_flight)),
+    max_queue_depth=int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', 200)),
+    queue_depth=event_queue.depth,
+)
 
-def save_user_to_db(user_id, username):
-    conn = create_connection()
-    cursor = conn.cursor()
+def reply_busy(event):
     try:
-        # Insert user_id and username into the database
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-        conn.commit()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=BUSY_MESSAGE))
     except Exception as e:
-        app.logger.error(f"Failed to insert user: {e}")
-    finally:
-        conn.close()
+        app.logger.error(f"Failed to send busy reply: {e}")
+
+# Host used to build public image URLs. Events may be handled on a worker
+# thread outside of the request, so fall back to the host their callback came
+# in on, which parse() stamps on every event.
+PUBLIC_HOST = services.public_host
+
+def public_host(event):
+    return PUBLIC_HOST or event.callback_host
+
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        abort(400)
-    return 'OK'
+    # Raw bytes: the signature check and JSON parsing both work on them as-is
+    body = request.get_data()
+
+    with correlation_id(uuid.uuid4().hex):
+        log_payload(app.logger, body, sample_rate=BODY_LOG_SAMPLE_RATE, max_bytes=BODY_LOG_MAX_BYTES)
+
+        try:
+            payload = handler.parse(body, signature, request.host)
+        except InvalidSignatureError:
+            abort(400)
+
+        admitted, shed = admission.admit_events(payload.events, handler.find_handler, dedup.is_duplicate)
+        for event, busy_reply in shed:
+            busy_reply(event)
+
+        if WEBHOOK_MODE == 'queue':
+            # All or nothing, so a redelivered payload is never partly handled twice
+            if not event_queue.submit_all(admitted, payload.destination, key=event_key):
+                for event in admitted:
+                    admission.done(event)
+                app.logger.warning("Event queue is full, asking LINE to redeliver")
+                abort(503)
+            return 'OK'
+
+        try:
+            handler.dispatch_all(admitted, payload.destination)
+        finally:
+            for event in admitted:
+                admission.done(event)
+        return 'OK'
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return jsonify(dict(
+        services.stats(),
+        webhook_mode=WEBHOOK_MODE,
+        event_queue=event_queue.stats(),
+        admission=admission.stats(),
+        logging=app_logging.stats(),
+    ))
 
 
 @app.route('/image/<image_id>', methods=['GET'])
 def serve_image(image_id):
     # Path to the image in the /tmp directory
-    print(os.listdir('/tmp'))  # Debugging line
     image_path = f"/tmp/{image_id}.jpg"
     
     try:
-        print(f"Serving image from: {image_path}")  # Debugging line
+        app.logger.debug(f"Serving image from: {image_path}")
         return send_file(image_path, mimetype='image/jpeg')
     except Exception as e:
         app.logger.error(f"Failed to serve image: {e}")
@@ -66,6 +171,7 @@ def serve_image(image_id):
 
 
 @handler.add(FollowEvent)
+@dedup.once
 def handle_follow(event):
     user_id = event.source.user_id  # Get the user's ID when they add the bot
     app.logger.info(f"New follower: {user_id}")
@@ -87,98 +193,96 @@ def handle_follow(event):
 
 
 @handler.add(MessageEvent, message=TextMessage)
+@dedup.once
+@admission.admit(reply_busy)
+@per_user
 def handle_message(event):
-    user_message = event.message.text
-    user_id = event.source.user_id
-    user_name = line_bot_api.get_profile(user_id).display_name
-    
-    try:
-        client = OpenAI(
-            # This is the default and can be omitted
-            api_key=API_KEY,
-        )
-        # Check if the query requires an online search
-        decision = should_search(user_message, client)
-
-        if 'yes' not in decision:
-            response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                # {"role": "system", "content": "You are a helpful assistant that provides information."},
-                {"role": "user", "content": user_message}
-            ]
-            )
-            ai_message = response.choices[0].message.content
+    with deadlines.track(line_bot_api, event, 'text') as delivery:
+        user_message = event.message.text
+        user_id = event.source.user_id
+        user_name = line_bot_api.get_profile(user_id).display_name
 
-        else:
-        
-            # Search Google for the user's query
-            search_results = google_search(user_message, GOOGLE_API_KEY, SEARCH_ENGINE_ID)
-            # Extract relevant data (title, link, snippet) from the search results
-            formatted_results = ""
-            for item in search_results.get('items', []):
-                title = item['title']
-                link = item['link']
-                snippet = item['snippet']
-                formatted_results += f"Title: {title}\nLink: {link}\nSnippet: {snippet}\n\n"
-
-            # Feed the formatted results into the GPT model
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that summarizes search results."},
-                    {"role": "user", "content": f"Here are the Google search results for the query '{user_message}':\n\n{formatted_results}"},
-                    {"role": "user", "content": "Can you summarize these search results for me?"}
-                ]
-            )
-            ai_message = response.choices[0].message.content
+        history = conversations.history(user_id) if conversations is not None else ()
+
+        if STREAMING:
+            return stream_message(delivery, event, user_message, user_name, history)
+
+        answered = False
+        try:
+            ai_message = pipeline.answer(user_message, clients.openai(), history)
+            answered = True
 
+        except Exception as e:
+            app.logger.error(f"OpenAI API request failed: {e}")
+            ai_message = f"Sorry, I couldn't process your request, {user_name}."
+
+        # Send AI-generated message back to user, pushed if the reply token ran out
+        delivery.send(TextSendMessage(text=ai_message))
+    if answered and conversations is not None:
+        conversations.record(user_id, user_message, ai_message)
+
+
+def stream_message(delivery, event, user_message, user_name, history):
+    # The first chunk takes the reply token if it is still good; the rest
+    # are pushed to the group or room the question came from, if any
+    def send(text, first):
+        delivery.send(TextSendMessage(text=text))
+
+    try:
+        ai_message = deliver(pipeline.answer_stream(user_message, clients.openai(), history), send,
+                             SentenceChunker(first_chars=STREAM_FIRST_CHARS, chunk_chars=STREAM_CHUNK_CHARS))
     except Exception as e:
         app.logger.error(f"OpenAI API request failed: {e}")
-        ai_message = f"Sorry, I couldn't process your request, {user_name}."
-
-    # Send AI-generated message back to user
-    message = TextSendMessage(text=ai_message)
-    line_bot_api.reply_message(event.reply_token, message)
-    # line_bot_api.push_message(user_id, message)
+        delivery.send(TextSendMessage(text=f"Sorry, I couldn't process your request, {user_name}."))
+        return
+    if conversations is not None:
+        conversations.record(event.source.user_id, user_message, ai_message)
 
 
 @handler.add(MessageEvent, message=ImageMessage)
+@dedup.once
+@admission.admit(reply_busy)
 def handle_image_message(event):
-    message_id = event.message.id
+    with deadlines.track(line_bot_api, event, 'image') as delivery:
+        message_id = event.message.id
 
-    # Download the image from LINE servers
-    message_content = line_bot_api.get_message_content(message_id)
+        # Download the image from LINE servers
+        message_content = line_bot_api.get_message_content(message_id)
     
-    # Save the image to the /tmp directory
-    temp_image_path = f"/tmp/{message_id}.jpg"
-    with open(temp_image_path, 'wb') as fd:
-        for chunk in message_content.iter_content():
-            fd.write(chunk)
+        # Save the image to the /tmp directory
+        temp_image_path = f"/tmp/{message_id}.jpg"
+        with open(temp_image_path, 'wb') as fd:
+            for chunk in message_content.iter_content():
+                fd.write(chunk)
     
-    # Process the image to extract quadrilaterals
-    output_dir = "/tmp"
-    transformed_image_paths = transform_papers_to_squares(temp_image_path, output_dir)
+        # Process the image to extract quadrilaterals
+        output_dir = "/tmp"
+        # Named after the message, so concurrent users never get each other's documents
+        image_id = f"{message_id}_transformed"
+        transformed_image_paths = transform_papers_to_squares(temp_image_path, output_dir, prefix=image_id)
     
-    # Ensure the URL is HTTPS and construct image URLs
-    image_messages = []
-    for i, transformed_image_path in enumerate(transformed_image_paths):
-        image_url = f"https://{request.host}/image/transformed_{i+1}"
-        image_message = ImageSendMessage(
-            original_content_url=image_url,
-            preview_image_url=image_url
-        )
-        image_messages.append(image_message)
+        # Ensure the URL is HTTPS and construct image URLs
+        image_messages = []
+        for i, transformed_image_path in enumerate(transformed_image_paths):
+            image_url = f"https://{public_host(event)}/image/{image_id}_{i+1}"
+            image_message = ImageSendMessage(
+                original_content_url=image_url,
+                preview_image_url=image_url
+            )
+            image_messages.append(image_message)
 
-    if image_messages:
-        # Send all transformed images back to the user
-        line_bot_api.reply_message(event.reply_token, image_messages)
-    else:
-        # Send a message if no valid quadrilaterals were found
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="No valid documents found in the image."))
+        if image_messages:
+            # Send all transformed images back to the user
+            delivery.send(image_messages)
+        else:
+            # Send a message if no valid quadrilaterals were found
+            delivery.send(TextSendMessage(text="No valid documents found in the image."))
 
 
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
+    # Exit through sys.exit on SIGTERM so atexit hooks drain the event queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    clients.warm()
     app.run(host='0.0.0.0', port=port)
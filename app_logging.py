@@ -0,0 +1,146 @@
+import atexit
+import contextlib
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Id of the webhook event (or request) being handled, attached to every record
+_correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+# Attributes every LogRecord has; anything else was passed through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'correlation_id'}
+
+_listener = None
+_queue_handler = None
+
+
+@contextlib.contextmanager
+def correlation_id(value):
+    token = _correlation_id.set(value or '-')
+    try:
+        yield
+    finally:
+        _correlation_id.reset(token)
+
+
+def current_correlation_id():
+    return _correlation_id.get()
+
+
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = _correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, with fields passed through `extra=` kept as keys
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "correlation_id": getattr(record, 'correlation_id', '-'),
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats the message on the calling thread; only
+    # take a snapshot here and leave the formatting to the listener thread.
+    # When the writer falls behind, records are dropped and counted rather
+    # than blocking the request.
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level='INFO', max_queue=10000):
+    # Routes the root logger through a queue to a background writer thread
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+
+    log_queue = queue.Queue(max_queue)
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    _queue_handler = queue_handler
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def _restart_after_fork():
+    # The listener thread does not survive fork(); give the child its own
+    # queue (the parent's may have been locked mid-put) and a new thread
+    if _listener is None:
+        return
+    log_queue = queue.Queue(_queue_handler.queue.maxsize)
+    _queue_handler.queue = log_queue
+    _listener.queue = log_queue
+    _listener._thread = None
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def stats():
+    if _queue_handler is None:
+        return {}
+    return {
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+    }
+
+
+def log_payload(logger, body, sample_rate=1.0, max_bytes=2048, **fields):
+    # Logs a sampled, size-capped copy of a request body. Only the kept prefix
+    # is decoded, so large group-chat payloads cost the same as small ones.
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return
+    preview = body[:max_bytes].decode('utf-8', 'replace')
+    logger.info("Request body", extra=dict(
+        fields,
+        body=preview,
+        body_bytes=len(body),
+        body_truncated=len(body) > max_bytes,
+    ))
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import os
+import uuid
+from functools import partial
+
+import aiohttp
+from aiohttp import web
+from linebot import AsyncLineBotApi
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import *
+
+import app_logging
+from app_logging import setup_logging, log_payload, correlation_id
+from admission import AdmissionController
+from line_http import ResilientAsyncHttpClient
+from event_queue import AsyncEventQueue
+from image_processing import *
+from services import Services
+from streaming import SentenceChunker, deliver_async
+from ratelimit import per_user
+from users_db import save_user_to_db
+from webhook_handler import AppWebhookHandler, event_key
+
+# asyncio entry point: the same follow/text/image handlers as app.py, served
+# by aiohttp on a single event loop with AsyncLineBotApi and AsyncOpenAI, so
+# in-flight LINE/OpenAI/Google calls cost a task each instead of a thread.
+#
+#   python async_app.py
+
+setup_logging(level=os.environ.get('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger('async_app')
+
+# Configuration and the components shared with app.py; see services.py. One
+# loop holds many more connections open than a thread pool.
+services = Services(openai_max_connections=1000, openai_max_keepalive=100)
+BODY_LOG_SAMPLE_RATE = services.body_log_sample_rate
+BODY_LOG_MAX_BYTES = services.body_log_max_bytes
+upstreams = services.upstreams
+clients = services.clients
+semantic_cache = services.semantic_cache
+pipeline = services.pipeline
+conversations = services.conversations
+deadlines = services.deadlines
+dedup = services.dedup
+STREAMING = services.streaming
+STREAM_FIRST_CHARS = services.stream_first_chars
+STREAM_CHUNK_CHARS = services.stream_chunk_chars
+BUSY_MESSAGE = services.busy_message
+PUBLIC_HOST = services.public_host
+
+handler = AppWebhookHandler(services.channel_secret, lazy=services.lazy_events)
+
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 1000))
+
+
+async def dispatch(event, destination=None):
+    try:
+        await handler.dispatch_async(event, destination)
+    finally:
+        admission.done(event)
+
+
+event_queue = AsyncEventQueue(
+    dispatch,
+    maxsize=int(os.environ.get('EVENT_QUEUE_SIZE', 10000)),
+    concurrency=ASYNC_CONCURRENCY,
+)
+
+# Load shedding, decided in the callback; by default no more events are
+# admitted than the queue runs at once
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', ASYNC_CONCURRENCY)),
+    max_queue_depth=int(os.environ.get('ADMISSION_MAX_QUEUE_DEPTH', 2000)),
+    queue_depth=event_queue.depth,
+)
+
+# Created on startup, inside the running loop
+session = None
+line_bot_api = None
+client = None
+
+
+async def reply_busy(event):
+    try:
+        await line_bot_api.reply_message(event.reply_token, TextSendMessage(text=BUSY_MESSAGE))
+    except Exception as e:
+        logger.error(f"Failed to send busy reply: {e}")
+
+
+async def on_startup(web_app):
+    global session, line_bot_api, client
+    session = aiohttp.ClientSession()
+    line_bot_api = AsyncLineBotApi(services.channel_access_token, ResilientAsyncHttpClient(session, upstreams['line']))
+    client = clients.async_openai()
+    asyncio.ensure_future(clients.warm_async())
+
+
+async def on_shutdown(web_app):
+    # Let the handlers already running finish before the sessions go away
+    await event_queue.shutdown(timeout=30)
+    await clients.aclose()
+    clients.close()
+    if semantic_cache is not None:
+        semantic_cache.save()
+    await session.close()
+
+
+async def callback(request):
+    signature = request.headers['X-Line-Signature']
+    body = await request.read()
+
+    with correlation_id(uuid.uuid4().hex):
+        log_payload(logger, body, sample_rate=BODY_LOG_SAMPLE_RATE, max_bytes=BODY_LOG_MAX_BYTES)
+        try:
+            payload = handler.parse(body, signature, request.host)
+        except InvalidSignatureError:
+            raise web.HTTPBadRequest()
+
+        admitted, shed = admission.admit_events(payload.events, handler.find_handler, dedup.is_duplicate)
+        for event, busy_reply in shed:
+            await busy_reply(event)
+
+        if not event_queue.submit_all(admitted, payload.destination, key=event_key):
+            for event in admitted:
+                admission.done(event)
+            logger.warning("Event queue is full, asking LINE to redeliver")
+            raise web.HTTPServiceUnavailable()
+    return web.Response(text='OK')
+
+
+async def metrics(request):
+    return web.json_response(dict(
+        services.stats(),
+        webhook_mode="async",
+        event_queue=event_queue.stats(),
+        admission=admission.stats(),
+        logging=app_logging.stats(),
+    ))
+
+
+async def serve_image(request):
+    image_path = f"/tmp/{request.match_info['image_id']}.jpg"
+    if not os.path.exists(image_path):
+        return web.Response(status=404, text="Image not found")
+    return web.FileResponse(image_path, headers={'Content-Type': 'image/jpeg'})
+
+
+@handler.add(FollowEvent)
+@dedup.once
+async def handle_follow(event):
+    user_id = event.source.user_id
+    logger.info(f"New follower: {user_id}")
+
+    try:
+        profile = await line_bot_api.get_profile(user_id)
+        username = profile.display_name
+
+        await asyncio.get_running_loop().run_in_executor(None, save_user_to_db, user_id, username)
+
+        welcome_message = TextSendMessage(text=f"Thank you for adding me, {username}!")
+        await line_bot_api.push_message(user_id, welcome_message)
+
+    except Exception as e:
+        logger.error(f"Error fetching user profile: {e}")
+
+
+@handler.add(MessageEvent, message=TextMessage)
+@dedup.once
+@admission.admit(reply_busy)
+@per_user
+async def handle_message(event):
+    async with deadlines.track_async(line_bot_api, event, 'text') as delivery:
+        user_message = event.message.text
+        user_id = event.source.user_id
+        user_name = (await line_bot_api.get_profile(user_id)).display_name
+
+        history = conversations.history(user_id) if conversations is not None else ()
+
+        if STREAMING:
+            return await stream_message(delivery, event, user_message, user_name, history)
+
+        answered = False
+        try:
+            ai_message = await pipeline.answer_async(user_message, client, session, history)
+            answered = True
+        except Exception as e:
+            logger.error(f"OpenAI API request failed: {e}")
+            ai_message = f"Sorry, I couldn't process your request, {user_name}."
+
+        await delivery.send(TextSendMessage(text=ai_message))
+    if answered and conversations is not None:
+        conversations.record(user_id, user_message, ai_message)
+
+
+async def stream_message(delivery, event, user_message, user_name, history):
+    async def send(text, first):
+        await delivery.send(TextSendMessage(text=text))
+
+    try:
+        ai_message = await deliver_async(
+            pipeline.answer_stream_async(user_message, client, session, history), send,
+            SentenceChunker(first_chars=STREAM_FIRST_CHARS, chunk_chars=STREAM_CHUNK_CHARS))
+    except Exception as e:
+        logger.error(f"OpenAI API request failed: {e}")
+        await delivery.send(TextSendMessage(text=f"Sorry, I couldn't process your request, {user_name}."))
+        return
+    if conversations is not None:
+        conversations.record(event.source.user_id, user_message, ai_message)
+
+
+@handler.add(MessageEvent, message=ImageMessage)
+@dedup.once
+@admission.admit(reply_busy)
+async def handle_image_message(event):
+    async with deadlines.track_async(line_bot_api, event, 'image') as delivery:
+        message_id = event.message.id
+
+        message_content = await line_bot_api.get_message_content(message_id)
+
+        temp_image_path = f"/tmp/{message_id}.jpg"
+        with open(temp_image_path, 'wb') as fd:
+            async for chunk in message_content.iter_content():
+                fd.write(chunk)
+
+        # OpenCV work is CPU-bound, keep it off the event loop. Outputs are
+        # named after the message, so concurrent users never get each other's
+        # documents.
+        output_dir = "/tmp"
+        image_id = f"{message_id}_transformed"
+        transformed_image_paths = await asyncio.get_running_loop().run_in_executor(
+            None, partial(transform_papers_to_squares, temp_image_path, output_dir, prefix=image_id))
+
+        host = PUBLIC_HOST or event.callback_host
+        image_messages = []
+        for i, transformed_image_path in enumerate(transformed_image_paths):
+            image_url = f"https://{host}/image/{image_id}_{i+1}"
+            image_messages.append(ImageSendMessage(
+                original_content_url=image_url,
+                preview_image_url=image_url
+            ))
+
+        if image_messages:
+            await delivery.send(image_messages)
+        else:
+            await delivery.send(TextSendMessage(text="No valid documents found in the image."))
+
+
+def create_app():
+    web_app = web.Application()
+    web_app.router.add_post('/callback', callback)
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_get('/image/{image_id}', serve_image)
+    web_app.on_startup.append(on_startup)
+    web_app.on_shutdown.append(on_shutdown)
+    return web_app
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get('PORT', 5000))
+    web.run_app(create_app(), host='0.0.0.0', port=port)
@@ -0,0 +1,244 @@
+"""Send signed LINE webhook payloads to /callback and report latency.
+
+Synthetic load, at a fixed rate or with a fixed number of concurrent senders:
+
+    python bench/loadgen.py --url http://localhost:5000/callback --kind mixed --rate 50 --requests 1000
+    python bench/loadgen.py --kind text --batch 5 --concurrency 20 --duration 60
+
+Replay captured payloads (JSON lines), at their original pace or scaled:
+
+    python bench/loadgen.py --replay captured.jsonl --speed 2
+
+A replay line is either a webhook payload ({"events": [...]}), an object with
+the payload under "body" and optionally its send time in seconds under "ts",
+or any object with a "text" (or string "body"/"title") field, which is sent
+as a text message. The channel secret comes from --secret or CHANNEL_SECRET.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+KINDS = ('text', 'image', 'follow')
+TEXTS = (
+    "What's the weather in Taipei today?",
+    "今天新聞",
+    "Explain how a hash map works",
+    "what's the date",
+    "Who won the game last night?",
+)
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def make_event(kind, seq, user_id=None, text=None):
+    event = {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'webhookEventId': uuid.uuid4().hex.upper(),
+        'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'user', 'userId': user_id or f'Uloadgen{seq % 1000:025d}'},
+        'replyToken': uuid.uuid4().hex,
+    }
+    if kind == 'text':
+        event['message'] = {'type': 'text', 'id': str(seq), 'text': text or TEXTS[seq % len(TEXTS)]}
+    elif kind == 'image':
+        event['message'] = {'type': 'image', 'id': str(seq), 'contentProvider': {'type': 'line'}}
+    elif kind == 'follow':
+        event['type'] = 'follow'
+    return event
+
+
+def make_payload(kind, batch, seq):
+    if kind == 'mixed':
+        kinds = [KINDS[(seq + i) % len(KINDS)] for i in range(batch)]
+    else:
+        kinds = [kind] * batch
+    return {'destination': 'Uloadgen', 'events': [make_event(k, seq * batch + i) for i, k in enumerate(kinds)]}
+
+
+def load_replay(path):
+    # Returns [(offset_seconds or None, payload dict)]
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for seq, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            ts = record.get('ts')
+            if 'events' in record:
+                payload = record
+            elif isinstance(record.get('body'), dict):
+                payload = record['body']
+            elif isinstance(record.get('body'), str) and record['body'].lstrip().startswith('{'):
+                payload = json.loads(record['body'])
+            else:
+                text = record.get('text') or record.get('body') or record.get('title') or ''
+                items.append((ts, {'destination': 'Uloadgen', 'events': [make_event('text', seq, text=text[:5000])]}))
+                continue
+            if ts is None and payload.get('events'):
+                ts = payload['events'][0].get('timestamp', 0) / 1000.0 or None
+            items.append((ts, payload))
+
+    # Offsets relative to the first payload that has a time
+    times = [ts for ts, _ in items if ts is not None]
+    start = min(times) if times else 0
+    return [(ts - start if ts is not None else None, payload) for ts, payload in items]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Runner(object):
+    def __init__(self, url, secret, timeout):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def send(self, payload, scheduled=None):
+        # Fresh ids per send, so replays are not dropped as redeliveries.
+        # Latency counts from `scheduled`, the perf_counter() time the
+        # request was due, when given.
+        for event in payload.get('events', []):
+            event['webhookEventId'] = uuid.uuid4().hex.upper()
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'X-Line-Signature': sign(self.secret, body)}
+        start = time.perf_counter() if scheduled is None else scheduled
+        try:
+            status = self.session().post(self.url, data=body, headers=headers, timeout=self.timeout).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.statuses[status] += 1
+
+    def report(self, wall):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        print(f"requests:   {count} in {wall:.2f}s ({count / wall if wall else 0:.1f} req/s)")
+        print(f"status:     {dict(self.statuses)}")
+        if latencies:
+            print(f"latency ms: p50={percentile(latencies, 50) * 1000:.1f} "
+                  f"p95={percentile(latencies, 95) * 1000:.1f} "
+                  f"p99={percentile(latencies, 99) * 1000:.1f} "
+                  f"max={latencies[-1] * 1000:.1f}")
+
+
+def run_paced(runner, items, concurrency):
+    # items: [(offset_seconds, payload)], sent at start + offset. Latency is
+    # measured from that scheduled time, so time spent waiting for a free
+    # sender while the server falls behind is counted too (no coordinated
+    # omission).
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for offset, payload in items:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(runner.send, payload, start + offset)
+    return time.perf_counter() - start
+
+
+def run_closed(runner, payloads, concurrency, deadline):
+    # `concurrency` senders, each sending as soon as its last request returns
+    lock = threading.Lock()
+
+    def worker():
+        while time.perf_counter() < deadline:
+            with lock:
+                payload = next(payloads, None)
+            if payload is None:
+                return
+            runner.send(payload)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=__doc__.split('\n', 2)[2])
+    parser.add_argument('--url', default='http://localhost:5000/callback')
+    parser.add_argument('--secret', default=os.environ.get('CHANNEL_SECRET'))
+    parser.add_argument('--kind', choices=KINDS + ('mixed',), default='text')
+    parser.add_argument('--batch', type=int, default=1, help='events per payload')
+    parser.add_argument('--requests', type=int, default=None, help='payloads to send')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run')
+    parser.add_argument('--rate', type=float, default=None, help='payloads per second (open loop)')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent senders')
+    parser.add_argument('--replay', default=None, help='JSON lines file of payloads to replay')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    if not args.secret:
+        parser.error('--secret or CHANNEL_SECRET is required')
+
+    runner = Runner(args.url, args.secret, args.timeout)
+
+    if args.replay:
+        items = load_replay(args.replay)
+        if args.requests:
+            items = items[:args.requests]
+        # Lines without a time are spread at --rate (default 10/s)
+        step = 1.0 / (args.rate or 10.0)
+        paced = []
+        last = 0.0
+        for ts, payload in items:
+            last = ts / args.speed if ts is not None else last + step
+            paced.append((last, payload))
+        wall = run_paced(runner, paced, max(args.concurrency, 64))
+    elif args.rate:
+        total = args.requests or int(args.rate * (args.duration or 10))
+        items = [(i / args.rate, make_payload(args.kind, args.batch, i)) for i in range(total)]
+        wall = run_paced(runner, items, max(args.concurrency, int(args.rate * 2)))
+    else:
+        counter = itertools.count()
+        if args.requests:
+            payloads = (make_payload(args.kind, args.batch, i) for i in itertools.islice(counter, args.requests))
+        else:
+            payloads = (make_payload(args.kind, args.batch, i) for i in counter)
+        deadline = time.perf_counter() + (args.duration or (float('inf') if args.requests else 10))
+        wall = run_closed(runner, payloads, args.concurrency, deadline)
+
+    runner.report(wall)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark webhook parsing: linebot's WebhookParser vs our eager and lazy events.
+
+Usage: python bench/parse_events.py [--events 200] [--rounds 200]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from linebot import WebhookParser  # noqa: E402
+from linebot.models import MessageEvent, TextMessage, ImageMessage, FollowEvent  # noqa: E402
+
+from webhook_handler import AppWebhookHandler  # noqa: E402
+
+SECRET = 'bench-secret'
+
+
+def make_event(i):
+    base = {
+        'mode': 'active',
+        'timestamp': 1700000000000 + i,
+        'webhookEventId': f'01BENCH{i:020d}',
+        'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'group', 'groupId': f'G{i % 7}', 'userId': f'U{i % 50:032d}'},
+    }
+    kind = i % 6
+    if kind == 0:
+        base.update(type='message', replyToken=f'r{i}',
+                    message={'type': 'text', 'id': str(i), 'text': 'what is the weather today?'})
+    elif kind == 1:
+        base.update(type='message', replyToken=f'r{i}',
+                    message={'type': 'image', 'id': str(i),
+                             'contentProvider': {'type': 'line'}})
+    elif kind == 2:
+        base.update(type='unsend', unsend={'messageId': str(i - 1)})
+    elif kind == 3:
+        base.update(type='memberJoined', replyToken=f'r{i}',
+                    joined={'members': [{'type': 'user', 'userId': f'U{i:032d}'}]})
+    elif kind == 4:
+        base.update(type='message', replyToken=f'r{i}',
+                    message={'type': 'sticker', 'id': str(i), 'packageId': '1', 'stickerId': '2',
+                             'stickerResourceType': 'STATIC'})
+    else:
+        base.update(type='follow', replyToken=f'r{i}')
+    return base
+
+
+def make_handler(lazy):
+    handler = AppWebhookHandler(SECRET, lazy=lazy)
+
+    @handler.add(MessageEvent, message=TextMessage)
+    def on_text(event):
+        return event.message.text, event.source.user_id, event.reply_token
+
+    @handler.add(MessageEvent, message=ImageMessage)
+    def on_image(event):
+        return event.message.id, event.reply_token
+
+    @handler.add(FollowEvent)
+    def on_follow(event):
+        return event.source.user_id
+
+    return handler
+
+
+def make_parse(mode, handler):
+    # linebot's own parser is the baseline: it takes the body as text and
+    # builds a model for every event
+    if mode == 'linebot':
+        parser = WebhookParser(SECRET)
+        return lambda body, signature: parser.parse(body.decode('utf-8'), signature, as_payload=True)
+    return handler.parse
+
+
+def run(mode, body, signature, rounds):
+    handler = make_handler(mode == 'lazy')
+    parse = make_parse(mode, handler)
+
+    start = time.perf_counter()
+    handled = 0
+    for _ in range(rounds):
+        payload = parse(body, signature)
+        for event in payload.events:
+            func = handler.find_handler(event)
+            if func is not None:
+                func(event)
+                handled += 1
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    payload = parse(body, signature)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, handled, len(payload.events), retained, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=200, help='events per payload')
+    parser.add_argument('--rounds', type=int, default=200, help='payloads parsed per mode')
+    args = parser.parse_args()
+
+    # Unknown-handler events are expected here, keep the output readable
+    logging.getLogger('webhook_handler').setLevel(logging.ERROR)
+
+    body = json.dumps({'destination': 'Ubench',
+                       'events': [make_event(i) for i in range(args.events)]}).encode('utf-8')
+    signature = base64.b64encode(
+        hmac.new(SECRET.encode('utf-8'), body, hashlib.sha256).digest()).decode('utf-8')
+
+    print(f"payload: {args.events} events, {len(body)} bytes, {args.rounds} rounds")
+    for mode in ('linebot', 'eager', 'lazy'):
+        elapsed, handled, kept, retained, peak = run(mode, body, signature, args.rounds)
+        parsed = args.events * args.rounds
+        print(f"{mode:>7}: {parsed / elapsed:>10.0f} events/s parsed, "
+              f"{handled // args.rounds} handled/payload, {kept} kept, "
+              f"{retained / args.events:>7.0f} bytes/event retained, "
+              f"{peak / args.events:>7.0f} bytes/event peak")
+
+
+if __name__ == '__main__':
+    main()
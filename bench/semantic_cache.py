@@ -0,0 +1,96 @@
+"""Benchmark semantic cache lookups against a large index.
+
+Usage: python bench/semantic_cache.py [--entries 100000] [--dims 256] [--batch 64]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import unicodedata
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import ngram_counts  # noqa: E402
+from semantic_cache import SemanticCache, VectorIndex  # noqa: E402
+
+
+def hashing_embedding(dims=256):
+    # Deterministic local embedding, hashed character n-grams (the router's
+    # features), so the benchmark needs no network. Not for serving: at the
+    # default threshold it matches questions that differ in meaning
+    # (Taipei vs Tainan, today vs tomorrow, won vs lost).
+    def embed(texts):
+        vectors = np.zeros((len(texts), dims), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts, norm = ngram_counts(unicodedata.normalize('NFKC', text), dims)
+            for index, count in counts.items():
+                vectors[row, index] += count
+        return vectors
+    return embed
+
+
+def random_unit_vectors(rng, count, dims):
+    vectors = rng.standard_normal((count, dims)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def fill(index, vectors):
+    now = time.time()
+    for row, vector in enumerate(vectors):
+        index.insert(vector, ['direct', f'answer {row}', None], now + 3600, now)
+
+
+def timed(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--dims', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = random_unit_vectors(rng, args.entries, args.dims)
+    index = VectorIndex(args.dims, args.entries)
+    start = time.perf_counter()
+    fill(index, vectors)
+    print(f"insert:        {(time.perf_counter() - start) / args.entries * 1e6:.1f} us/entry")
+
+    now = time.time()
+    one = vectors[:1]
+    batch = vectors[:args.batch]
+    single = timed(lambda: index.search(one, now), args.rounds)
+    batched = timed(lambda: index.search(batch, now), args.rounds)
+    print(f"search 1:      {single * 1000:.2f} ms")
+    print(f"search {args.batch}:     {batched * 1000:.2f} ms ({batched / args.batch * 1000:.3f} ms/query)")
+    rows, scores = index.search(batch, now)
+    assert (rows == np.arange(args.batch)).all()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'semantic.idx')
+        index.path = path
+        start = time.perf_counter()
+        index.save()
+        print(f"save:          {(time.perf_counter() - start) * 1000:.1f} ms")
+        start = time.perf_counter()
+        loaded = VectorIndex(args.dims, args.entries, path)
+        print(f"load (mmap):   {(time.perf_counter() - start) * 1000:.1f} ms, {loaded.live_count(now)} entries")
+
+    cache = SemanticCache(hashing_embedding(args.dims), args.dims, capacity=1000)
+    answer, vector = cache.lookup("what's the weather in Taipei today")
+    cache.insert(vector, 'search', 'sunny')
+    for query in ("What's the weather in Taipei today?", "weather in taipei today", "how do hash maps work"):
+        print(f"local embedding: {query!r} -> {cache.lookup(query)[0]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry(object):
+    # One pooled OpenAI client per process, shared by every handler thread,
+    # and one AsyncOpenAI client for the event loop. Building a client per
+    # message throws its connection pool away, so each answer paid for a new
+    # TCP connection and TLS handshake to the API.
+    #
+    # Clients are created on first use. A forked child drops the ones it
+    # inherited (their sockets belong to the parent) and builds its own.
+
+    def __init__(self, api_key, max_connections=100, max_keepalive=20, keepalive_expiry=60.0,
+                 timeout=60.0, connect_timeout=5.0, max_retries=2):
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._openai = None
+        self._async_openai = None
+        self._created = 0
+        self._warmed = 0
+        self._warm_failures = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._openai = None
+        self._async_openai = None
+
+    def _limits(self):
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def _timeout(self):
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+    def openai(self):
+        with self._lock:
+            if self._openai is None:
+                self._openai = OpenAI(
+                    api_key=self.api_key,
+                    timeout=self._timeout(),
+                    max_retries=self.max_retries,
+                    http_client=httpx.Client(limits=self._limits(), timeout=self._timeout()),
+                )
+                self._created += 1
+            return self._openai
+
+    def async_openai(self):
+        # Call from inside the running loop; the pool is bound to it
+        with self._lock:
+            if self._async_openai is None:
+                self._async_openai = AsyncOpenAI(
+                    api_key=self.api_key,
+                    timeout=self._timeout(),
+                    max_retries=self.max_retries,
+                    http_client=httpx.AsyncClient(limits=self._limits(), timeout=self._timeout()),
+                )
+                self._created += 1
+            return self._async_openai
+
+    def _record_warm(self, error):
+        with self._lock:
+            if error is None:
+                self._warmed += 1
+            else:
+                self._warm_failures += 1
+        if error is not None:
+            logger.warning(f"Failed to warm OpenAI connection: {error}")
+
+    def warm(self, background=True):
+        # Opens a pooled connection (TCP + TLS) ahead of the first message
+        # with a cheap models.list() call
+        client = self.openai().with_options(max_retries=0)
+
+        def run():
+            try:
+                client.models.list()
+            except Exception as e:
+                self._record_warm(e)
+            else:
+                self._record_warm(None)
+
+        if not background:
+            run()
+            return
+        threading.Thread(target=run, name='openai-warm', daemon=True).start()
+
+    async def warm_async(self):
+        try:
+            await self.async_openai().with_options(max_retries=0).models.list()
+        except Exception as e:
+            self._record_warm(e)
+        else:
+            self._record_warm(None)
+
+    def close(self):
+        with self._lock:
+            client, self._openai = self._openai, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self):
+        with self._lock:
+            client, self._async_openai = self._async_openai, None
+        if client is not None:
+            await client.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_connections": self.max_connections,
+                "max_keepalive": self.max_keepalive,
+                "keepalive_expiry_s": self.keepalive_expiry,
+                "timeout_s": self.timeout,
+                "max_retries": self.max_retries,
+                "clients_created": self._created,
+                "warmed": self._warmed,
+                "warm_failures": self._warm_failures,
+            }
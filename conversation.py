@@ -0,0 +1,235 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from tokens import count_tokens, MESSAGE_OVERHEAD
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_TURNS = 40
+
+
+def gpt_summarizer(get_client, models, max_tokens=200):
+    # summarize(summary, turns) -> new summary, folding the dropped turns
+    # into the running summary with one short completion on the tier
+    # `models` (a ModelPolicy) picks for summaries
+    def summarize(summary, turns):
+        transcript = "\n".join(f"{role}: {content}" for role, content, tokens in turns)
+        messages = [
+            {"role": "system", "content": "You keep a running summary of a chat between a user and an assistant. "
+                                          "Update the summary with the new lines. Keep names, facts, preferences "
+                                          "and open questions; stay under 120 words."},
+            {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew lines:\n{transcript}"},
+        ]
+        response = models.create(get_client(), models.tier_for('summary'), messages=messages, max_tokens=max_tokens)
+        return response.choices[0].message.content.strip()
+    return summarize
+
+
+class Conversation(object):
+    # One user's memory: a rolling summary of older turns, the recent turns
+    # verbatim as (role, content, tokens), and the turns dropped from the
+    # window that the summary does not cover yet
+    __slots__ = ('summary', 'turns', 'pending', 'updated_at')
+
+    def __init__(self, summary='', turns=None, pending=None, updated_at=0.0):
+        self.summary = summary
+        self.turns = turns or []
+        self.pending = pending or []
+        self.updated_at = updated_at
+
+
+class ConversationStore(object):
+    # Per-user conversation history, kept under `budget` tokens per request:
+    # record() moves the oldest turns out of the window once summary and
+    # turns go over it, and a background thread folds them into the summary
+    # after the reply has been sent. Without a summarizer they are dropped.
+    #
+    # In memory it is an LRU of `max_users` conversations; with `db_path` it
+    # is a SQLite table shared by every worker process. Conversations idle
+    # for `ttl` seconds start over.
+
+    def __init__(self, summarize=None, budget=1500, summary_budget=300, max_users=10000,
+                 ttl=86400, db_path=None):
+        self.summarize = summarize
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.max_users = max_users
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = None
+        self._executor_pid = None
+        self._summaries = 0
+        self._summary_failures = 0
+        self._dropped_turns = 0
+        if db_path:
+            self._init_db()
+
+    def _connection(self):
+        # SQLite connections must not be shared across threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "user_id TEXT PRIMARY KEY, summary TEXT NOT NULL, turns TEXT NOT NULL, "
+            "pending TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _get_executor(self):
+        # Created on first use so forked workers each get their own thread;
+        # one thread keeps each user's summary updates in order
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='summarizer')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _update(self, user_id, func):
+        # Runs func(conversation) atomically and stores the conversation;
+        # returns what func returns
+        now = time.time()
+        if self.db_path:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT summary, turns, pending, updated_at FROM conversations "
+                                   "WHERE user_id = ?", (user_id,)).fetchone()
+                conversation = Conversation()
+                if row is not None and row[3] + self.ttl >= now:
+                    conversation = Conversation(row[0], [tuple(t) for t in json.loads(row[1])],
+                                                [tuple(t) for t in json.loads(row[2])], row[3])
+                result = func(conversation)
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (user_id, summary, turns, pending, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (user_id, conversation.summary, json.dumps(conversation.turns, ensure_ascii=False),
+                     json.dumps(conversation.pending, ensure_ascii=False), now),
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return result
+
+        with self._lock:
+            conversation = self._entries.pop(user_id, None)
+            if conversation is None or conversation.updated_at + self.ttl < now:
+                conversation = Conversation()
+            result = func(conversation)
+            conversation.updated_at = now
+            self._entries[user_id] = conversation
+            if len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            return result
+
+    def history(self, user_id):
+        # Chat messages to put before the user's new message
+        if not user_id:
+            return []
+        if self.db_path:
+            row = self._connection().execute(
+                "SELECT summary, turns, updated_at FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None or row[2] + self.ttl < time.time():
+                return []
+            summary, turns = row[0], json.loads(row[1])
+        else:
+            with self._lock:
+                conversation = self._entries.get(user_id)
+                if conversation is None or conversation.updated_at + self.ttl < time.time():
+                    return []
+                summary, turns = conversation.summary, list(conversation.turns)
+
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the conversation so far: {summary}"})
+        messages.extend({"role": role, "content": content} for role, content, tokens in turns)
+        return messages
+
+    def _compact(self, conversation):
+        # Moves the oldest turns out until the window fits the budget
+        used = count_tokens(conversation.summary) + sum(t[2] for t in conversation.turns)
+        moved = 0
+        while conversation.turns and used > self.budget:
+            turn = conversation.turns.pop(0)
+            used -= turn[2]
+            moved += 1
+            if self.summarize is not None:
+                conversation.pending.append(turn)
+        # If the summarizer keeps failing, the oldest unsummarized turns go
+        del conversation.pending[:-MAX_PENDING_TURNS]
+        return moved
+
+    def record(self, user_id, user_message, answer):
+        # Call after the reply is sent; summarizing happens in the background
+        if not user_id:
+            return
+
+        def append(conversation):
+            for role, content in (("user", user_message), ("assistant", answer)):
+                conversation.turns.append((role, content, count_tokens(content) + MESSAGE_OVERHEAD))
+            moved = self._compact(conversation)
+            return moved, bool(conversation.pending)
+
+        moved, pending = self._update(user_id, append)
+        if moved:
+            with self._lock:
+                self._dropped_turns += moved
+        if pending:
+            self._get_executor().submit(self._fold_pending, user_id)
+
+    def _fold_pending(self, user_id):
+        snapshot = self._update(user_id, lambda c: (c.summary, list(c.pending)))
+        summary, pending = snapshot
+        if not pending:
+            return
+        try:
+            new_summary = self.summarize(summary, pending)
+        except Exception as e:
+            with self._lock:
+                self._summary_failures += 1
+            logger.warning(f"Failed to update conversation summary: {e}")
+            return
+        # Summaries are asked to be short; this only guards the budget
+        while count_tokens(new_summary) > self.summary_budget:
+            new_summary = new_summary[:int(len(new_summary) * 0.8)]
+
+        def apply(conversation):
+            # Another process may have folded the same turns already
+            if conversation.pending[:len(pending)] != pending:
+                return False, False
+            conversation.summary = new_summary
+            del conversation.pending[:len(pending)]
+            self._compact(conversation)
+            return True, bool(conversation.pending)
+
+        applied, more = self._update(user_id, apply)
+        if applied:
+            with self._lock:
+                self._summaries += 1
+        if more:
+            self._get_executor().submit(self._fold_pending, user_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._entries) if not self.db_path else None,
+                "budget_tokens": self.budget,
+                "dropped_turns": self._dropped_turns,
+                "summaries": self._summaries,
+                "summary_failures": self._summary_failures,
+            }
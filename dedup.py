@@ -0,0 +1,182 @@
+import functools
+import inspect
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def event_dedup_key(event):
+    # webhookEventId is stable across redeliveries of the same event; older
+    # payloads without it fall back to the message id or reply token
+    key = getattr(event, 'webhook_event_id', None)
+    if key:
+        return key
+    message = getattr(event, 'message', None)
+    if message is not None and getattr(message, 'id', None):
+        return 'message:' + message.id
+    reply_token = getattr(event, 'reply_token', None)
+    if reply_token:
+        return 'reply:' + reply_token
+    return None
+
+
+class DedupCache(object):
+    # Remembers recently handled webhook events for `ttl` seconds so LINE
+    # redeliveries do not run the GPT/search pipeline and reply a second time.
+    #
+    # In memory it is an insertion-ordered dict bounded by `max_entries`; with
+    # `db_path` set it is a SQLite table shared by every worker process and
+    # kept across restarts.
+
+    def __init__(self, ttl=600, max_entries=10000, db_path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._duplicates = 0
+        self._accepted = 0
+        if db_path:
+            self._init_db()
+
+    def _connection(self):
+        # SQLite connections must not be shared across threads or forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_db(self):
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_events ("
+            "event_key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS webhook_events_expires_at "
+            "ON webhook_events (expires_at)"
+        )
+
+    def _seen_in_db(self, key, now):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM webhook_events WHERE expires_at < ?", (now,))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO webhook_events (event_key, expires_at) VALUES (?, ?)",
+                (key, now + self.ttl),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 0
+
+    def _seen_in_memory(self, key, now):
+        with self._lock:
+            # Entries share one TTL, so the oldest ones expire first
+            while self._entries:
+                oldest, expires_at = next(iter(self._entries.items()))
+                if expires_at >= now:
+                    break
+                del self._entries[oldest]
+
+            if key in self._entries:
+                return True
+
+            self._entries[key] = now + self.ttl
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return False
+
+    def seen(self, key):
+        # Records `key` and tells whether it was already recorded within the TTL
+        now = time.time()
+        if self.db_path:
+            duplicate = self._seen_in_db(key, now)
+        else:
+            duplicate = self._seen_in_memory(key, now)
+        with self._lock:
+            if duplicate:
+                self._duplicates += 1
+            else:
+                self._accepted += 1
+        return duplicate
+
+    def peek(self, key):
+        # Whether `key` is recorded within the TTL, without recording it
+        now = time.time()
+        if self.db_path:
+            row = self._connection().execute(
+                "SELECT 1 FROM webhook_events WHERE event_key = ? AND expires_at >= ?", (key, now)).fetchone()
+            return row is not None
+        with self._lock:
+            expires_at = self._entries.get(key)
+            return expires_at is not None and expires_at >= now
+
+    def is_duplicate(self, event):
+        # peek() for an event: True for a redelivery of one already taken
+        key = event_dedup_key(event)
+        return key is not None and self.peek(key)
+
+    def forget(self, key):
+        # Lets a redelivery through again, used when handling the event failed
+        if self.db_path:
+            self._connection().execute("DELETE FROM webhook_events WHERE event_key = ?", (key,))
+        else:
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def once(self, func):
+        # Handler decorator; goes below @handler.add so the dedup check runs
+        # before anything else in the handler
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(event):
+                key = event_dedup_key(event)
+                if key is None:
+                    return await func(event)
+                if self.seen(key):
+                    logger.info(f"Dropping duplicate webhook event {key}")
+                    return None
+                try:
+                    return await func(event)
+                except Exception:
+                    self.forget(key)
+                    raise
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(event):
+            key = event_dedup_key(event)
+            if key is None:
+                return func(event)
+            if self.seen(key):
+                logger.info(f"Dropping duplicate webhook event {key}")
+                return None
+            try:
+                return func(event)
+            except Exception:
+                self.forget(key)
+                raise
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "backend": "sqlite" if self.db_path else "memory",
+                "duplicates": self._duplicates,
+                "accepted": self._accepted,
+            }
+            if not self.db_path:
+                stats["size"] = len(self._entries)
+            return stats
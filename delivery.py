@@ -0,0 +1,228 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+from models import percentile
+from webhook_handler import event_key
+
+logger = logging.getLogger(__name__)
+
+
+def event_time(event):
+    # When the event's reply token was issued: the earlier of LINE's
+    # timestamp and our arrival time, so clock skew either way errs early
+    times = [time.time()]
+    received_at = getattr(event, 'received_at', None)
+    if received_at:
+        times.append(received_at)
+    timestamp = getattr(event, 'timestamp', None)
+    if timestamp:
+        times.append(timestamp / 1000.0)
+    return min(times)
+
+
+class ReplyDeadlines(object):
+    # Sends a handler's messages through the event's reply token while it is
+    # still good and by push_message after. LINE reply tokens stop working
+    # about `token_ttl` seconds after the event; one with less than `margin`
+    # seconds left is not used.
+    #
+    # With `ack_text`, the reply token is not left to expire: if this kind
+    # of event usually takes longer (p95) than the token has left, the ack
+    # is replied at once; otherwise it is replied if the answer is not ready
+    # a `margin` before the token would be given up. The answer is then
+    # pushed.
+    #
+    #   with deadlines.track(line_bot_api, event, 'text') as delivery:
+    #       delivery.send(TextSendMessage(text=answer))
+
+    def __init__(self, token_ttl=60.0, margin=5.0, ack_text=None, min_samples=20):
+        self.token_ttl = token_ttl
+        self.margin = margin
+        self.ack_text = ack_text
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._kinds = {}
+
+    def time_left(self, event):
+        return event_time(event) + self.token_ttl - time.time()
+
+    def _kind(self, kind):
+        # Caller holds the lock
+        stats = self._kinds.get(kind)
+        if stats is None:
+            stats = self._kinds[kind] = {"events": 0, "replies": 0, "pushes": 0, "acks": 0,
+                                         "early_acks": 0, "expired_tokens": 0, "durations": deque(maxlen=200)}
+        return stats
+
+    def _count(self, kind, name):
+        with self._lock:
+            self._kind(kind)[name] += 1
+
+    def _ack_at_once(self, kind, time_left):
+        with self._lock:
+            durations = self._kind(kind)["durations"]
+            if len(durations) < self.min_samples:
+                return False
+            return percentile(sorted(durations), 95) > time_left - self.margin
+
+    def _finish(self, kind, elapsed):
+        with self._lock:
+            stats = self._kind(kind)
+            stats["events"] += 1
+            stats["durations"].append(elapsed)
+
+    def track(self, api, event, kind):
+        return Delivery(self, api, event, kind)
+
+    def track_async(self, api, event, kind):
+        return AsyncDelivery(self, api, event, kind)
+
+    def stats(self):
+        with self._lock:
+            kinds = {}
+            for kind, stats in self._kinds.items():
+                durations = sorted(stats["durations"])
+                kinds[kind] = dict((k, v) for k, v in stats.items() if k != "durations")
+                kinds[kind]["p95_ms"] = round(percentile(durations, 95) * 1000, 1)
+            return {
+                "token_ttl_s": self.token_ttl,
+                "margin_s": self.margin,
+                "ack": bool(self.ack_text),
+                "kinds": kinds,
+            }
+
+
+class _BaseDelivery(object):
+    # One event's messages. The reply token is taken by the first send (or
+    # the ack) while it has time left; everything else is pushed.
+
+    def __init__(self, deadlines, api, event, kind):
+        self.deadlines = deadlines
+        self.api = api
+        self.kind = kind
+        self.to = event_key(event)
+        self.started = time.monotonic()
+        self.expires = self.started + deadlines.time_left(event)
+        self._token = event.reply_token
+        self._lock = threading.Lock()
+
+    def _take_token(self):
+        # The reply token if it is unused and still good, else None
+        with self._lock:
+            token, self._token = self._token, None
+        if token is not None and self.expires - time.monotonic() < self.deadlines.margin:
+            self.deadlines._count(self.kind, "expired_tokens")
+            return None
+        return token
+
+    def _ack_delay(self):
+        # Seconds until the ack is due, None without one
+        if not self.deadlines.ack_text:
+            return None
+        time_left = self.expires - time.monotonic()
+        if self.deadlines._ack_at_once(self.kind, time_left):
+            self.deadlines._count(self.kind, "early_acks")
+            return 0.0
+        return max(0.0, time_left - 2 * self.deadlines.margin)
+
+    def _invalid_token(self, error):
+        # LINE answers 400 "Invalid reply token" to an expired or used reply
+        # token; any other 400 is a bad message that a push would not fix
+        if not isinstance(error, LineBotApiError) or error.status_code != 400:
+            return False
+        message = getattr(error.error, 'message', None) or ''
+        return 'invalid reply token' in message.lower()
+
+
+class Delivery(_BaseDelivery):
+
+    def __enter__(self):
+        self._timer = None
+        delay = self._ack_delay()
+        if delay == 0.0:
+            self.ack()
+        elif delay is not None:
+            # The copied context keeps the correlation id and rate-limited user
+            self._timer = threading.Timer(delay, contextvars.copy_context().run, args=(self.ack,))
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.deadlines._finish(self.kind, time.monotonic() - self.started)
+
+    def ack(self):
+        token = self._take_token()
+        if token is None:
+            return
+        try:
+            self.api.reply_message(token, TextSendMessage(text=self.deadlines.ack_text))
+            self.deadlines._count(self.kind, "acks")
+        except Exception as e:
+            logger.warning(f"Failed to send acknowledgement: {e}")
+
+    def send(self, messages):
+        token = self._take_token()
+        if token is not None:
+            try:
+                self.api.reply_message(token, messages)
+                self.deadlines._count(self.kind, "replies")
+                return
+            except LineBotApiError as e:
+                if not self._invalid_token(e):
+                    raise
+                self.deadlines._count(self.kind, "expired_tokens")
+        self.api.push_message(self.to, messages)
+        self.deadlines._count(self.kind, "pushes")
+
+
+class AsyncDelivery(_BaseDelivery):
+    # Same as Delivery, for AsyncLineBotApi
+
+    async def __aenter__(self):
+        self._timer = None
+        delay = self._ack_delay()
+        if delay == 0.0:
+            await self.ack()
+        elif delay is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                delay, lambda: asyncio.ensure_future(self.ack()))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.deadlines._finish(self.kind, time.monotonic() - self.started)
+
+    async def ack(self):
+        token = self._take_token()
+        if token is None:
+            return
+        try:
+            await self.api.reply_message(token, TextSendMessage(text=self.deadlines.ack_text))
+            self.deadlines._count(self.kind, "acks")
+        except Exception as e:
+            logger.warning(f"Failed to send acknowledgement: {e}")
+
+    async def send(self, messages):
+        token = self._take_token()
+        if token is not None:
+            try:
+                await self.api.reply_message(token, messages)
+                self.deadlines._count(self.kind, "replies")
+                return
+            except LineBotApiError as e:
+                if not self._invalid_token(e):
+                    raise
+                self.deadlines._count(self.kind, "expired_tokens")
+        await self.api.push_message(self.to, messages)
+        self.deadlines._count(self.kind, "pushes")
@@ -0,0 +1,225 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class EventQueue(object):
+    # Bounded queue of parsed webhook events served by a pool of worker threads.
+    # The webhook callback only enqueues, so LINE gets its 200 right away.
+    #
+    # Events are queued per key (user, group or room id). A key with queued
+    # events and none running is ready, and any idle worker takes the next
+    # ready key, so events of the same source are handled in order while one
+    # slow source only ever holds up its own events.
+
+    def __init__(self, dispatch, maxsize=1000, workers=4):
+        self.dispatch = dispatch
+        self.maxsize = maxsize
+        self.workers = workers
+        self._cond = threading.Condition()
+        # key -> deque of (event, destination); present while the key has
+        # events queued or running
+        self._pending = {}
+        self._ready = deque()
+        self._size = 0
+        self._threads = []
+        self._closed = False
+        self._busy = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Worker threads do not survive fork(); a forked child starts its own
+        # on first submit, with an empty queue
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pending = {}
+        self._ready = deque()
+        self._size = 0
+        self._busy = 0
+
+    def _start(self):
+        # Caller holds the lock
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"event-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, event, destination=None, key=None):
+        # Returns False when the queue is full or shutting down
+        return self.submit_all([event], destination, key=lambda event: key)
+
+    def submit_all(self, events, destination=None, key=None):
+        # Queues all of a payload's events or, when they do not all fit or
+        # the queue is shutting down, none of them and returns False. `key`
+        # maps an event to its source.
+        with self._cond:
+            if self._closed:
+                return False
+            if self._size + len(events) > self.maxsize:
+                self._rejected += len(events)
+                return False
+            if events:
+                self._start()
+            for event in events:
+                event_key = key(event) if key is not None else None
+                if event_key is None:
+                    # No source to keep in order with
+                    event_key = object()
+                pending = self._pending.get(event_key)
+                if pending is None:
+                    pending = self._pending[event_key] = deque()
+                    self._ready.append(event_key)
+                    self._cond.notify()
+                pending.append((event, destination))
+                self._size += 1
+        return True
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                event, destination = self._pending[key].popleft()
+                self._size -= 1
+                self._busy += 1
+            failed = False
+            try:
+                self.dispatch(event, destination)
+            except Exception as e:
+                logger.exception(f"Failed to handle queued event: {e}")
+                failed = True
+            with self._cond:
+                self._busy -= 1
+                self._processed += 1
+                self._failed += failed
+                if self._pending[key]:
+                    # Back of the line, behind the other ready sources
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._pending[key]
+
+    def depth(self):
+        return self._size
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": self._size,
+                "maxsize": self.maxsize,
+                "active_keys": len(self._pending),
+                "workers": len(self._threads),
+                "busy_workers": self._busy,
+                "utilization": self._busy / self.workers if self.workers else 0.0,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+            }
+
+    def shutdown(self, timeout=None):
+        # Stop accepting events and let the workers drain what is already queued
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(timeout)
+        logger.info(f"Event queue shut down, {self.depth()} events left")
+
+
+class AsyncEventQueue(object):
+    # asyncio counterpart of EventQueue: each event becomes a task on the
+    # running loop. Events sharing a key wait for the previous one, at most
+    # `concurrency` handlers run at once and at most `maxsize` are pending.
+
+    def __init__(self, dispatch, maxsize=10000, concurrency=1000):
+        self.dispatch = dispatch
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._tasks = set()
+        self._tails = {}
+        self._closed = False
+        self._busy = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def submit(self, event, destination=None, key=None):
+        # Must be called from the event loop; returns False when full or closing
+        return self.submit_all([event], destination, key=lambda event: key)
+
+    def submit_all(self, events, destination=None, key=None):
+        # All of a payload's events or none of them, as EventQueue.submit_all
+        if self._closed:
+            return False
+        if len(self._tasks) + len(events) > self.maxsize:
+            self._rejected += len(events)
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        for event in events:
+            event_key = key(event) if key is not None else None
+            previous = self._tails.get(event_key) if event_key is not None else None
+            task = asyncio.ensure_future(self._run(previous, event, destination))
+            self._tasks.add(task)
+            if event_key is not None:
+                self._tails[event_key] = task
+            task.add_done_callback(functools.partial(self._finished, key=event_key))
+        return True
+
+    async def _run(self, previous, event, destination):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            self._busy += 1
+            try:
+                await self.dispatch(event, destination)
+            except Exception as e:
+                logger.exception(f"Failed to handle queued event: {e}")
+                self._failed += 1
+            finally:
+                self._busy -= 1
+                self._processed += 1
+
+    def _finished(self, task, key):
+        self._tasks.discard(task)
+        if key is not None and self._tails.get(key) is task:
+            del self._tails[key]
+
+    def depth(self):
+        return len(self._tasks) - self._busy
+
+    def stats(self):
+        return {
+            "depth": self.depth(),
+            "maxsize": self.maxsize,
+            "concurrency": self.concurrency,
+            "in_flight": self._busy,
+            "utilization": self._busy / self.concurrency if self.concurrency else 0.0,
+            "processed": self._processed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+        }
+
+    async def shutdown(self, timeout=None):
+        self._closed = True
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+        logger.info(f"Async event queue shut down, {len(self._tasks)} events left")
@@ -0,0 +1,51 @@
+import gc
+import multiprocessing
+import os
+
+# Production server for app.py:
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# The master imports app.py (and with it cv2 and numpy) once, then forks the
+# workers, which share those pages copy-on-write. `kill -HUP <master>` forks a
+# fresh set of workers and retires the old ones gracefully; since the app is
+# preloaded, code changes need a full restart.
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+
+# Recycle each worker after a number of requests, staggered so they do not
+# all restart at once
+max_requests = int(os.environ.get('MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# No collections while the app is preloaded: freed objects would leave holes
+# in pages that are about to be shared
+gc.disable()
+
+
+def when_ready(server):
+    # Everything imported so far goes to the permanent generation. The
+    # workers' collector then never touches those objects, and so never
+    # writes to (and copies) the shared pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    # Warmed here rather than at import: connections opened in the master
+    # would be inherited by every worker
+    import app
+    app.clients.warm()
+
+
+def worker_exit(server, worker):
+    # Drain events already accepted in queue mode before the worker goes away
+    import app
+    app.event_queue.shutdown(timeout=graceful_timeout)
@@ -1,7 +1,9 @@
 import cv2
 import numpy as np
 
-def transform_papers_to_squares(image_path, output_dir, min_area=1000, max_area_ratio=0.9):
+# Outputs are written as {output_dir}/{prefix}_{n}.jpg; give each image its own
+# prefix when several may be processed at once
+def transform_papers_to_squares(image_path, output_dir, min_area=1000, max_area_ratio=0.9, prefix="transformed"):
     # Load the image
     image = cv2.imread(image_path)
     original = image.copy()
@@ -83,7 +85,7 @@ def transform_papers_to_squares(image_path, output_dir, min_area=1000, max_area_
             warped = cv2.warpPerspective(original, M, (maxWidth, maxHeight))
             
             # Save each valid quadrilateral to a file in the /tmp directory
-            output_image_path = f"{output_dir}/transformed_{valid_count+1}.jpg"
+            output_image_path = f"{output_dir}/{prefix}_{valid_count+1}.jpg"
             cv2.imwrite(output_image_path, warped)
             transformed_image_paths.append(output_image_path)
             valid_count += 1
@@ -0,0 +1,115 @@
+import functools
+import inspect
+
+import linebot.models  # noqa: F401, registers every model class under Base
+from linebot.models.base import Base
+from linebot.models.messages import (
+    TextMessage, ImageMessage, VideoMessage, AudioMessage, LocationMessage, StickerMessage,
+    FileMessage,
+)
+from linebot.utils import to_camel_case
+
+MESSAGE_TYPES = {
+    'text': TextMessage,
+    'image': ImageMessage,
+    'video': VideoMessage,
+    'audio': AudioMessage,
+    'location': LocationMessage,
+    'sticker': StickerMessage,
+    'file': FileMessage,
+}
+
+# Attribute names are looked up on every access, so convert each name once
+camel_case = functools.lru_cache(maxsize=256)(to_camel_case)
+
+
+@functools.lru_cache(maxsize=None)
+def model_fields(model_class=None):
+    # Attribute names the linebot model sets from its constructor, all of
+    # which it leaves as None when the JSON does not carry them. Without a
+    # class, the names of every linebot model.
+    if model_class is not None:
+        return frozenset(
+            name for name, param in inspect.signature(model_class.__init__).parameters.items()
+            if name != 'self' and param.kind not in (param.VAR_POSITIONAL, param.VAR_KEYWORD))
+    fields = set()
+    classes = [Base]
+    while classes:
+        cls = classes.pop()
+        fields |= model_fields(cls)
+        classes.extend(cls.__subclasses__())
+    return frozenset(fields)
+
+
+def _wrap(value):
+    if isinstance(value, dict):
+        return LazyModel(value)
+    if isinstance(value, list):
+        return [_wrap(item) for item in value]
+    return value
+
+
+class LazyModel(object):
+    # Read-only view over a parsed JSON object. Attributes use the snake_case
+    # names of linebot.models (`event.source.user_id`) and are only looked up,
+    # and nested objects only wrapped, when a handler actually reads them.
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getattr__(self, name):
+        try:
+            value = self._data[camel_case(name)]
+        except KeyError:
+            # Like the linebot model, an attribute missing from the JSON is None
+            if name in self._fields():
+                return None
+            raise AttributeError(name)
+        return _wrap(value)
+
+    def _fields(self):
+        # The type of a nested object is not known here, so any model's
+        # attribute name counts
+        return model_fields()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self._data!r})"
+
+
+class LazyEvent(LazyModel):
+    # Webhook event built on demand. Anything the JSON does not carry (model
+    # defaults, as_json_dict(), ...) comes from the full linebot model, which
+    # is built at most once per event.
+    __slots__ = ('event_class', '_model', 'received_at', 'callback_host')
+
+    def __init__(self, data, event_class):
+        LazyModel.__init__(self, data)
+        self.event_class = event_class
+        self._model = None
+        self.received_at = None
+        self.callback_host = None
+
+    def handler_keys(self):
+        # Same keys WebhookHandler.add registers handlers under, most specific first
+        keys = []
+        if self._data.get('type') == 'message':
+            message_class = MESSAGE_TYPES.get(self._data.get('message', {}).get('type'))
+            if message_class is not None:
+                keys.append(self.event_class.__name__ + '_' + message_class.__name__)
+        keys.append(self.event_class.__name__)
+        return keys
+
+    def _fields(self):
+        return model_fields(self.event_class)
+
+    def to_model(self):
+        if self._model is None:
+            self._model = self.event_class.new_from_json_dict(self._data)
+        return self._model
+
+    def __getattr__(self, name):
+        try:
+            return LazyModel.__getattr__(self, name)
+        except AttributeError:
+            return getattr(self.to_model(), name)
@@ -0,0 +1,137 @@
+import uuid
+from urllib.parse import urlparse
+
+from linebot.http_client import RequestsHttpClient
+
+from resilience import TRANSIENT_STATUSES, UpstreamError, error_for_status
+
+try:
+    from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+except ImportError:
+    AiohttpAsyncHttpClient = None
+
+
+# HTTP clients for the LINE SDK that send every request through an
+# resilience.Upstream, so they stop while LINE is down and GETs, PUTs and
+# DELETEs are retried. Once retries run out the last response is handed back
+# and the SDK raises its usual LineBotApiError.
+#
+# A POST that timed out or failed with a 5xx may still have been accepted,
+# so only POSTs LINE can tell apart from their retries are retried: pushes
+# and the other sends carry an X-Line-Retry-Key, kept across attempts, and
+# LINE answers 409 instead of sending a repeat. That 409 means the send went
+# through, so the SDK is shown a success. Replies and other POSTs get one
+# attempt.
+
+# Sends that accept X-Line-Retry-Key
+RETRY_KEY_PATHS = frozenset([
+    '/v2/bot/message/push',
+    '/v2/bot/message/multicast',
+    '/v2/bot/message/narrowcast',
+    '/v2/bot/message/broadcast',
+])
+
+# A 409 from LINE means the retry key was already accepted
+LINE_TRANSIENT_STATUSES = TRANSIENT_STATUSES - {409}
+
+
+class _Accepted(object):
+    # A 409 to a request with a retry key LINE has already accepted: a 200
+    # to the SDK, the real response otherwise
+
+    status_code = 200
+
+    def __init__(self, response):
+        self.response = response
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+def _post_retries(url, headers):
+    # (headers, max_attempts, retry_key) for a POST to `url`
+    if urlparse(url).path not in RETRY_KEY_PATHS:
+        return headers, 1, False
+    # The SDK shares one headers dict between requests
+    headers = dict(headers or {})
+    headers.setdefault('X-Line-Retry-Key', str(uuid.uuid4()))
+    return headers, None, True
+
+
+def _checked(upstream_name, response, retry_key=False):
+    if retry_key and response.status_code == 409:
+        return _Accepted(response)
+    error = error_for_status(upstream_name, response.status_code, response.headers,
+                             transient_statuses=LINE_TRANSIENT_STATUSES)
+    if error is not None and error.transient:
+        error.response = response
+        raise error
+    return response
+
+
+class ResilientHttpClient(RequestsHttpClient):
+    # LineBotApi takes a class: pass functools.partial(ResilientHttpClient, upstream)
+
+    def __init__(self, upstream, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super(ResilientHttpClient, self).__init__(timeout)
+        self.upstream = upstream
+
+    def _send(self, send, *args, max_attempts=None, retry_key=False, **kwargs):
+        try:
+            return self.upstream.call(lambda: _checked(self.upstream.name, send(*args, **kwargs), retry_key),
+                                      max_attempts=max_attempts)
+        except UpstreamError as e:
+            if e.response is not None:
+                return e.response
+            raise
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._send(super(ResilientHttpClient, self).get, url, headers=headers, params=params,
+                          stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        headers, max_attempts, retry_key = _post_retries(url, headers)
+        return self._send(super(ResilientHttpClient, self).post, url, headers=headers, data=data, timeout=timeout,
+                          max_attempts=max_attempts, retry_key=retry_key)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._send(super(ResilientHttpClient, self).delete, url, headers=headers, data=data,
+                          timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._send(super(ResilientHttpClient, self).put, url, headers=headers, data=data, timeout=timeout)
+
+
+if AiohttpAsyncHttpClient is not None:
+    class ResilientAsyncHttpClient(AiohttpAsyncHttpClient):
+
+        def __init__(self, session, upstream, timeout=AiohttpAsyncHttpClient.DEFAULT_TIMEOUT):
+            super(ResilientAsyncHttpClient, self).__init__(session, timeout)
+            self.upstream = upstream
+
+        async def _send(self, send, *args, max_attempts=None, retry_key=False, **kwargs):
+            async def attempt():
+                return _checked(self.upstream.name, await send(*args, **kwargs), retry_key)
+            try:
+                return await self.upstream.call_async(attempt, max_attempts=max_attempts)
+            except UpstreamError as e:
+                if e.response is not None:
+                    return e.response
+                raise
+
+        async def get(self, url, headers=None, params=None, timeout=None):
+            return await self._send(super(ResilientAsyncHttpClient, self).get, url, headers=headers,
+                                    params=params, timeout=timeout)
+
+        async def post(self, url, headers=None, data=None, timeout=None):
+            headers, max_attempts, retry_key = _post_retries(url, headers)
+            return await self._send(super(ResilientAsyncHttpClient, self).post, url, headers=headers,
+                                    data=data, timeout=timeout, max_attempts=max_attempts, retry_key=retry_key)
+
+        async def delete(self, url, headers=None, data=None, timeout=None):
+            return await self._send(super(ResilientAsyncHttpClient, self).delete, url, headers=headers,
+                                    data=data, timeout=timeout)
+
+        async def put(self, url, headers=None, data=None, timeout=None):
+            return await self._send(super(ResilientAsyncHttpClient, self).put, url, headers=headers,
+                                    data=data, timeout=timeout)
@@ -0,0 +1,455 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from resilience import Upstream, classify
+
+from tokens import count_tokens, count_message_tokens
+
+# USD per million prompt / completion tokens, for the cost estimate in /metrics
+PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+# While the large tier is over the latency SLO, one in this many of its
+# requests is sent to it anyway to keep measuring it
+PROBE_EVERY = 10
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def acceptable(response):
+    # A completion worth answering with: text or tool calls
+    choices = getattr(response, 'choices', None)
+    if not choices:
+        return False
+    message = choices[0].message
+    return bool(message.content or getattr(message, 'tool_calls', None))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class ModelTier(object):
+    # A model plus the latency and usage seen for it recently
+
+    def __init__(self, name, model, prices=None, window=200):
+        self.name = name
+        self.model = model
+        self.prices = prices or PRICES.get(model, (0.0, 0.0))
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def cost(self):
+        return (self.prompt_tokens * self.prices[0] + self.completion_tokens * self.prices[1]) / 1e6
+
+    def p95(self):
+        return percentile(sorted(self.latencies), 95)
+
+
+class ModelPolicy(object):
+    # Chooses the model tier for each completion:
+    #
+    #   routing and conversation summaries     -> fast
+    #   summarizing search results             -> large
+    #   questions up to `short_query_tokens`   -> fast
+    #   longer questions                       -> large
+    #
+    # With `latency_slo` (seconds) set, a request meant for the large tier
+    # goes to the fast one while the large tier's recent p95 is over the SLO
+    # (bar an occasional probe).
+    #
+    # create() and stream() run the completion and record its latency,
+    # tokens and cost under the tier.
+    #
+    # Every create() has a deadline, `route_deadline` seconds for routing and
+    # `answer_deadline` for the rest, past which it raises DeadlineExceeded.
+    # With hedge=True, a call still running after its tier's p95 latency gets
+    # a second request on the fast tier; the first acceptable response wins
+    # and the other request is cancelled (a blocking one is abandoned, its
+    # thread finishes in the background). Streams only get the deadline.
+    # Blocking calls that may be hedged run on a pool of `hedge_workers`
+    # threads, their deadline counted from when a thread picks them up; all
+    # others run on the caller's thread.
+    # Every request is sent with what is left of its deadline as the
+    # client's timeout and is not retried past it, so an abandoned request
+    # gives its thread back by the deadline.
+    #
+    # Requests go through `upstream`, a resilience.Upstream that retries
+    # them and fails fast while OpenAI is down; a stream is retried only
+    # until it opens.
+    #
+    # With a ratelimit.RateLimiter, each request is charged one
+    # 'openai_requests' and its estimated 'openai_tokens' (prompt plus
+    # max_tokens, or `completion_estimate`) before it is sent, waiting for
+    # them if need be; the estimate is corrected from the usage reported.
+    # The wait counts against the request's deadline: a request that could
+    # only go out after it raises RateLimited without being charged.
+
+    def __init__(self, fast=None, large=None, short_query_tokens=60, latency_slo=None,
+                 route_deadline=5.0, answer_deadline=30.0, hedge=False, hedge_min_samples=20,
+                 hedge_workers=32, upstream=None, limiter=None, completion_estimate=300):
+        self.fast = fast or ModelTier("fast", "gpt-4o-mini")
+        self.large = large or ModelTier("large", "gpt-4")
+        self.short_query_tokens = short_query_tokens
+        self.latency_slo = latency_slo
+        self.route_deadline = route_deadline
+        self.answer_deadline = answer_deadline
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_workers = hedge_workers
+        self.upstream = upstream or Upstream('openai')
+        self.limiter = limiter
+        self.completion_estimate = completion_estimate
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._over_slo = 0
+        self._downgrades = 0
+        self._calls = 0
+        self._hedged = 0
+        self._hedge_wins = 0
+        self._deadline_exceeded = 0
+        self._primary_latencies = deque(maxlen=1000)
+        self._latencies = deque(maxlen=1000)
+
+    def tier_for(self, purpose, query=None, search=None):
+        # purpose: 'route', 'summary' or 'answer'; search: the route when known
+        if purpose != 'answer':
+            return self.fast
+        if not search and query is not None and count_tokens(query) <= self.short_query_tokens:
+            return self.fast
+        if self.latency_slo is not None:
+            with self._lock:
+                if len(self.large.latencies) >= 10 and self.large.p95() > self.latency_slo:
+                    # Every PROBE_EVERY-th one still goes to the large tier,
+                    # so its p95 can come back under the SLO
+                    self._over_slo += 1
+                    if self._over_slo % PROBE_EVERY:
+                        self._downgrades += 1
+                        return self.fast
+        return self.large
+
+    def _record(self, tier, elapsed, usage, failed=False):
+        with self._lock:
+            tier.calls += 1
+            if failed:
+                tier.errors += 1
+                return
+            tier.latencies.append(elapsed)
+            if usage is not None:
+                tier.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+                tier.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+    def _get_executor(self):
+        # Created on first use so forked workers each get their own threads
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers, thread_name_prefix='llm')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _deadline(self, purpose):
+        return self.route_deadline if purpose == 'route' else self.answer_deadline
+
+    def _hedge_delay(self, tier):
+        # None when hedging is off or the tier has too few samples for a p95
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(tier.latencies) < self.hedge_min_samples:
+                return None
+            return tier.p95()
+
+    def _record_outcome(self, elapsed, hedged=False, hedge_won=False, exceeded=False):
+        with self._lock:
+            self._calls += 1
+            self._hedged += hedged
+            self._hedge_wins += hedge_won
+            self._deadline_exceeded += exceeded
+            if not exceeded:
+                self._latencies.append(elapsed)
+
+    def _record_primary(self, elapsed):
+        with self._lock:
+            self._primary_latencies.append(elapsed)
+
+    def _estimate(self, kwargs):
+        return (count_message_tokens(kwargs.get('messages') or ())
+                + (kwargs.get('max_tokens') or self.completion_estimate))
+
+    def _acquire(self, kwargs, deadline):
+        self._check_deadline(deadline)
+        if self.limiter is None:
+            return None
+        estimate = self._estimate(kwargs)
+        return self.limiter.acquire({'openai_requests': 1, 'openai_tokens': estimate}, user_cost=estimate,
+                                    max_wait=deadline - time.monotonic())
+
+    async def _acquire_async(self, kwargs, deadline):
+        self._check_deadline(deadline)
+        if self.limiter is None:
+            return None
+        estimate = self._estimate(kwargs)
+        return await self.limiter.acquire_async({'openai_requests': 1, 'openai_tokens': estimate},
+                                                user_cost=estimate, max_wait=deadline - time.monotonic())
+
+    def _settle(self, charge, usage):
+        total = getattr(usage, 'total_tokens', None)
+        if charge is not None and total is not None:
+            self.limiter.settle(charge, 'openai_tokens', total)
+
+    def _check_deadline(self, deadline):
+        # Nothing is sent once `deadline` (a time.monotonic() value) has passed
+        if time.monotonic() >= deadline:
+            raise DeadlineExceeded("deadline passed before the request was sent")
+
+    def _raise_past_deadline(self, error, tier, deadline):
+        # A timeout or retryable failure that ran into the deadline is the deadline
+        if time.monotonic() >= deadline and classify(error)[0]:
+            raise DeadlineExceeded(f"{tier.model} did not answer by the deadline") from error
+
+    def _send(self, client, deadline, **kwargs):
+        # One attempt, with what is left of the deadline as its timeout;
+        # returns a coroutine for an async client
+        return client.chat.completions.create(timeout=max(0.01, deadline - time.monotonic()), **kwargs)
+
+    def _create(self, client, tier, deadline, **kwargs):
+        charge = self._acquire(kwargs, deadline)
+        start = time.perf_counter()
+        try:
+            response = self.upstream.call(self._send, client, deadline, model=tier.model, deadline=deadline,
+                                          **kwargs)
+        except Exception as e:
+            self._record(tier, 0.0, None, failed=True)
+            self._raise_past_deadline(e, tier, deadline)
+            raise
+        self._record(tier, time.perf_counter() - start, getattr(response, 'usage', None))
+        self._settle(charge, getattr(response, 'usage', None))
+        return response
+
+    async def _create_async(self, client, tier, deadline, **kwargs):
+        charge = await self._acquire_async(kwargs, deadline)
+        start = time.perf_counter()
+        try:
+            response = await self.upstream.call_async(self._send, client, deadline, model=tier.model,
+                                                      deadline=deadline, **kwargs)
+        except Exception as e:
+            self._record(tier, 0.0, None, failed=True)
+            self._raise_past_deadline(e, tier, deadline)
+            raise
+        self._record(tier, time.perf_counter() - start, getattr(response, 'usage', None))
+        self._settle(charge, getattr(response, 'usage', None))
+        return response
+
+    def create(self, client, tier, purpose='answer', **kwargs):
+        start = time.perf_counter()
+        hedge_delay = self._hedge_delay(tier)
+        if hedge_delay is None:
+            deadline = time.monotonic() + self._deadline(purpose)
+            try:
+                response = self._create(client, tier, deadline, **kwargs)
+            except DeadlineExceeded:
+                self._record_outcome(0.0, exceeded=True)
+                raise
+            except Exception:
+                self._record_outcome(time.perf_counter() - start)
+                raise
+            self._record_primary(time.perf_counter() - start)
+            self._record_outcome(time.perf_counter() - start)
+            return response
+
+        executor = self._get_executor()
+        started = threading.Event()
+        deadlines = []
+
+        def create_primary():
+            # The deadline runs from when a thread picks the call up, not
+            # from when it was queued
+            deadlines.append(time.monotonic() + self._deadline(purpose))
+            started.set()
+            return self._create(client, tier, deadlines[0], **kwargs)
+
+        # Copied contexts keep the correlation id and rate-limited user
+        primary = executor.submit(contextvars.copy_context().run, create_primary)
+        primary.add_done_callback(lambda f: not f.cancelled() and f.exception() is None
+                                  and self._record_primary(time.perf_counter() - start))
+        started.wait()
+        deadline = deadlines[0]
+
+        wait([primary], timeout=max(0.0, min(hedge_delay, deadline - time.monotonic())))
+        pending = [primary]
+        hedge = None
+        if not primary.done() and time.monotonic() < deadline:
+            hedge = executor.submit(contextvars.copy_context().run, self._create, client, self.fast, deadline,
+                                    **kwargs)
+            pending.append(hedge)
+
+        error = fallback = None
+        while pending:
+            done, _ = wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                pending.remove(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                if acceptable(future.result()) or not pending:
+                    for other in pending:
+                        other.cancel()
+                    self._record_outcome(time.perf_counter() - start, hedged=hedge is not None,
+                                         hedge_won=future is hedge)
+                    return future.result()
+                fallback = future.result()
+        if not pending and (fallback is not None or not isinstance(error, DeadlineExceeded)):
+            # Nothing acceptable: an empty answer beats an error
+            self._record_outcome(time.perf_counter() - start, hedged=hedge is not None)
+            if fallback is not None:
+                return fallback
+            raise error
+        for other in pending:
+            other.cancel()
+        self._record_outcome(0.0, hedged=hedge is not None, exceeded=True)
+        raise DeadlineExceeded(f"{tier.model} did not answer within {self._deadline(purpose)}s")
+
+    async def create_async(self, client, tier, purpose='answer', **kwargs):
+        # Same as create(); here the losing request really is cancelled
+        start = time.perf_counter()
+        deadline = time.monotonic() + self._deadline(purpose)
+        primary = asyncio.ensure_future(self._create_async(client, tier, deadline, **kwargs))
+
+        hedge_delay = self._hedge_delay(tier)
+        first_wait = self._deadline(purpose) if hedge_delay is None else min(hedge_delay, self._deadline(purpose))
+        await asyncio.wait({primary}, timeout=first_wait)
+        pending = {primary}
+        hedge = None
+        if not primary.done() and hedge_delay is not None and time.monotonic() < deadline:
+            hedge = asyncio.ensure_future(self._create_async(client, self.fast, deadline, **kwargs))
+            pending.add(hedge)
+
+        error = fallback = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if task is primary:
+                        self._record_primary(time.perf_counter() - start)
+                    if acceptable(task.result()) or not pending:
+                        self._record_outcome(time.perf_counter() - start, hedged=hedge is not None,
+                                             hedge_won=task is hedge)
+                        return task.result()
+                    fallback = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        if not pending and (fallback is not None or not isinstance(error, DeadlineExceeded)):
+            self._record_outcome(time.perf_counter() - start, hedged=hedge is not None)
+            if fallback is not None:
+                return fallback
+            raise error
+        self._record_outcome(0.0, hedged=hedge is not None, exceeded=True)
+        raise DeadlineExceeded(f"{tier.model} did not answer within {self._deadline(purpose)}s")
+
+    def stream(self, client, tier, purpose='answer', **kwargs):
+        # Yields the stream's chunks; usage arrives in a last chunk without choices
+        deadline = time.monotonic() + self._deadline(purpose)
+        charge = self._acquire(kwargs, deadline)
+        start = time.perf_counter()
+        usage = None
+        try:
+            stream = self.upstream.call(self._send, client, deadline, model=tier.model, stream=True,
+                                        stream_options={"include_usage": True}, deadline=deadline, **kwargs)
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                yield chunk
+        except Exception:
+            self._record(tier, 0.0, None, failed=True)
+            raise
+        self._record(tier, time.perf_counter() - start, usage)
+        self._settle(charge, usage)
+
+    async def stream_async(self, client, tier, purpose='answer', **kwargs):
+        deadline = time.monotonic() + self._deadline(purpose)
+        charge = await self._acquire_async(kwargs, deadline)
+        start = time.perf_counter()
+        usage = None
+        try:
+            stream = await self.upstream.call_async(self._send, client, deadline, model=tier.model, stream=True,
+                                                    stream_options={"include_usage": True}, deadline=deadline,
+                                                    **kwargs)
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                yield chunk
+        except Exception:
+            self._record(tier, 0.0, None, failed=True)
+            raise
+        self._record(tier, time.perf_counter() - start, usage)
+        self._settle(charge, usage)
+
+    def stats(self):
+        with self._lock:
+            tiers = {}
+            for tier in (self.fast, self.large):
+                latencies = sorted(tier.latencies)
+                tiers[tier.name] = {
+                    "model": tier.model,
+                    "calls": tier.calls,
+                    "errors": tier.errors,
+                    "latency_ms": {
+                        "p50": round(percentile(latencies, 50) * 1000, 1),
+                        "p95": round(percentile(latencies, 95) * 1000, 1),
+                        "p99": round(percentile(latencies, 99) * 1000, 1),
+                    },
+                    "prompt_tokens": tier.prompt_tokens,
+                    "completion_tokens": tier.completion_tokens,
+                    "cost_usd": round(tier.cost(), 4),
+                }
+            primary_p99 = percentile(sorted(self._primary_latencies), 99)
+            p99 = percentile(sorted(self._latencies), 99)
+            return {
+                "short_query_tokens": self.short_query_tokens,
+                "latency_slo_s": self.latency_slo,
+                "slo_downgrades": self._downgrades,
+                "deadlines_s": {"route": self.route_deadline, "answer": self.answer_deadline},
+                "deadline_exceeded": self._deadline_exceeded,
+                "hedging": {
+                    "enabled": self.hedge,
+                    "calls": self._calls,
+                    "hedged": self._hedged,
+                    "hedge_rate": round(self._hedged / self._calls, 3) if self._calls else 0.0,
+                    "hedge_wins": self._hedge_wins,
+                    "win_rate": round(self._hedge_wins / self._hedged, 3) if self._hedged else 0.0,
+                    # Primary requests alone vs the first acceptable answer.
+                    # Cancelled async primaries are not measured, so the
+                    # improvement is understated there.
+                    "p99_primary_ms": round(primary_p99 * 1000, 1),
+                    "p99_ms": round(p99 * 1000, 1),
+                    "p99_improvement_ms": round((primary_p99 - p99) * 1000, 1) or 0.0,
+                },
+                "tiers": tiers,
+            }
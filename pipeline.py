@@ -0,0 +1,705 @@
+import asyncio
+import contextvars
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models import ModelPolicy
+from answer_cache import normalize_query
+from prompts import PromptBuilder
+from ratelimit import RateLimited
+from resilience import Upstream
+from search import google_search, async_google_search, should_search_messages
+
+logger = logging.getLogger(__name__)
+
+# The text answer pipeline behind handle_message: decide whether the question
+# needs an online search, then either answer it directly or summarize Google
+# results. The blocking and asyncio versions share their prompts, which
+# prompts.PromptBuilder assembles under a token budget.
+
+
+def wants_search(decision):
+    return 'yes' in decision
+
+
+# Tool-calling mode: the model sees the question once, with this tool
+# declared, and asks for a search only when it needs one
+WEB_SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "web_search",
+        "description": "Search Google for up-to-date information such as news, weather, prices, schedules or recent events.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "The search query"},
+            },
+            "required": ["query"],
+        },
+    },
+}
+
+
+def tool_call_message(message):
+    # The assistant turn that requested the tool calls, echoed back to the model
+    return {
+        "role": "assistant",
+        "content": message.content,
+        "tool_calls": [
+            {"id": call.id, "type": "function",
+             "function": {"name": call.function.name, "arguments": call.function.arguments}}
+            for call in message.tool_calls
+        ],
+    }
+
+
+def tool_call_query(arguments, user_message):
+    try:
+        return json.loads(arguments).get('query') or user_message
+    except ValueError:
+        return user_message
+
+
+def merge_tool_call_deltas(tool_calls, deltas):
+    # Streamed tool calls arrive in pieces keyed by index; the arguments
+    # string is split across chunks
+    for delta in deltas:
+        while len(tool_calls) <= delta.index:
+            tool_calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+        call = tool_calls[delta.index]
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function is not None:
+            call["function"]["name"] += delta.function.name or ""
+            call["function"]["arguments"] += delta.function.arguments or ""
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+async def _timed_async(coro):
+    start = time.perf_counter()
+    result = await coro
+    return result, time.perf_counter() - start
+
+
+def _total_tokens(response):
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', 0) or 0
+
+
+class AnswerPipeline(object):
+    # Holds the pipeline's configuration: Google credentials and, optionally,
+    # a local QueryRouter that answers the search/no-search question without
+    # a GPT call when it is confident, and a DecisionLog collecting the GPT
+    # decisions the router is trained on.
+    #
+    # With speculative=True, a question the local router cannot settle starts
+    # the GPT routing call, the direct answer and the Google query at the same
+    # time, keeps the branch the routing call picks and cancels the other.
+    # The discarded work (a search call or a completion's tokens) and the
+    # latency saved against running the steps one after another are recorded.
+    # Blocking branches run on `speculative_workers` threads, three for each
+    # question; branches waiting for one are counted as queued.
+    #
+    # With tool_calling=True, questions the local router cannot settle go to
+    # GPT once with a web_search tool declared: one completion when no search
+    # is needed, two when the model calls the tool. This replaces both the
+    # routing call and speculation.
+    #
+    # Every completion runs on the model tier `models` (a ModelPolicy) picks
+    # for it: routing on the fast tier, answers by route and question length.
+    #
+    # `history` (earlier turns as chat messages) goes in front of the
+    # question in every prompt.
+    #
+    # An AnswerCache, when given, is checked before any of that and filled
+    # with each answer under the route that produced it; a SemanticCache is
+    # checked next, for rewordings of questions already answered. Neither is
+    # used for questions asked with history.
+    #
+    # With a SingleFlight, concurrent identical questions (after the caches
+    # miss) share one answer: the first runs the pipeline, the others wait
+    # for it. Streamed answers are not coalesced.
+    #
+    # Google searches go through `google`, a resilience.Upstream that retries
+    # them and fails fast while Google is down. With a ratelimit.RateLimiter
+    # each search first takes one 'google' from the daily quota; when the
+    # quota has no room for it in time, the question is answered without a
+    # search (but still cached as a search answer, for the shorter TTL).
+
+    def __init__(self, google_api_key, search_engine_id, router=None, decision_log=None,
+                 speculative=False, speculative_workers=16, tool_calling=False, cache=None,
+                 semantic_cache=None, prompts=None, models=None, singleflight=None, google=None,
+                 limiter=None):
+        self.google_api_key = google_api_key
+        self.search_engine_id = search_engine_id
+        self.router = router
+        self.decision_log = decision_log
+        self.speculative = speculative
+        self.speculative_workers = speculative_workers
+        self.tool_calling = tool_calling
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+        self.prompts = prompts or PromptBuilder()
+        self.models = models or ModelPolicy()
+        self.singleflight = singleflight
+        self.google = google or Upstream('google')
+        self.limiter = limiter
+        self._executor = None
+        self._lock = threading.Lock()
+        self._routed_locally = 0
+        self._routed_by_llm = 0
+        self._speculated = 0
+        self._wasted_searches = 0
+        self._wasted_tokens = 0
+        self._cancelled_branches = 0
+        self._latency_saved = 0.0
+        self._tool_answers = 0
+        self._tool_searches = 0
+        self._searches_rate_limited = 0
+        self._queued = 0
+        self._max_queued = 0
+
+    def _get_executor(self):
+        # Created on first use so forked workers each get their own threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.speculative_workers,
+                                                    thread_name_prefix='speculative')
+            return self._executor
+
+    def _submit(self, func, *args):
+        # Runs func on the speculative pool in a copy of this context
+        # (correlation id, rate-limited user); queued until a thread takes it
+        context = contextvars.copy_context()
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+            return context.run(func, *args)
+
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        return self._get_executor().submit(run)
+
+    def _route_locally(self, user_message):
+        # Returns True/False when the local router is confident, else None
+        if self.router is None:
+            return None
+        search, confidence = self.router.predict(user_message)
+        if confidence < self.router.threshold:
+            return None
+        with self._lock:
+            self._routed_locally += 1
+        return search
+
+    def _record_llm_decision(self, user_message, search):
+        with self._lock:
+            self._routed_by_llm += 1
+        if self.decision_log is not None:
+            try:
+                self.decision_log.record(user_message, search)
+            except Exception as e:
+                logger.warning(f"Failed to log routing decision: {e}")
+
+    def _ask_llm(self, user_message, client):
+        # Check if the query requires an online search
+        response = self.models.create(client, self.models.tier_for('route'), purpose='route',
+                                      messages=should_search_messages(self.prompts.query(user_message)))
+        search = wants_search(response.choices[0].message.content.lower())
+        self._record_llm_decision(user_message, search)
+        return search
+
+    async def _ask_llm_async(self, user_message, client):
+        response = await self.models.create_async(client, self.models.tier_for('route'), purpose='route',
+                                                  messages=should_search_messages(self.prompts.query(user_message)))
+        search = wants_search(response.choices[0].message.content.lower())
+        self._record_llm_decision(user_message, search)
+        return search
+
+    def should_search(self, user_message, client):
+        # The local router's decision when it is confident, GPT's otherwise
+        search = self._route_locally(user_message)
+        if search is None:
+            search = self._ask_llm(user_message, client)
+        return search
+
+    async def should_search_async(self, user_message, client):
+        search = self._route_locally(user_message)
+        if search is None:
+            search = await self._ask_llm_async(user_message, client)
+        return search
+
+    def _search_limited(self, error):
+        with self._lock:
+            self._searches_rate_limited += 1
+        logger.warning(f"Answering without a search: {error}")
+
+    def _search(self, query):
+        # The results, or None when the search is over the Google quota
+        if self.limiter is not None:
+            try:
+                self.limiter.acquire({'google': 1})
+            except RateLimited as e:
+                self._search_limited(e)
+                return None
+        return self.google.call(google_search, query, self.google_api_key, self.search_engine_id)
+
+    async def _search_async(self, query, session):
+        if self.limiter is not None:
+            try:
+                await self.limiter.acquire_async({'google': 1})
+            except RateLimited as e:
+                self._search_limited(e)
+                return None
+        return await self.google.call_async(async_google_search, query, self.google_api_key,
+                                            self.search_engine_id, session)
+
+    def _search_prompt(self, user_message, search_results, history):
+        # The direct prompt stands in when the search was rate limited
+        if search_results is None:
+            return self.prompts.direct(user_message, history)
+        return self.prompts.search(user_message, search_results, history)
+
+    def _tier(self, user_message, search):
+        return self.models.tier_for('answer', user_message, search)
+
+    def _complete(self, client, tier, messages):
+        return self.models.create(client, tier, messages=messages)
+
+    def _record_waste(self, branch, result):
+        with self._lock:
+            if branch == 'search':
+                self._wasted_searches += 1
+            else:
+                self._wasted_tokens += _total_tokens(result)
+
+    def _discard(self, future, branch):
+        # A running thread cannot be stopped; its result is dropped when it lands
+        if future.cancel():
+            with self._lock:
+                self._cancelled_branches += 1
+                self._queued -= 1
+            return
+
+        def on_done(done):
+            # A rate-limited search (None) cost nothing
+            if done.exception() is None and done.result()[0] is not None:
+                self._record_waste(branch, done.result()[0])
+        future.add_done_callback(on_done)
+
+    def _record_speculation(self, user_message, search, sequential, elapsed):
+        saved = sequential - elapsed
+        with self._lock:
+            self._speculated += 1
+            self._latency_saved += saved
+        logger.info("Speculative answer", extra={
+            "route": "search" if search else "direct",
+            "latency_s": round(elapsed, 3),
+            "latency_saved_s": round(saved, 3),
+        })
+
+    def _answer_speculatively(self, user_message, client, history):
+        start = time.perf_counter()
+        decision = self._submit(_timed, self._ask_llm, user_message, client)
+        direct = self._submit(_timed, self._complete, client, self._tier(user_message, False),
+                              self.prompts.direct(user_message, history))
+        searched = self._submit(_timed, self._search, user_message)
+
+        try:
+            search, t_decision = decision.result()
+        except Exception:
+            self._discard(direct, 'direct')
+            self._discard(searched, 'search')
+            raise
+
+        if not search:
+            self._discard(searched, 'search')
+            response, t_direct = direct.result()
+            sequential = t_decision + t_direct
+        else:
+            search_results, t_search = searched.result()
+            if search_results is None:
+                # Rate limited: the direct branch is the answer after all
+                response, t_direct = direct.result()
+                sequential = t_decision + t_direct
+            else:
+                self._discard(direct, 'direct')
+                response, t_summary = _timed(self._complete, client, self._tier(user_message, True),
+                                             self.prompts.search(user_message, search_results, history))
+                sequential = t_decision + t_search + t_summary
+
+        self._record_speculation(user_message, search, sequential, time.perf_counter() - start)
+        return response.choices[0].message.content, search
+
+    async def _answer_speculatively_async(self, user_message, client, session, history):
+        # Same as _answer_speculatively(); here the losing branch really is cancelled
+        start = time.perf_counter()
+        decision = asyncio.ensure_future(_timed_async(self._ask_llm_async(user_message, client)))
+        direct = asyncio.ensure_future(_timed_async(self.models.create_async(
+            client, self._tier(user_message, False), messages=self.prompts.direct(user_message, history))))
+        searched = asyncio.ensure_future(_timed_async(self._search_async(user_message, session)))
+
+        try:
+            search, t_decision = await decision
+        except Exception:
+            direct.cancel()
+            searched.cancel()
+            raise
+
+        search_results = None
+        if search:
+            search_results, t_search = await searched
+        # With the search rate limited, the direct branch is the answer after all
+        if not search or search_results is not None:
+            loser = searched if not search else direct
+            if loser.done():
+                if not loser.cancelled() and loser.exception() is None and loser.result()[0] is not None:
+                    self._record_waste('search' if not search else 'direct', loser.result()[0])
+            else:
+                loser.cancel()
+                with self._lock:
+                    self._cancelled_branches += 1
+
+        if search_results is None:
+            response, t_direct = await direct
+            sequential = t_decision + t_direct
+        else:
+            response, t_summary = await _timed_async(self.models.create_async(
+                client, self._tier(user_message, True),
+                messages=self.prompts.search(user_message, search_results, history)))
+            sequential = t_decision + t_search + t_summary
+
+        self._record_speculation(user_message, search, sequential, time.perf_counter() - start)
+        return response.choices[0].message.content, search
+
+    def _record_tool_answer(self, searches):
+        with self._lock:
+            self._tool_answers += 1
+            self._tool_searches += searches
+
+    def _answer_with_tools(self, user_message, client, history):
+        messages = self.prompts.tools(user_message, history)
+        response = self.models.create(client, self._tier(user_message, None), messages=messages,
+                                      tools=[WEB_SEARCH_TOOL])
+        message = response.choices[0].message
+        if not message.tool_calls:
+            self._record_tool_answer(0)
+            return message.content, False
+
+        messages.append(tool_call_message(message))
+        for i, call in enumerate(message.tool_calls):
+            search_results = self._search(tool_call_query(call.function.arguments, user_message))
+            self.prompts.tool_result(messages, call.id, search_results or {}, share=len(message.tool_calls) - i)
+        self._record_tool_answer(len(message.tool_calls))
+        self.prompts.record("tool_followup", messages)
+
+        # No tools on the follow-up, so the model has to answer now
+        response = self._complete(client, self._tier(user_message, True), messages)
+        return response.choices[0].message.content, True
+
+    async def _answer_with_tools_async(self, user_message, client, session, history):
+        messages = self.prompts.tools(user_message, history)
+        response = await self.models.create_async(client, self._tier(user_message, None), messages=messages,
+                                                  tools=[WEB_SEARCH_TOOL])
+        message = response.choices[0].message
+        if not message.tool_calls:
+            self._record_tool_answer(0)
+            return message.content, False
+
+        messages.append(tool_call_message(message))
+        results = await asyncio.gather(*[
+            self._search_async(tool_call_query(call.function.arguments, user_message), session)
+            for call in message.tool_calls
+        ])
+        for i, (call, search_results) in enumerate(zip(message.tool_calls, results)):
+            self.prompts.tool_result(messages, call.id, search_results or {}, share=len(message.tool_calls) - i)
+        self._record_tool_answer(len(message.tool_calls))
+        self.prompts.record("tool_followup", messages)
+
+        response = await self.models.create_async(client, self._tier(user_message, True), messages=messages)
+        return response.choices[0].message.content, True
+
+    def _answer(self, user_message, client, history):
+        search = self._route_locally(user_message)
+        if search is None:
+            if self.tool_calling:
+                return self._answer_with_tools(user_message, client, history)
+            if self.speculative:
+                return self._answer_speculatively(user_message, client, history)
+            search = self._ask_llm(user_message, client)
+
+        if not search:
+            messages = self.prompts.direct(user_message, history)
+        else:
+            # Search Google for the user's query and feed the results into the GPT model
+            search_results = self._search(user_message)
+            messages = self._search_prompt(user_message, search_results, history)
+
+        response = self._complete(client, self._tier(user_message, search), messages)
+        return response.choices[0].message.content, search
+
+    async def _answer_async(self, user_message, client, session, history):
+        search = self._route_locally(user_message)
+        if search is None:
+            if self.tool_calling:
+                return await self._answer_with_tools_async(user_message, client, session, history)
+            if self.speculative:
+                return await self._answer_speculatively_async(user_message, client, session, history)
+            search = await self._ask_llm_async(user_message, client)
+
+        if not search:
+            messages = self.prompts.direct(user_message, history)
+        else:
+            search_results = await self._search_async(user_message, session)
+            messages = self._search_prompt(user_message, search_results, history)
+
+        response = await self.models.create_async(client, self._tier(user_message, search), messages=messages)
+        return response.choices[0].message.content, search
+
+    def _semantic_lookup(self, user_message):
+        # Returns (answer or None, vector); an embedding failure only costs the lookup
+        try:
+            return self.semantic_cache.lookup(user_message)
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None, None
+
+    def _cache_answer(self, user_message, search, content, vector, history):
+        # An answer that depends on earlier turns is not a general answer
+        if history:
+            return
+        route = 'search' if search else 'direct'
+        if self.cache is not None:
+            self.cache.put(user_message, route, content)
+        if vector is not None:
+            self.semantic_cache.insert(vector, route, content, query=user_message)
+
+    def _lookup(self, user_message, history):
+        # Returns (cached answer or None, question vector for the semantic cache).
+        # Follow-ups in a conversation are never answered from the caches.
+        if history:
+            return None, None
+        if self.cache is not None:
+            cached = self.cache.get(user_message)
+            if cached is not None:
+                return cached, None
+        if self.semantic_cache is not None:
+            return self._semantic_lookup(user_message)
+        return None, None
+
+    async def _lookup_async(self, user_message, history):
+        if history:
+            return None, None
+        if self.cache is not None:
+            cached = self.cache.get(user_message)
+            if cached is not None:
+                return cached, None
+        if self.semantic_cache is not None:
+            # The embedding function blocks, so it runs off the event loop
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._semantic_lookup, user_message)
+        return None, None
+
+    def _flight_key(self, user_message, history):
+        # Identical questions coalesce; follow-ups depend on their own history
+        if self.singleflight is None or history:
+            return None
+        return normalize_query(user_message) or None
+
+    def _answer_and_cache(self, user_message, client, history, vector):
+        content, search = self._answer(user_message, client, history)
+        self._cache_answer(user_message, search, content, vector, history)
+        return content
+
+    async def _answer_and_cache_async(self, user_message, client, session, history, vector):
+        content, search = await self._answer_async(user_message, client, session, history)
+        self._cache_answer(user_message, search, content, vector, history)
+        return content
+
+    def answer(self, user_message, client, history=()):
+        cached, vector = self._lookup(user_message, history)
+        if cached is not None:
+            return cached
+        key = self._flight_key(user_message, history)
+        if key is None:
+            return self._answer_and_cache(user_message, client, history, vector)
+        # Routing, search and completion all run once per flight; the route
+        # follows from the question, so the normalized question is the key
+        return self.singleflight.do(key, self._answer_and_cache, user_message, client, history, vector)
+
+    async def answer_async(self, user_message, client, session, history=()):
+        # Same as answer(), with an AsyncOpenAI client and an aiohttp session
+        cached, vector = await self._lookup_async(user_message, history)
+        if cached is not None:
+            return cached
+        key = self._flight_key(user_message, history)
+        if key is None:
+            return await self._answer_and_cache_async(user_message, client, session, history, vector)
+        return await self.singleflight.do_async(key, self._answer_and_cache_async,
+                                                user_message, client, session, history, vector)
+
+    # Streaming: the same answers, yielded as text pieces while the final
+    # completion streams in. Routing (and Google) still happen up front;
+    # speculation does not apply since only the final completion streams.
+
+    def _stream_completion(self, client, tier, messages, tool_calls=None, **kwargs):
+        for chunk in self.models.stream(client, tier, messages=messages, **kwargs):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield delta.content
+            if tool_calls is not None and delta.tool_calls:
+                merge_tool_call_deltas(tool_calls, delta.tool_calls)
+
+    async def _stream_completion_async(self, client, tier, messages, tool_calls=None, **kwargs):
+        async for chunk in self.models.stream_async(client, tier, messages=messages, **kwargs):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                yield delta.content
+            if tool_calls is not None and delta.tool_calls:
+                merge_tool_call_deltas(tool_calls, delta.tool_calls)
+
+    def _stream_with_tools(self, user_message, client, history, result):
+        # Yields the answer; the first completion's text streams through as
+        # well, in case the model answers without calling the tool. `result`
+        # ends up holding the final answer's pieces and whether it searched.
+        parts = result["parts"]
+        messages = self.prompts.tools(user_message, history)
+        tool_calls = []
+        for delta in self._stream_completion(client, self._tier(user_message, None), messages, tool_calls,
+                                              tools=[WEB_SEARCH_TOOL]):
+            parts.append(delta)
+            yield delta
+        self._record_tool_answer(len(tool_calls))
+        if not tool_calls:
+            return
+        result["search"] = True
+
+        messages.append({"role": "assistant", "content": ''.join(parts) or None, "tool_calls": tool_calls})
+        for i, call in enumerate(tool_calls):
+            search_results = self._search(tool_call_query(call["function"]["arguments"], user_message))
+            self.prompts.tool_result(messages, call["id"], search_results or {}, share=len(tool_calls) - i)
+        self.prompts.record("tool_followup", messages)
+        del parts[:]
+        for delta in self._stream_completion(client, self._tier(user_message, True), messages):
+            parts.append(delta)
+            yield delta
+
+    async def _stream_with_tools_async(self, user_message, client, session, history, result):
+        parts = result["parts"]
+        messages = self.prompts.tools(user_message, history)
+        tool_calls = []
+        async for delta in self._stream_completion_async(client, self._tier(user_message, None), messages, tool_calls,
+                                                          tools=[WEB_SEARCH_TOOL]):
+            parts.append(delta)
+            yield delta
+        self._record_tool_answer(len(tool_calls))
+        if not tool_calls:
+            return
+        result["search"] = True
+
+        messages.append({"role": "assistant", "content": ''.join(parts) or None, "tool_calls": tool_calls})
+        results = await asyncio.gather(*[
+            self._search_async(tool_call_query(call["function"]["arguments"], user_message), session)
+            for call in tool_calls
+        ])
+        for i, (call, search_results) in enumerate(zip(tool_calls, results)):
+            self.prompts.tool_result(messages, call["id"], search_results or {}, share=len(tool_calls) - i)
+        self.prompts.record("tool_followup", messages)
+        del parts[:]
+        async for delta in self._stream_completion_async(client, self._tier(user_message, True), messages):
+            parts.append(delta)
+            yield delta
+
+    def answer_stream(self, user_message, client, history=()):
+        cached, vector = self._lookup(user_message, history)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        search = self._route_locally(user_message)
+        if search is None and self.tool_calling:
+            result = {"parts": parts, "search": False}
+            for delta in self._stream_with_tools(user_message, client, history, result):
+                yield delta
+            self._cache_answer(user_message, result["search"], ''.join(parts), vector, history)
+            return
+        if search is None:
+            search = self._ask_llm(user_message, client)
+
+        if not search:
+            messages = self.prompts.direct(user_message, history)
+        else:
+            search_results = self._search(user_message)
+            messages = self._search_prompt(user_message, search_results, history)
+        for delta in self._stream_completion(client, self._tier(user_message, search), messages):
+            parts.append(delta)
+            yield delta
+        self._cache_answer(user_message, search, ''.join(parts), vector, history)
+
+    async def answer_stream_async(self, user_message, client, session, history=()):
+        cached, vector = await self._lookup_async(user_message, history)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        search = self._route_locally(user_message)
+        if search is None and self.tool_calling:
+            result = {"parts": parts, "search": False}
+            async for delta in self._stream_with_tools_async(user_message, client, session, history, result):
+                yield delta
+            self._cache_answer(user_message, result["search"], ''.join(parts), vector, history)
+            return
+        if search is None:
+            search = await self._ask_llm_async(user_message, client)
+
+        if not search:
+            messages = self.prompts.direct(user_message, history)
+        else:
+            search_results = await self._search_async(user_message, session)
+            messages = self._search_prompt(user_message, search_results, history)
+        async for delta in self._stream_completion_async(client, self._tier(user_message, search), messages):
+            parts.append(delta)
+            yield delta
+        self._cache_answer(user_message, search, ''.join(parts), vector, history)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "routed_locally": self._routed_locally,
+                "routed_by_llm": self._routed_by_llm,
+                "speculation": {
+                    "enabled": self.speculative,
+                    "requests": self._speculated,
+                    "cancelled_branches": self._cancelled_branches,
+                    "wasted_searches": self._wasted_searches,
+                    "wasted_completion_tokens": self._wasted_tokens,
+                    "latency_saved_s": round(self._latency_saved, 3),
+                    "workers": self.speculative_workers,
+                    "queued": self._queued,
+                    "max_queued": self._max_queued,
+                },
+                "prompts": self.prompts.stats(),
+                "models": self.models.stats(),
+                "singleflight": self.singleflight.stats() if self.singleflight is not None else None,
+                "tool_calling": {
+                    "enabled": self.tool_calling,
+                    "answers": self._tool_answers,
+                    "searches": self._tool_searches,
+                },
+                "searches_rate_limited": self._searches_rate_limited,
+            }
@@ -0,0 +1,126 @@
+import logging
+import threading
+
+from tokens import count_tokens, count_message_tokens, truncate_to_tokens, MESSAGE_OVERHEAD
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SYSTEM_PROMPT = "You are a helpful assistant that summarizes search results."
+TOOLS_SYSTEM_PROMPT = ("You are a helpful assistant. Use the web_search tool when the question needs "
+                       "up-to-date information, and summarize what it returns.")
+SUMMARIZE_REQUEST = "Can you summarize these search results for me?"
+
+# Below this many tokens of room a search result is dropped rather than cut
+MIN_RESULT_TOKENS = 24
+
+
+def format_result(item):
+    return f"Title: {item.get('title', '')}\nLink: {item.get('link', '')}\nSnippet: {item.get('snippet', '')}\n"
+
+
+class PromptBuilder(object):
+    # Assembles the answer prompts under a token budget. The user's message
+    # is capped at `max_query_tokens`; Google results are added in rank order
+    # while they fit in what the budget leaves, the one that does not fit is
+    # cut down and the rest are dropped. Token counts per prompt kind are kept
+    # for /metrics.
+
+    def __init__(self, budget=3000, max_query_tokens=500):
+        self.budget = budget
+        self.max_query_tokens = max_query_tokens
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self._truncated_queries = 0
+        self._results_used = 0
+        self._results_cut = 0
+        self._results_dropped = 0
+
+    def query(self, user_message):
+        capped = truncate_to_tokens(user_message, self.max_query_tokens)
+        if capped is not user_message:
+            with self._lock:
+                self._truncated_queries += 1
+        return capped
+
+    def format_results(self, search_results, budget):
+        # Results as text in at most `budget` tokens; joined once at the end
+        parts = []
+        used = cut = 0
+        remaining = budget
+        items = search_results.get('items', [])
+        for item in items:
+            text = format_result(item)
+            tokens = count_tokens(text) + 1
+            if tokens > remaining:
+                if remaining >= MIN_RESULT_TOKENS:
+                    parts.append(truncate_to_tokens(text, remaining - 1).rstrip() + "…\n")
+                    cut = 1
+                break
+            parts.append(text)
+            remaining -= tokens
+            used += 1
+        with self._lock:
+            self._results_used += used
+            self._results_cut += cut
+            self._results_dropped += len(items) - used - cut
+        return "\n".join(parts)
+
+    def record(self, kind, messages):
+        # Counts the prompt's tokens under `kind` and returns the count
+        tokens = count_message_tokens(messages)
+        with self._lock:
+            stats = self._kinds.setdefault(kind, {"prompts": 0, "tokens": 0, "max_tokens": 0})
+            stats["prompts"] += 1
+            stats["tokens"] += tokens
+            stats["max_tokens"] = max(stats["max_tokens"], tokens)
+        logger.info("Prompt assembled", extra={"prompt_kind": kind, "prompt_tokens": tokens})
+        return tokens
+
+    def direct(self, user_message, history=()):
+        # `history`: earlier turns of the conversation as chat messages
+        messages = list(history) + [
+            # {"role": "system", "content": "You are a helpful assistant that provides information."},
+            {"role": "user", "content": self.query(user_message)}
+        ]
+        self.record("direct", messages)
+        return messages
+
+    def search(self, user_message, search_results, history=()):
+        query = self.query(user_message)
+        header = f"Here are the Google search results for the query '{query}':\n\n"
+        messages = [{"role": "system", "content": SEARCH_SYSTEM_PROMPT}] + list(history)
+        fixed = (count_message_tokens(messages) + count_tokens(header) + MESSAGE_OVERHEAD
+                 + count_tokens(SUMMARIZE_REQUEST) + MESSAGE_OVERHEAD)
+        formatted_results = self.format_results(search_results, self.budget - fixed)
+        messages += [
+            {"role": "user", "content": header + formatted_results},
+            {"role": "user", "content": SUMMARIZE_REQUEST}
+        ]
+        self.record("search", messages)
+        return messages
+
+    def tools(self, user_message, history=()):
+        messages = [{"role": "system", "content": TOOLS_SYSTEM_PROMPT}] + list(history) + [
+            {"role": "user", "content": self.query(user_message)}
+        ]
+        self.record("tools", messages)
+        return messages
+
+    def tool_result(self, messages, call_id, search_results, share=1):
+        # Appends a tool message with the results, within `share` of the
+        # budget the conversation so far leaves
+        room = (self.budget - count_message_tokens(messages)) // share - MESSAGE_OVERHEAD
+        messages.append({"role": "tool", "tool_call_id": call_id,
+                         "content": self.format_results(search_results, room)})
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_tokens": self.budget,
+                "kinds": {kind: dict(stats, avg_tokens=round(stats["tokens"] / stats["prompts"], 1))
+                          for kind, stats in self._kinds.items()},
+                "truncated_queries": self._truncated_queries,
+                "results_used": self._results_used,
+                "results_cut": self._results_cut,
+                "results_dropped": self._results_dropped,
+            }
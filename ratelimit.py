@@ -0,0 +1,230 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# The user the current request is charged to; see charged_to()
+_current_user = contextvars.ContextVar('rate_limit_user', default=None)
+
+
+@contextlib.contextmanager
+def charged_to(user_id):
+    # Calls made inside the block count against `user_id`'s bucket. Work
+    # handed to an executor keeps the user only when submitted through
+    # contextvars.copy_context().run.
+    token = _current_user.set(user_id)
+    try:
+        yield
+    finally:
+        _current_user.reset(token)
+
+
+def per_user(func):
+    # Handler decorator: the handler's calls are charged to the user who
+    # sent the event
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(event):
+            with charged_to(getattr(event.source, 'user_id', None)):
+                return await func(event)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(event):
+        with charged_to(getattr(event.source, 'user_id', None)):
+            return func(event)
+    return wrapper
+
+
+class RateLimited(Exception):
+    # The wait for `resource` would be longer than the limiter's max_wait
+
+    def __init__(self, resource, wait):
+        super(RateLimited, self).__init__(f"{resource} rate limit: would wait {wait:.1f}s")
+        self.resource = resource
+        self.wait = wait
+
+
+class TokenBucket(object):
+    # `rate` tokens a second, holding at most `capacity`. Charges are taken
+    # at once even past zero, and the caller then waits until the debt is
+    # refilled, so callers queue in arrival order and go out at the rate.
+    # Not thread-safe; RateLimiter locks around it.
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_for(self, amount):
+        # Seconds until `amount` more could be taken without debt
+        short = amount - self.tokens
+        if short <= 0:
+            return 0.0
+        return short / self.rate if self.rate > 0 else float('inf')
+
+
+class _Charge(object):
+    # What one acquire() took, so settle() can correct the estimate
+    __slots__ = ('buckets', 'user_bucket', 'user_cost')
+
+    def __init__(self, buckets, user_bucket, user_cost):
+        self.buckets = buckets
+        self.user_bucket = user_bucket
+        self.user_cost = user_cost
+
+
+class RateLimiter(object):
+    # Local scheduler for upstream budgets. `limits` maps a resource
+    # ('openai_requests', 'openai_tokens', 'google', ...) to (rate per
+    # second, burst). acquire() charges the estimated cost to every
+    # resource of the call and sleeps until all of them have it, so peaks
+    # are queued and smoothed instead of hitting the upstream's limit.
+    # Only waits longer than `max_wait` raise RateLimited.
+    #
+    # With `user_rate`, each user also has a bucket of `user_burst`,
+    # charged `user_cost` (tokens) per call. A `reserve` share of every
+    # resource is kept for fresh users, those with at least half their
+    # bucket left, so heavy users cannot queue everyone else out. Without
+    # `user_rate` nobody is fresh, so nothing is reserved.
+
+    def __init__(self, limits, user_rate=None, user_burst=None, reserve=0.1, max_wait=20.0,
+                 max_users=10000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst or (user_rate * 60 if user_rate else None)
+        self.reserve = reserve if user_rate else 0.0
+        self.max_wait = max_wait
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._shared = {}
+        self._reserved = {}
+        self._stats = {}
+        for resource, (rate, burst) in limits.items():
+            # At least one whole call fits in the shared bucket
+            self._shared[resource] = TokenBucket(rate * (1 - self.reserve), max(1.0, burst * (1 - self.reserve)))
+            self._reserved[resource] = TokenBucket(rate * self.reserve, burst * self.reserve)
+            self._stats[resource] = {"charged": 0, "waits": 0, "wait_s": 0.0, "max_wait_s": 0.0,
+                                     "reserved_uses": 0, "rejected": 0, "estimate_error": 0}
+        self._users = OrderedDict()
+
+    def _user_bucket(self, user_id, now):
+        # Caller holds the lock
+        if user_id is None or not self.user_rate:
+            return None
+        bucket = self._users.pop(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+        self._users[user_id] = bucket
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        bucket.refill(now)
+        return bucket
+
+    def _schedule(self, charges, user_cost, max_wait=None):
+        # Charges the buckets and returns (seconds to wait, charge); charges
+        # nothing when the wait would be over max_wait
+        user_id = _current_user.get()
+        with self._lock:
+            now = time.monotonic()
+            user_bucket = self._user_bucket(user_id, now)
+            fresh = user_bucket is not None and user_bucket.tokens >= user_bucket.capacity / 2
+            wait = user_bucket.wait_for(user_cost) if user_bucket is not None else 0.0
+            waited_on = 'user'
+            picked = {}
+            for resource, amount in charges.items():
+                shared = self._shared.get(resource)
+                if shared is None:
+                    continue
+                shared.refill(now)
+                bucket = shared
+                if fresh:
+                    reserved = self._reserved[resource]
+                    reserved.refill(now)
+                    if reserved.wait_for(amount) < shared.wait_for(amount):
+                        bucket = reserved
+                picked[resource] = (bucket, amount)
+                if bucket.wait_for(amount) > wait:
+                    wait = bucket.wait_for(amount)
+                    waited_on = resource
+
+            if wait > (self.max_wait if max_wait is None else min(self.max_wait, max_wait)):
+                if waited_on in self._stats:
+                    self._stats[waited_on]["rejected"] += 1
+                raise RateLimited(waited_on, wait)
+
+            for resource, (bucket, amount) in picked.items():
+                bucket.tokens -= amount
+                stats = self._stats[resource]
+                stats["charged"] += amount
+                stats["reserved_uses"] += bucket is self._reserved[resource]
+                if wait > 0:
+                    stats["waits"] += 1
+                    stats["wait_s"] += wait
+                    stats["max_wait_s"] = max(stats["max_wait_s"], wait)
+            if user_bucket is not None:
+                user_bucket.tokens -= user_cost
+        return wait, _Charge(picked, user_bucket, user_cost)
+
+    def acquire(self, charges, user_cost=0, max_wait=None):
+        # Blocks until the call may go out; returns the charge for settle().
+        # `max_wait` lowers the limiter's own max_wait for this call.
+        wait, charge = self._schedule(charges, user_cost, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return charge
+
+    async def acquire_async(self, charges, user_cost=0, max_wait=None):
+        wait, charge = self._schedule(charges, user_cost, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return charge
+
+    def settle(self, charge, resource, actual):
+        # Corrects an estimated charge once the real amount is known; the
+        # user's bucket gets the same correction
+        if resource not in charge.buckets:
+            return
+        bucket, estimated = charge.buckets[resource]
+        delta = actual - estimated
+        with self._lock:
+            bucket.tokens = min(bucket.capacity, bucket.tokens - delta)
+            self._stats[resource]["charged"] += delta
+            self._stats[resource]["estimate_error"] += abs(delta)
+            if charge.user_bucket is not None:
+                charge.user_bucket.tokens = min(charge.user_bucket.capacity, charge.user_bucket.tokens - delta)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            resources = {}
+            for resource, stats in self._stats.items():
+                shared, reserved = self._shared[resource], self._reserved[resource]
+                shared.refill(now)
+                reserved.refill(now)
+                resources[resource] = dict(
+                    stats,
+                    rate_per_s=round(shared.rate + reserved.rate, 3),
+                    available=round(shared.tokens, 1),
+                    reserved_available=round(reserved.tokens, 1),
+                    wait_s=round(stats["wait_s"], 3),
+                    max_wait_s=round(stats["max_wait_s"], 3),
+                )
+            return {
+                "reserve": self.reserve,
+                "max_wait_s": self.max_wait,
+                "user_rate_per_s": self.user_rate,
+                "users": len(self._users),
+                "resources": resources,
+            }
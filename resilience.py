@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+import requests
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth another try: the request timed out, was throttled or the
+# upstream failed; any other 4xx fails the same way again
+TRANSIENT_STATUSES = frozenset([408, 409, 425, 429, 500, 502, 503, 504])
+
+
+class UpstreamError(Exception):
+    # A failed call to an upstream API. `transient` errors are retried and
+    # count against the upstream's circuit breaker; `retry_after` is the
+    # wait the upstream asked for, in seconds.
+
+    def __init__(self, upstream, message, status=None, transient=False, retry_after=None, response=None):
+        super(UpstreamError, self).__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+        self.status = status
+        self.transient = transient
+        self.retry_after = retry_after
+        self.response = response
+
+
+class CircuitOpenError(UpstreamError):
+    # Raised without calling the upstream while its breaker is open
+
+    def __init__(self, upstream, retry_after):
+        super(CircuitOpenError, self).__init__(
+            upstream, f"circuit open, retrying in {retry_after:.1f}s", retry_after=retry_after)
+
+
+def parse_retry_after(headers):
+    # Retry-After as seconds, from either of its forms: a number of seconds
+    # or an HTTP date
+    value = headers.get('Retry-After') or headers.get('retry-after') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_for_status(upstream, status, headers=None, text='', transient_statuses=TRANSIENT_STATUSES):
+    # The UpstreamError for a non-2xx response, None for a 2xx one
+    if 200 <= status < 300:
+        return None
+    return UpstreamError(upstream, f"HTTP {status}: {text[:200]}", status=status,
+                         transient=status in transient_statuses, retry_after=parse_retry_after(headers))
+
+
+def classify(error):
+    # (transient, retry_after) for an exception raised by a client library
+    if isinstance(error, CircuitOpenError):
+        return False, error.retry_after
+    if isinstance(error, UpstreamError):
+        return error.transient, error.retry_after
+    # openai.APIStatusError, linebot's LineBotApiError, aiohttp's ClientResponseError
+    status = getattr(error, 'status_code', None) or getattr(error, 'status', None)
+    if isinstance(status, int):
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or getattr(error, 'headers', None)
+        # A 429 for an exhausted quota does not clear by waiting
+        transient = status in TRANSIENT_STATUSES and getattr(error, 'code', None) != 'insufficient_quota'
+        return transient, parse_retry_after(headers)
+    transient_types = (TimeoutError, ConnectionError, asyncio.TimeoutError, requests.ConnectionError,
+                       requests.Timeout, openai.APIConnectionError)
+    if aiohttp is not None:
+        transient_types += (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)
+    return isinstance(error, transient_types), None
+
+
+class CircuitBreaker(object):
+    # Opens after `failure_threshold` transient failures in a row; while open,
+    # calls fail at once with CircuitOpenError. After `reset_timeout` seconds
+    # one call is let through (half open): its success closes the breaker,
+    # its failure opens it again.
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._opens = 0
+        self._rejected = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            now = time.monotonic()
+            if self.state == 'open' and now >= self._opened_at + self.reset_timeout:
+                self.state = 'half_open'
+            # A probe that never reported back (cancelled, abandoned) expires
+            if self.state == 'half_open' and (self._probe_started is None
+                                              or now >= self._probe_started + self.reset_timeout):
+                self._probe_started = now
+                return
+            self._rejected += 1
+            raise CircuitOpenError(self.name, max(0.0, self._opened_at + self.reset_timeout - now))
+
+    def is_open(self):
+        with self._lock:
+            return self.state == 'open'
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"Circuit for {self.name} closed")
+            self.state = 'closed'
+            self._failures = 0
+            self._probe_started = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                if self.state == 'closed':
+                    logger.warning(f"Circuit for {self.name} opened after {self._failures} failures")
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+                self._opens += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self._failures,
+                "opens": self._opens,
+                "rejected": self._rejected,
+            }
+
+
+class Upstream(object):
+    # Calls to one upstream API (OpenAI, Google, LINE) go through call() or
+    # call_async(): transient errors are retried up to `max_attempts` times
+    # in all, after the upstream's Retry-After or else a full-jitter
+    # exponential backoff from `base_delay`, capped at `max_delay`. A
+    # Retry-After longer than `max_delay` is not waited out. Other errors
+    # are raised at once, and nothing is sent while the breaker is open.
+    # With a `deadline` (a time.monotonic() value), no retry is made that
+    # would start after it; `max_attempts` overrides the upstream's own for
+    # one call.
+
+    def __init__(self, name, max_attempts=3, base_delay=0.25, max_delay=8.0, failure_threshold=5,
+                 reset_timeout=30.0):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._retries = 0
+        self._transient_errors = 0
+        self._permanent_errors = 0
+
+    def _retry_delay(self, error, attempt, deadline=None, max_attempts=None):
+        # Seconds to wait before the next attempt, None to give up
+        transient, retry_after = classify(error)
+        with self._lock:
+            if transient:
+                self._transient_errors += 1
+            else:
+                self._permanent_errors += 1
+        if not transient:
+            # The upstream answered; the request itself was bad
+            if not isinstance(error, CircuitOpenError):
+                self.breaker.success()
+            return None
+        self.breaker.failure()
+        if attempt + 1 >= (max_attempts or self.max_attempts) or self.breaker.is_open():
+            return None
+        if retry_after is None:
+            retry_after = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        elif retry_after > self.max_delay:
+            return None
+        if deadline is not None and time.monotonic() + retry_after >= deadline:
+            return None
+        with self._lock:
+            self._retries += 1
+        return retry_after
+
+    def call(self, func, *args, deadline=None, max_attempts=None, **kwargs):
+        with self._lock:
+            self._calls += 1
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, max_attempts)
+                if delay is None:
+                    raise
+                logger.info(f"Retrying {self.name} in {delay:.2f}s after: {e}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    async def call_async(self, func, *args, deadline=None, max_attempts=None, **kwargs):
+        # func(*args, **kwargs) returns a coroutine
+        with self._lock:
+            self._calls += 1
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline, max_attempts)
+                if delay is None:
+                    raise
+                logger.info(f"Retrying {self.name} in {delay:.2f}s after: {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return result
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "calls": self._calls,
+                "retries": self._retries,
+                "transient_errors": self._transient_errors,
+                "permanent_errors": self._permanent_errors,
+            }
+        stats["breaker"] = self.breaker.stats()
+        return stats
@@ -0,0 +1,155 @@
+"""Local search/no-search router trained from logged GPT decisions.
+
+    python router.py train decisions.jsonl router.npz
+    python router.py predict router.npz "what's the weather today"
+
+decisions.jsonl has one {"query": ..., "search": true|false} per line, as
+written by DecisionLog when ROUTER_LOG is set.
+"""
+import json
+import math
+import sys
+import threading
+import zlib
+
+import numpy as np
+
+DEFAULT_DIMS = 1 << 16
+NGRAM_SIZES = (1, 2, 3)
+
+
+def ngram_counts(query, dims=DEFAULT_DIMS):
+    # Hashed character n-grams of the lower-cased query, padded with spaces so
+    # word starts and ends count. crc32 rather than hash(): the feature ids
+    # must be the same in every process.
+    text = ' ' + ' '.join(query.lower().split()) + ' '
+    counts = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            index = zlib.crc32(text[i:i + n].encode('utf-8')) % dims
+            counts[index] = counts.get(index, 0) + 1
+    # Length-normalized so long and short queries score on the same scale
+    norm = 1.0 / math.sqrt(len(text.encode('utf-8')))
+    return counts, norm
+
+
+def featurize(query, dims=DEFAULT_DIMS):
+    counts, norm = ngram_counts(query, dims)
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * np.float32(norm)
+    return indices, values
+
+
+class QueryRouter(object):
+    # Logistic regression over hashed character n-grams. predict() returns the
+    # decision and a confidence in [0.5, 1]; callers fall back to the LLM when
+    # the confidence is under `threshold`.
+
+    def __init__(self, weights, bias, threshold=0.9):
+        self.weights = weights
+        self.bias = float(bias)
+        self.dims = len(weights)
+        self.threshold = threshold
+        # A query touches ~100 weights; indexing a plain list beats building
+        # NumPy arrays for that few
+        self._weights = weights.tolist()
+
+    def probability(self, query):
+        counts, norm = ngram_counts(query, self.dims)
+        weights = self._weights
+        score = sum(weights[index] * count for index, count in counts.items()) * norm + self.bias
+        return 1.0 / (1.0 + math.exp(-score))
+
+    def predict(self, query):
+        p = self.probability(query)
+        return bool(p >= 0.5), float(max(p, 1.0 - p))
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=np.float32(self.bias))
+
+    @classmethod
+    def load(cls, path, threshold=0.9):
+        with np.load(path) as data:
+            return cls(data['weights'], float(data['bias']), threshold=threshold)
+
+    @classmethod
+    def train(cls, examples, dims=DEFAULT_DIMS, epochs=200, learning_rate=5.0, l2=1e-5,
+              threshold=0.9):
+        # examples: iterable of (query, search: bool). Full-batch gradient
+        # descent on a sparse design matrix kept as flat index/value arrays.
+        rows, cols, vals, labels = [], [], [], []
+        for row, (query, search) in enumerate(examples):
+            indices, values = featurize(query, dims)
+            rows.append(np.full(len(indices), row, dtype=np.int64))
+            cols.append(indices)
+            vals.append(values)
+            labels.append(1.0 if search else 0.0)
+        if not labels:
+            raise ValueError("no training examples")
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        vals = np.concatenate(vals)
+        y = np.asarray(labels, dtype=np.float32)
+        n = len(y)
+
+        weights = np.zeros(dims, dtype=np.float32)
+        bias = 0.0
+        for _ in range(epochs):
+            scores = np.bincount(rows, weights=weights[cols] * vals, minlength=n) + bias
+            p = 1.0 / (1.0 + np.exp(-scores))
+            error = (p - y).astype(np.float32)
+            grad = np.bincount(cols, weights=error[rows] * vals, minlength=dims) / n
+            weights -= learning_rate * (grad.astype(np.float32) + l2 * weights)
+            bias -= learning_rate * float(error.mean())
+        return cls(weights, bias, threshold=threshold)
+
+
+class DecisionLog(object):
+    # Appends the LLM's routing decisions as training data for the router
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, query, search):
+        line = json.dumps({"query": query, "search": bool(search)}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+def load_examples(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['query'], bool(record['search'])
+
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == 'train':
+        examples = list(load_examples(argv[2]))
+        # Hold out every fifth example to report accuracy
+        train = [e for i, e in enumerate(examples) if i % 5]
+        held_out = [e for i, e in enumerate(examples) if not i % 5]
+        router = QueryRouter.train(train or examples)
+        if held_out:
+            results = [(router.predict(q), s) for q, s in held_out]
+            accuracy = sum(d == s for (d, c), s in results) / len(results)
+            confident = [(d, s) for (d, c), s in results if c >= router.threshold]
+            print(f"held-out accuracy {accuracy:.3f} on {len(results)} examples; "
+                  f"{len(confident)} above threshold, "
+                  f"accuracy there {sum(d == s for d, s in confident) / max(1, len(confident)):.3f}")
+        QueryRouter.train(examples).save(argv[3])
+        print(f"trained on {len(examples)} examples, saved to {argv[3]}")
+    elif len(argv) == 4 and argv[1] == 'predict':
+        search, confidence = QueryRouter.load(argv[2]).predict(argv[3])
+        print(f"search={search} confidence={confidence:.3f}")
+    else:
+        print(__doc__)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
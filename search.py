@@ -1,29 +1,53 @@
+import aiohttp
 import requests
 
-# Function to search Google Custom Search
-def google_search(query, api_key, search_engine_id):
-    url = f"https://www.googleapis.com/customsearch/v1"
+from resilience import error_for_status
+
+GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+
+# Function to search Google Custom Search. Failures raise
+# resilience.UpstreamError, marked transient for throttling and server errors
+def google_search(query, api_key, search_engine_id, timeout=10):
+    url = GOOGLE_SEARCH_URL
     params = {
         "key": api_key,
         "cx": search_engine_id,
         "q": query
     }
     
-    response = requests.get(url, params=params)
+    response = requests.get(url, params=params, timeout=timeout)
     if response.status_code == 200:
         return response.json()
     else:
-        raise Exception(f"Error: {response.status_code}, {response.text}")
-    
-def should_search(query, client):
-    response = client.chat.completions.create(
-        model="gpt-4",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant. Determine whether the following question requires an online search for up-to-date information or not."},
-            {"role": "user", "content": query}
-        ]
-    )
-    
-    # Get the decision from GPT
-    decision = response.choices[0].message.content
-    return decision.lower()
\ No newline at end of file
+        raise error_for_status("google", response.status_code, response.headers, response.text)
+
+# Same as google_search, on an aiohttp ClientSession
+async def async_google_search(query, api_key, search_engine_id, session, timeout=10):
+    params = {
+        "key": api_key,
+        "cx": search_engine_id,
+        "q": query
+    }
+
+    async with session.get(GOOGLE_SEARCH_URL, params=params,
+                           timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        if response.status == 200:
+            return await response.json()
+        else:
+            raise error_for_status("google", response.status, response.headers, await response.text())
+
+def should_search_messages(query):
+    return [
+        {"role": "system", "content": "You are a helpful assistant. Determine whether the following question requires an online search for up-to-date information or not."},
+        {"role": "user", "content": query}
+    ]
+
+# Whether `query` needs an online search, as `pipeline` (a
+# pipeline.AnswerPipeline) routes it: its local router when confident, GPT on
+# the fast tier otherwise
+def should_search(query, client, pipeline):
+    return pipeline.should_search(query, client)
+
+# Same as should_search, with an AsyncOpenAI client
+async def async_should_search(query, client, pipeline):
+    return await pipeline.should_search_async(query, client)
\ No newline at end of file
@@ -0,0 +1,251 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from resilience import Upstream
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Rows scored per matrix product when searching, so a search over a large
+# index does not allocate a (queries x entries) score matrix in one go
+SEARCH_CHUNK = 32768
+
+
+def openai_embedding(get_client, model="text-embedding-3-small", dims=256, upstream=None, limiter=None,
+                     deadline=5.0):
+    # OpenAI embeddings, shortened to `dims` by the API. Calls go through
+    # `upstream`, the resilience.Upstream the completions use, and with a
+    # ratelimit.RateLimiter are charged one 'openai_requests' and the
+    # input's 'openai_tokens' like a completion. Like a completion, a call
+    # gives up after `deadline` seconds, rate-limit wait and retries
+    # included: each attempt is sent with what is left as its timeout.
+    upstream = upstream or Upstream('openai')
+
+    def create(texts, until):
+        return get_client().embeddings.create(model=model, input=texts, dimensions=dims,
+                                              timeout=max(0.01, until - time.monotonic()))
+
+    def embed(texts):
+        texts = list(texts)
+        until = time.monotonic() + deadline
+        charge = None
+        if limiter is not None:
+            tokens = sum(count_tokens(text) for text in texts)
+            charge = limiter.acquire({'openai_requests': 1, 'openai_tokens': tokens}, user_cost=tokens,
+                                     max_wait=deadline)
+        response = upstream.call(create, texts, until, deadline=until)
+        total = getattr(getattr(response, 'usage', None), 'total_tokens', None)
+        if charge is not None and total is not None:
+            limiter.settle(charge, 'openai_tokens', total)
+        return np.asarray([item.embedding for item in response.data], dtype=np.float32)
+    return embed
+
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorIndex(object):
+    # A fixed-capacity matrix of unit vectors searched by cosine similarity
+    # (a dot product), with a payload, expiry and last-use time per row.
+    # Expired rows are reused first; when none are, the least recently used
+    # row is evicted.
+    #
+    # With `path`, a saved index is memory-mapped copy-on-write: gunicorn
+    # workers forked from the preloading master share its pages until they
+    # insert. save() writes the vectors to `path` and the payloads to
+    # `path`.json, under a lock so workers saving at exit do not interleave,
+    # merged with what other workers saved before: one entry per route and
+    # question, the later expiry winning, and the entries expiring last
+    # when they do not all fit.
+
+    def __init__(self, dims, capacity, path=None):
+        self.dims = dims
+        self.capacity = capacity
+        self.path = path
+        self.size = 0
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.payloads = [None] * capacity
+        if path:
+            self.vectors = self._open_memmap(path)
+        else:
+            self.vectors = np.zeros((capacity, dims), dtype=np.float32)
+
+    def _open_memmap(self, path):
+        expected = self.capacity * self.dims * 4
+        if os.path.exists(path) and os.path.getsize(path) == expected and self._load_metadata(path + '.json'):
+            return np.memmap(path, dtype=np.float32, mode='c', shape=(self.capacity, self.dims))
+        return np.zeros((self.capacity, self.dims), dtype=np.float32)
+
+    def _load_metadata(self, meta_path):
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('dims') != self.dims or meta.get('capacity') != self.capacity:
+            logger.warning("Semantic cache file has a different shape, starting empty")
+            return False
+        self.size = meta['size']
+        for slot, expires_at, payload in meta['entries']:
+            self.expires_at[slot] = expires_at
+            self.payloads[slot] = payload
+        return True
+
+    def _live_entries(self, now):
+        # [(vector, expires_at, payload)] for the live rows
+        return [(self.vectors[slot], float(self.expires_at[slot]), self.payloads[slot])
+                for slot in range(self.size) if self.expires_at[slot] > now]
+
+    def _saved_entries(self, now):
+        # Live entries of the saved index, as _live_entries(); caller holds
+        # the file lock
+        saved = VectorIndex(self.dims, self.capacity)
+        if not (os.path.exists(self.path) and os.path.getsize(self.path) == self.capacity * self.dims * 4
+                and saved._load_metadata(self.path + '.json')):
+            return []
+        saved.vectors = np.memmap(self.path, dtype=np.float32, mode='r', shape=(self.capacity, self.dims))
+        return saved._live_entries(now)
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.time()
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = {}
+            for vector, expires_at, payload in self._saved_entries(now) + self._live_entries(now):
+                route, answer, query = payload
+                key = (route, query if query is not None else answer)
+                if key not in merged or merged[key][1] < expires_at:
+                    merged[key] = (vector, expires_at, payload)
+            kept = sorted(merged.values(), key=lambda entry: entry[1], reverse=True)[:self.capacity]
+
+            vectors = np.zeros((self.capacity, self.dims), dtype=np.float32)
+            entries = []
+            for slot, (vector, expires_at, payload) in enumerate(kept):
+                vectors[slot] = vector
+                entries.append([slot, expires_at, payload])
+            vectors.tofile(tmp)
+            os.replace(tmp, self.path)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({"dims": self.dims, "capacity": self.capacity, "size": len(kept),
+                           "entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp, self.path + '.json')
+
+    def live_count(self, now):
+        return int(np.count_nonzero(self.expires_at[:self.size] > now))
+
+    def search(self, queries, now):
+        # queries: (n, dims) unit vectors. Returns the best row and its score
+        # for each query; row -1 when the index has no live entry.
+        best_rows = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.full(len(queries), -np.inf, dtype=np.float32)
+        for start in range(0, self.size, SEARCH_CHUNK):
+            stop = min(start + SEARCH_CHUNK, self.size)
+            scores = queries @ self.vectors[start:stop].T
+            scores[:, self.expires_at[start:stop] <= now] = -np.inf
+            rows = np.argmax(scores, axis=1)
+            top = scores[np.arange(len(queries)), rows]
+            better = top > best_scores
+            best_rows[better] = rows[better] + start
+            best_scores[better] = top[better]
+        return best_rows, best_scores
+
+    def touch(self, row, now):
+        self.last_used[row] = now
+
+    def insert(self, vector, payload, expires_at, now):
+        # Returns True when a live entry had to be evicted
+        evicted = False
+        if self.size < self.capacity:
+            slot = self.size
+            self.size += 1
+        else:
+            expired = self.expires_at <= now
+            if expired.any():
+                slot = int(np.argmax(expired))
+            else:
+                slot = int(np.argmin(self.last_used))
+                evicted = True
+        self.vectors[slot] = vector
+        self.expires_at[slot] = expires_at
+        self.last_used[slot] = now
+        self.payloads[slot] = payload
+        return evicted
+
+
+class SemanticCache(object):
+    # Answers looked up by meaning rather than exact wording: the question is
+    # embedded and matched against earlier questions; an answer whose
+    # question scores at least `threshold` (cosine) is returned. Routes and
+    # their TTLs work as in AnswerCache.
+
+    def __init__(self, embed, dims, capacity=100000, threshold=0.92,
+                 search_ttl=600, direct_ttl=86400, path=None):
+        self.embed = embed
+        self.threshold = threshold
+        self.ttls = {'search': search_ttl, 'direct': direct_ttl}
+        self.index = VectorIndex(dims, capacity, path)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def lookup_many(self, queries):
+        # Batched lookup: one embedding call and one pass over the index.
+        # Returns [(answer or None, vector)] in query order.
+        vectors = _normalize_rows(np.asarray(self.embed(queries), dtype=np.float32))
+        now = time.time()
+        with self._lock:
+            rows, scores = self.index.search(vectors, now)
+            results = []
+            for row, score, vector in zip(rows, scores, vectors):
+                if row >= 0 and score >= self.threshold:
+                    self.index.touch(row, now)
+                    self._hits += 1
+                    results.append((self.index.payloads[row][1], vector))
+                else:
+                    self._misses += 1
+                    results.append((None, vector))
+            return results
+
+    def lookup(self, query):
+        # The vector is handed back so a miss can be inserted without
+        # embedding the question twice
+        return self.lookup_many([query])[0]
+
+    def insert(self, vector, route, answer, query=None):
+        if not answer:
+            return
+        now = time.time()
+        with self._lock:
+            if self.index.insert(vector, [route, answer, query], now + self.ttls[route], now):
+                self._evictions += 1
+
+    def save(self):
+        with self._lock:
+            self.index.save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": self.index.live_count(time.time()),
+                "capacity": self.index.capacity,
+                "threshold": self.threshold,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 3) if lookups else 0.0,
+                "evictions": self._evictions,
+            }
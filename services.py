@@ -0,0 +1,231 @@
+import os
+
+from answer_cache import AnswerCache
+from clients import ClientRegistry
+from conversation import ConversationStore, gpt_summarizer
+from dedup import DedupCache
+from delivery import ReplyDeadlines
+from models import ModelPolicy, ModelTier
+from pipeline import AnswerPipeline
+from prompts import PromptBuilder
+from ratelimit import RateLimiter
+from resilience import Upstream
+from router import QueryRouter, DecisionLog
+from semantic_cache import SemanticCache, openai_embedding
+from singleflight import SingleFlight
+
+
+class Services(object):
+    # Configuration, read from os.environ, and the components built from it
+    # that app.py (Flask, threads) and async_app.py (aiohttp) share. The apps
+    # only add what differs between them: the LINE client, the event queue
+    # and admission control. The few defaults that differ are arguments.
+
+    def __init__(self, openai_max_connections=100, openai_max_keepalive=20):
+        # Share of webhook bodies that get logged, and how much of each
+        self.body_log_sample_rate = float(os.environ.get('BODY_LOG_SAMPLE_RATE', 0.01))
+        self.body_log_max_bytes = int(os.environ.get('BODY_LOG_MAX_BYTES', 2048))
+
+        self.channel_access_token = os.environ['CHANNEL_ACCESS_TOKEN']
+        self.channel_secret = os.environ['CHANNEL_SECRET']
+        # LAZY_EVENTS=1 builds event fields on access and skips event types
+        # without a handler
+        self.lazy_events = os.environ.get('LAZY_EVENTS') == '1'
+        # Host used to build public image URLs; the callback's host otherwise
+        self.public_host = os.environ.get('PUBLIC_HOST')
+        self.busy_message = os.environ.get(
+            'BUSY_MESSAGE', "I'm getting a lot of messages right now, please try again in a minute.")
+
+        # Calls to OpenAI, Google and LINE are retried on throttling, server
+        # and connection errors, UPSTREAM_MAX_ATTEMPTS tries in all, after the
+        # upstream's Retry-After or a jittered backoff. After
+        # UPSTREAM_FAILURE_THRESHOLD such failures in a row an upstream's
+        # calls fail at once for UPSTREAM_RESET_TIMEOUT seconds.
+        self.upstreams = {
+            name: Upstream(
+                name,
+                max_attempts=int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', 3)),
+                max_delay=float(os.environ.get('UPSTREAM_MAX_DELAY', 8)),
+                failure_threshold=int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', 5)),
+                reset_timeout=float(os.environ.get('UPSTREAM_RESET_TIMEOUT', 30)),
+            )
+            for name in ('openai', 'google', 'line')
+        }
+
+        # One pooled OpenAI client per worker process, so answers reuse
+        # kept-alive connections instead of a fresh TLS handshake per message
+        self.clients = ClientRegistry(
+            os.environ['OPENAI_API_KEY'],
+            max_connections=int(os.environ.get('OPENAI_MAX_CONNECTIONS', openai_max_connections)),
+            max_keepalive=int(os.environ.get('OPENAI_MAX_KEEPALIVE', openai_max_keepalive)),
+            keepalive_expiry=float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60)),
+            timeout=float(os.environ.get('OPENAI_TIMEOUT', 60)),
+            connect_timeout=float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 5)),
+            # Retries happen in upstreams['openai']
+            max_retries=int(os.environ.get('OPENAI_MAX_RETRIES', 0)),
+        )
+
+        # Answers are cached on the normalized question;
+        # ANSWER_CACHE_MAX_BYTES=0 turns the cache off
+        answer_cache_max_bytes = int(os.environ.get('ANSWER_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+        self.answer_cache = AnswerCache(
+            max_bytes=answer_cache_max_bytes,
+            search_ttl=int(os.environ.get('ANSWER_CACHE_SEARCH_TTL', 600)),
+            direct_ttl=int(os.environ.get('ANSWER_CACHE_DIRECT_TTL', 86400)),
+        ) if answer_cache_max_bytes > 0 else None
+
+        # Local rate limits, each off unless set: OPENAI_RPM / OPENAI_TPM
+        # requests and tokens a minute (bursting up to
+        # RATE_LIMIT_BURST_SECONDS worth), GOOGLE_DAILY_QUOTA searches a day
+        # (the whole quota may go at once, it refills over the day) and
+        # USER_TOKENS_PER_MINUTE for each user. Calls over a limit wait their turn, up to RATE_LIMIT_MAX_WAIT
+        # seconds; RATE_LIMIT_RESERVE of every limit is kept for users who
+        # have not been asking much lately.
+        burst_seconds = float(os.environ.get('RATE_LIMIT_BURST_SECONDS', 10))
+        rate_limits = {}
+        if os.environ.get('OPENAI_RPM'):
+            rate = float(os.environ['OPENAI_RPM']) / 60
+            rate_limits['openai_requests'] = (rate, rate * burst_seconds)
+        if os.environ.get('OPENAI_TPM'):
+            rate = float(os.environ['OPENAI_TPM']) / 60
+            rate_limits['openai_tokens'] = (rate, rate * burst_seconds)
+        if os.environ.get('GOOGLE_DAILY_QUOTA'):
+            quota = float(os.environ['GOOGLE_DAILY_QUOTA'])
+            rate_limits['google'] = (quota / 86400, quota)
+        user_tokens_per_minute = os.environ.get('USER_TOKENS_PER_MINUTE')
+        self.limiter = RateLimiter(
+            rate_limits,
+            user_rate=float(user_tokens_per_minute) / 60 if user_tokens_per_minute else None,
+            reserve=float(os.environ.get('RATE_LIMIT_RESERVE', 0.1)),
+            max_wait=float(os.environ.get('RATE_LIMIT_MAX_WAIT', 20)),
+        ) if rate_limits or user_tokens_per_minute else None
+
+        # Model tiers: MODEL_FAST routes and answers short questions,
+        # MODEL_LARGE summarizes search results and answers longer ones. With
+        # MODEL_LATENCY_SLO (seconds) set, large-tier requests fall back to
+        # the fast tier while the large tier's p95 latency is over it.
+        # Completions give up after MODEL_ROUTE_DEADLINE /
+        # MODEL_ANSWER_DEADLINE seconds; MODEL_HEDGE=1 also sends a request
+        # still running past its tier's p95 to the fast tier, and the first
+        # answer wins. Hedged requests run on MODEL_HEDGE_WORKERS threads a
+        # process; size it to the requests a process has in flight at once.
+        self.models = ModelPolicy(
+            fast=ModelTier('fast', os.environ.get('MODEL_FAST', 'gpt-4o-mini')),
+            large=ModelTier('large', os.environ.get('MODEL_LARGE', 'gpt-4')),
+            short_query_tokens=int(os.environ.get('MODEL_SHORT_QUERY_TOKENS', 60)),
+            latency_slo=float(os.environ['MODEL_LATENCY_SLO']) if os.environ.get('MODEL_LATENCY_SLO') else None,
+            route_deadline=float(os.environ.get('MODEL_ROUTE_DEADLINE', 5)),
+            answer_deadline=float(os.environ.get('MODEL_ANSWER_DEADLINE', 30)),
+            hedge=os.environ.get('MODEL_HEDGE') == '1',
+            hedge_workers=int(os.environ.get('MODEL_HEDGE_WORKERS', 32)),
+            upstream=self.upstreams['openai'],
+            limiter=self.limiter,
+        )
+
+        # Semantic cache for reworded questions (SEMANTIC_CACHE=openai),
+        # embedded with the embeddings API through the same upstream and
+        # rate limits as completions, and given up on after
+        # MODEL_ROUTE_DEADLINE like a routing call. Saved to
+        # SEMANTIC_CACHE_PATH on shutdown when set, merged with the other
+        # workers' saves.
+        semantic_cache_dims = int(os.environ.get('SEMANTIC_CACHE_DIMS', 256))
+        self.semantic_cache = SemanticCache(
+            openai_embedding(self.clients.openai, dims=semantic_cache_dims, upstream=self.models.upstream,
+                             limiter=self.limiter, deadline=self.models.route_deadline),
+            semantic_cache_dims,
+            capacity=int(os.environ.get('SEMANTIC_CACHE_CAPACITY', 100000)),
+            threshold=float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92)),
+            search_ttl=int(os.environ.get('ANSWER_CACHE_SEARCH_TTL', 600)),
+            direct_ttl=int(os.environ.get('ANSWER_CACHE_DIRECT_TTL', 86400)),
+            path=os.environ.get('SEMANTIC_CACHE_PATH'),
+        ) if os.environ.get('SEMANTIC_CACHE') == 'openai' else None
+
+        # Search/no-search routing: a local model trained on logged GPT
+        # decisions (ROUTER_MODEL) answers when confident, GPT decides
+        # otherwise. ROUTER_LOG collects GPT's decisions as training data.
+        # SPECULATIVE=1 runs GPT routing, the direct answer and the Google
+        # search in parallel when the router is unsure, on SPECULATIVE_WORKERS
+        # threads a process: by default three for each thread that may be
+        # handling a question. PIPELINE_MODE=tools instead sends the question
+        # once with a web_search tool.
+        handler_threads = max(int(os.environ.get('GUNICORN_THREADS', 8)),
+                              int(os.environ.get('EVENT_WORKERS', 4)),
+                              int(os.environ.get('WEBHOOK_CONCURRENCY', 1)))
+        self.pipeline = AnswerPipeline(
+            os.environ['GOOGLE_API_KEY'],
+            os.environ['SEARCH_ENGINE_ID'],
+            router=(QueryRouter.load(os.environ['ROUTER_MODEL'],
+                                     threshold=float(os.environ.get('ROUTER_THRESHOLD', 0.9)))
+                    if os.environ.get('ROUTER_MODEL') else None),
+            decision_log=DecisionLog(os.environ['ROUTER_LOG']) if os.environ.get('ROUTER_LOG') else None,
+            speculative=os.environ.get('SPECULATIVE') == '1',
+            speculative_workers=int(os.environ.get('SPECULATIVE_WORKERS', 3 * handler_threads)),
+            tool_calling=os.environ.get('PIPELINE_MODE') == 'tools',
+            cache=self.answer_cache,
+            semantic_cache=self.semantic_cache,
+            # Prompt size cap; Google results are cut or dropped to fit
+            prompts=PromptBuilder(
+                budget=int(os.environ.get('PROMPT_BUDGET_TOKENS', 3000)),
+                max_query_tokens=int(os.environ.get('MAX_QUERY_TOKENS', 500)),
+            ),
+            models=self.models,
+            google=self.upstreams['google'],
+            limiter=self.limiter,
+            # Concurrent identical questions wait for one answer, at most
+            # SINGLEFLIGHT_MAX_WAIT seconds before asking on their own
+            singleflight=SingleFlight(max_wait=float(os.environ.get('SINGLEFLIGHT_MAX_WAIT', 30))),
+        )
+
+        # Per-user conversation memory (MEMORY=1): earlier turns go into each
+        # prompt, kept under MEMORY_BUDGET_TOKENS with a rolling summary of
+        # older turns, written by a background thread with the blocking
+        # client. MEMORY_DB shares it between worker processes.
+        self.conversations = ConversationStore(
+            summarize=gpt_summarizer(self.clients.openai, self.models),
+            budget=int(os.environ.get('MEMORY_BUDGET_TOKENS', 1500)),
+            summary_budget=int(os.environ.get('MEMORY_SUMMARY_TOKENS', 300)),
+            max_users=int(os.environ.get('MEMORY_MAX_USERS', 10000)),
+            ttl=int(os.environ.get('MEMORY_TTL', 86400)),
+            db_path=os.environ.get('MEMORY_DB'),
+        ) if os.environ.get('MEMORY') == '1' else None
+
+        # STREAMING=1 streams the final completion: the first sentence goes
+        # out through the reply token, the rest is pushed in chunks as it
+        # arrives
+        self.streaming = os.environ.get('STREAMING') == '1'
+        self.stream_first_chars = int(os.environ.get('STREAM_FIRST_CHARS', 20))
+        self.stream_chunk_chars = int(os.environ.get('STREAM_CHUNK_CHARS', 1000))
+
+        # Answers go out through the reply token while it has more than
+        # REPLY_MARGIN of its REPLY_TOKEN_TTL seconds left, by push after.
+        # With REPLY_ACK_TEXT set, that text is replied before the token runs
+        # out (at once when answers of the kind usually take too long) and
+        # the answer is pushed.
+        self.deadlines = ReplyDeadlines(
+            token_ttl=float(os.environ.get('REPLY_TOKEN_TTL', 60)),
+            margin=float(os.environ.get('REPLY_MARGIN', 5)),
+            ack_text=os.environ.get('REPLY_ACK_TEXT') or None,
+        )
+
+        # Drops LINE redeliveries of events that were already handled. Set
+        # DEDUP_DB to a SQLite file to share the dedup state across processes
+        # and restarts.
+        self.dedup = DedupCache(
+            ttl=int(os.environ.get('DEDUP_TTL', 600)),
+            max_entries=int(os.environ.get('DEDUP_MAX_ENTRIES', 10000)),
+            db_path=os.environ.get('DEDUP_DB'),
+        )
+
+    def stats(self):
+        # The /metrics entries both apps report
+        return {
+            "dedup": self.dedup.stats(),
+            "pipeline": self.pipeline.stats(),
+            "answer_cache": self.answer_cache.stats() if self.answer_cache is not None else None,
+            "semantic_cache": self.semantic_cache.stats() if self.semantic_cache is not None else None,
+            "conversations": self.conversations.stats() if self.conversations is not None else None,
+            "openai_clients": self.clients.stats(),
+            "upstreams": {name: upstream.stats() for name, upstream in self.upstreams.items()},
+            "reply_deadlines": self.deadlines.stats(),
+            "rate_limits": self.limiter.stats() if self.limiter is not None else None,
+        }
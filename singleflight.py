@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self, done):
+        self.done = done
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+    # Coalesces concurrent calls with the same key: the first caller (the
+    # leader) runs the function, callers arriving while it runs wait for its
+    # result instead of starting their own. A follower waits at most
+    # `max_wait` seconds, then runs the function itself. The leader's
+    # exception is raised in its followers too.
+    #
+    # Blocking callers use do(), coroutines do_async(); the two do not share
+    # flights.
+
+    def __init__(self, max_wait=30.0):
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self._leaders = 0
+        self._coalesced = 0
+        self._follower_timeouts = 0
+
+    def _join(self, calls, key, new_done):
+        with self._lock:
+            call = calls.get(key)
+            if call is None:
+                call = calls[key] = _Call(new_done())
+                self._leaders += 1
+                return call, True
+            call.followers += 1
+            self._coalesced += 1
+            return call, False
+
+    def _finish(self, calls, key):
+        with self._lock:
+            del calls[key]
+
+    def _timed_out(self):
+        with self._lock:
+            self._follower_timeouts += 1
+
+    def do(self, key, func, *args):
+        call, leader = self._join(self._calls, key, threading.Event)
+        if leader:
+            try:
+                call.result = func(*args)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(self._calls, key)
+                call.done.set()
+
+        if not call.done.wait(self.max_wait):
+            self._timed_out()
+            return func(*args)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key, func, *args):
+        # func(*args) returns a coroutine
+        loop = asyncio.get_running_loop()
+        call, leader = self._join(self._async_calls, key, loop.create_future)
+        if leader:
+            try:
+                call.result = await func(*args)
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(self._async_calls, key)
+                call.done.set_result(None)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(call.done), self.max_wait)
+        except asyncio.TimeoutError:
+            self._timed_out()
+            return await func(*args)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._async_calls),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "follower_timeouts": self._follower_timeouts,
+                "max_wait_s": self.max_wait,
+            }
@@ -0,0 +1,109 @@
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# LINE rejects text messages over 5000 characters
+LINE_TEXT_LIMIT = 5000
+
+# End of a sentence: Western punctuation (plus closing quotes/brackets)
+# followed by whitespace, CJK full stops on their own, or a line break
+SENTENCE_END = re.compile(r'[.!?…]+["\'”’)\]」』]*\s+|[。！？]+[」』）]*|\n+')
+
+
+class SentenceChunker(object):
+    # Cuts a stream of text deltas into messages at sentence boundaries. The
+    # first message goes out at the first boundary after `first_chars`, so
+    # the user sees text early; later ones collect at least `chunk_chars`
+    # (each push counts against the channel's message quota). No message is
+    # longer than `max_chars`; a sentence that long is cut at a space.
+
+    def __init__(self, first_chars=20, chunk_chars=1000, max_chars=LINE_TEXT_LIMIT):
+        self.first_chars = first_chars
+        self.chunk_chars = chunk_chars
+        self.max_chars = max_chars
+        self.chunks = 0
+        self._buffer = ''
+
+    def _cut(self, target):
+        # Index to cut the buffer at, or None to wait for more text
+        window = self._buffer[:self.max_chars]
+        for match in SENTENCE_END.finditer(window):
+            if match.end() >= target:
+                return match.end()
+        if len(self._buffer) < self.max_chars:
+            return None
+        space = window.rfind(' ', self.max_chars // 2)
+        return space + 1 if space > 0 else self.max_chars
+
+    def _take(self, cut):
+        chunk, self._buffer = self._buffer[:cut].strip(), self._buffer[cut:]
+        if not chunk:
+            return []
+        self.chunks += 1
+        return [chunk]
+
+    def feed(self, delta):
+        # Returns the messages completed by this delta
+        self._buffer += delta
+        ready = []
+        while True:
+            cut = self._cut(self.first_chars if self.chunks == 0 else self.chunk_chars)
+            if cut is None:
+                return ready
+            ready.extend(self._take(cut))
+
+    def flush(self):
+        # The rest of the text once the stream has ended
+        ready = []
+        while len(self._buffer) > self.max_chars:
+            ready.extend(self._take(self._cut(self.chunk_chars)))
+        ready.extend(self._take(len(self._buffer)))
+        return ready
+
+
+def _log_delivery(start, first_at, chunker):
+    logger.info("Streamed answer", extra={
+        "first_message_s": round(first_at - start, 3) if first_at else None,
+        "total_s": round(time.perf_counter() - start, 3),
+        "messages": chunker.chunks,
+    })
+
+
+def deliver(deltas, send, chunker=None):
+    # Sends each finished message as the deltas arrive; send(text, first)
+    # should use the reply token for the first message and push the rest.
+    # Returns the whole text.
+    chunker = chunker or SentenceChunker()
+    start = time.perf_counter()
+    first_at = None
+    parts = []
+    for delta in deltas:
+        parts.append(delta)
+        for text in chunker.feed(delta):
+            send(text, first_at is None)
+            first_at = first_at or time.perf_counter()
+    for text in chunker.flush():
+        send(text, first_at is None)
+        first_at = first_at or time.perf_counter()
+    _log_delivery(start, first_at, chunker)
+    return ''.join(parts)
+
+
+async def deliver_async(deltas, send, chunker=None):
+    # Same as deliver(), for an async iterator of deltas and an async send
+    chunker = chunker or SentenceChunker()
+    start = time.perf_counter()
+    first_at = None
+    parts = []
+    async for delta in deltas:
+        parts.append(delta)
+        for text in chunker.feed(delta):
+            await send(text, first_at is None)
+            first_at = first_at or time.perf_counter()
+    for text in chunker.flush():
+        await send(text, first_at is None)
+        first_at = first_at or time.perf_counter()
+    _log_delivery(start, first_at, chunker)
+    return ''.join(parts)
@@ -0,0 +1,83 @@
+from admission import AdmissionController
+from dedup import DedupCache
+
+
+class Event(object):
+    def __init__(self, event_id, kind='text'):
+        self.webhook_event_id = event_id
+        self.kind = kind
+
+
+def handlers(admission):
+    busy = []
+
+    @admission.admit(busy.append)
+    def handle_text(event):
+        pass
+
+    def handle_follow(event):
+        pass
+
+    def find_handler(event):
+        return handle_text if event.kind == 'text' else handle_follow
+    return find_handler, busy
+
+
+def test_events_over_max_in_flight_are_shed():
+    admission = AdmissionController(max_in_flight=2)
+    find_handler, busy = handlers(admission)
+    events = [Event(i) for i in range(3)]
+    admitted, shed = admission.admit_events(events, find_handler)
+    assert admitted == events[:2]
+    assert [event for event, _ in shed] == events[2:]
+    shed[0][1](shed[0][0])
+    assert busy == events[2:]
+    assert admission.stats()['in_flight'] == 2
+    assert admission.stats()['shed'] == 1
+
+
+def test_done_frees_the_slot():
+    admission = AdmissionController(max_in_flight=1)
+    find_handler, _ = handlers(admission)
+    first, second = Event(1), Event(2)
+    admission.admit_events([first], find_handler)
+    assert admission.admit_events([second], find_handler)[0] == []
+    admission.done(first)
+    assert admission.admit_events([second], find_handler)[0] == [second]
+    # Done for an event without a slot changes nothing
+    admission.done(Event(3))
+    assert admission.stats()['in_flight'] == 1
+
+
+def test_ungated_handlers_take_no_slot():
+    admission = AdmissionController(max_in_flight=0)
+    find_handler, _ = handlers(admission)
+    follow = Event(1, kind='follow')
+    assert admission.admit_events([follow], find_handler) == ([follow], [])
+    assert admission.stats()['in_flight'] == 0
+
+
+def test_deep_queue_sheds():
+    depth = [5]
+    admission = AdmissionController(max_in_flight=10, max_queue_depth=5, queue_depth=lambda: depth[0])
+    find_handler, _ = handlers(admission)
+    assert admission.admit_events([Event(1)], find_handler)[0] == []
+    depth[0] = 4
+    assert len(admission.admit_events([Event(1)], find_handler)[0]) == 1
+
+
+def test_redelivery_is_left_to_dedup():
+    dedup = DedupCache()
+    admission = AdmissionController(max_in_flight=1)
+    find_handler, _ = handlers(admission)
+    event = Event('ev1')
+    admission.admit_events([event], find_handler, dedup.is_duplicate)
+    # The handler's dedup takes the event while it is still being handled
+    assert not dedup.seen('ev1')
+    redelivery = Event('ev1')
+    admitted, shed = admission.admit_events([redelivery], find_handler, dedup.is_duplicate)
+    assert admitted == [redelivery]
+    assert shed == []
+    assert admission.stats()['in_flight'] == 1
+    # Peeking does not claim the event
+    assert dedup.stats()['duplicates'] == 0
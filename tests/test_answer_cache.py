@@ -0,0 +1,98 @@
+from types import SimpleNamespace as NS
+
+import answer_cache
+from answer_cache import ENTRY_OVERHEAD, AnswerCache, normalize_query
+from pipeline import AnswerPipeline
+
+
+def test_normalize_query_folds_width_case_space_and_punctuation():
+    assert normalize_query("天氣？") == normalize_query(" 天氣 ") == "天氣"
+    assert normalize_query("ＷＥＡＴＨＥＲ ｉｎ Taipei!") == "weatherintaipei"
+    assert normalize_query("?? !") == ""
+
+
+def test_get_matches_normalized_queries():
+    cache = AnswerCache()
+    cache.put("What's the weather?", 'search', "Sunny")
+    assert cache.get("whats the WEATHER") == "Sunny"
+    assert cache.get("something else") is None
+    stats = cache.stats()
+    assert stats['hits'] == {'search': 1, 'direct': 0}
+    assert stats['misses'] == 1
+
+
+def test_search_answer_wins_over_direct():
+    cache = AnswerCache()
+    cache.put("news", 'direct', "From memory")
+    cache.put("news", 'search', "From the web")
+    assert cache.get("news") == "From the web"
+
+
+def test_routes_expire_on_their_own_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(answer_cache.time, 'monotonic', lambda: now[0])
+    cache = AnswerCache(search_ttl=10, direct_ttl=100)
+    cache.put("news", 'search', "From the web")
+    cache.put("news", 'direct', "From memory")
+    now[0] += 11
+    assert cache.get("news") == "From memory"
+    now[0] += 90
+    assert cache.get("news") is None
+    assert cache.stats()['expired'] == 2
+    assert cache.stats()['entries'] == 0
+
+
+def test_least_recently_used_is_evicted_by_bytes():
+    size = len("q1") + len("a1") + ENTRY_OVERHEAD
+    cache = AnswerCache(max_bytes=2 * size)
+    cache.put("q1", 'direct', "a1")
+    cache.put("q2", 'direct', "a2")
+    cache.get("q1")
+    cache.put("q3", 'direct', "a3")
+    assert cache.get("q2") is None
+    assert cache.get("q1") == "a1"
+    assert cache.get("q3") == "a3"
+    assert cache.stats()['bytes'] == 2 * size
+    assert cache.stats()['evictions'] == 1
+
+
+def test_empty_and_oversized_answers_are_not_cached():
+    cache = AnswerCache(max_bytes=ENTRY_OVERHEAD + 10)
+    cache.put("q", 'direct', "")
+    cache.put("?!", 'direct', "answer")
+    cache.put("q", 'direct', "x" * 100)
+    assert cache.stats()['entries'] == 0
+
+
+class DirectClient(object):
+    # Routes every question to a direct answer
+    def __init__(self):
+        self.chat = self.completions = self
+        self.calls = 0
+
+    def create(self, model, messages, timeout=None, **kwargs):
+        self.calls += 1
+        content = 'no' if 'online search' in messages[0]['content'] else f"answer {self.calls}"
+        return NS(choices=[NS(message=NS(content=content, tool_calls=None))], usage=None)
+
+
+def test_pipeline_answers_repeats_from_the_cache():
+    pipeline = AnswerPipeline('key', 'engine', cache=AnswerCache())
+    client = DirectClient()
+    first = pipeline.answer("Tell me a joke", client)
+    calls = client.calls
+    assert pipeline.answer("tell me a joke!", client) == first
+    assert client.calls == calls
+    assert pipeline.cache.stats()['hits']['direct'] == 1
+
+
+def test_pipeline_does_not_cache_follow_ups():
+    pipeline = AnswerPipeline('key', 'engine', cache=AnswerCache())
+    client = DirectClient()
+    history = [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]
+    pipeline.answer("tell me another", client, history)
+    assert pipeline.cache.stats()['entries'] == 0
+    pipeline.answer("tell me another", client)
+    calls = client.calls
+    pipeline.answer("tell me another", client, history)
+    assert client.calls > calls
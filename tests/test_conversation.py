@@ -0,0 +1,110 @@
+import pytest
+
+import conversation as conversation_module
+from conversation import ConversationStore
+from tokens import MESSAGE_OVERHEAD, count_tokens
+
+
+def turn_tokens(content):
+    return count_tokens(content) + MESSAGE_OVERHEAD
+
+
+def settle(store):
+    # The summarizer has one thread, so this runs after every queued fold
+    store._get_executor().submit(lambda: None).result(timeout=5)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def db_path(request, tmp_path):
+    return str(tmp_path / 'conversations.db') if request.param == 'sqlite' else None
+
+
+def test_history_replays_recorded_turns(db_path):
+    store = ConversationStore(db_path=db_path)
+    assert store.history('u1') == []
+    store.record('u1', "hello", "hi there")
+    assert store.history('u1') == [{'role': 'user', 'content': "hello"},
+                                   {'role': 'assistant', 'content': "hi there"}]
+    assert store.history('u2') == []
+
+
+def test_no_user_id_has_no_memory(db_path):
+    store = ConversationStore(db_path=db_path)
+    store.record(None, "hello", "hi")
+    assert store.history(None) == []
+
+
+def test_oldest_turns_drop_out_of_the_budget(db_path):
+    store = ConversationStore(budget=4 * turn_tokens("q0"), db_path=db_path)
+    for i in range(4):
+        store.record('u1', f"q{i}", f"a{i}")
+    assert [message['content'] for message in store.history('u1')] == ["q2", "a2", "q3", "a3"]
+    assert store.stats()['dropped_turns'] == 4
+
+
+def test_dropped_turns_are_folded_into_the_summary(db_path):
+    folded = []
+
+    def summarize(summary, turns):
+        folded.append([content for role, content, tokens in turns])
+        return (summary + ' ' if summary else '') + ' '.join(content for role, content, tokens in turns)
+
+    # Room for the summary and one exchange
+    budget = count_tokens("q0 a0") + 2 * turn_tokens("q1")
+    store = ConversationStore(summarize=summarize, budget=budget, db_path=db_path)
+    store.record('u1', "q0", "a0")
+    store.record('u1', "q1", "a1")
+    settle(store)
+    assert folded == [["q0", "a0"]]
+    history = store.history('u1')
+    assert history[0] == {'role': 'system', 'content': "Summary of the conversation so far: q0 a0"}
+    assert [message['content'] for message in history[1:]] == ["q1", "a1"]
+    assert store.stats()['summaries'] == 1
+
+
+def test_failed_summaries_keep_the_turns_pending(db_path):
+    calls = []
+
+    def summarize(summary, turns):
+        calls.append(len(turns))
+        if len(calls) == 1:
+            raise RuntimeError("model down")
+        return "earlier chat"
+
+    budget = 2 * turn_tokens("q0") + count_tokens("earlier chat")
+    store = ConversationStore(summarize=summarize, budget=budget, db_path=db_path)
+    store.record('u1', "q0", "a0")
+    store.record('u1', "q1", "a1")
+    settle(store)
+    assert store.stats()['summary_failures'] == 1
+    store.record('u1', "q2", "a2")
+    settle(store)
+    # The second attempt covers the turns the first one failed on
+    assert calls == [2, 4]
+    assert store.history('u1')[0]['content'].endswith("earlier chat")
+
+
+def test_idle_conversations_start_over(db_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(conversation_module.time, 'time', lambda: now[0])
+    store = ConversationStore(ttl=60, db_path=db_path)
+    store.record('u1', "hello", "hi")
+    now[0] += 61
+    assert store.history('u1') == []
+    store.record('u1', "again", "hi again")
+    assert [message['content'] for message in store.history('u1')] == ["again", "hi again"]
+
+
+def test_memory_store_keeps_the_most_recent_users():
+    store = ConversationStore(max_users=2)
+    for user_id in ('u1', 'u2', 'u3'):
+        store.record(user_id, "hello", "hi")
+    assert store.history('u1') == []
+    assert store.history('u3') != []
+    assert store.stats()['users'] == 2
+
+
+def test_sqlite_store_is_shared(tmp_path):
+    db_path = str(tmp_path / 'conversations.db')
+    ConversationStore(db_path=db_path).record('u1', "hello", "hi")
+    assert len(ConversationStore(db_path=db_path).history('u1')) == 2
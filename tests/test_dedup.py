@@ -0,0 +1,105 @@
+import asyncio
+from types import SimpleNamespace as NS
+
+import pytest
+
+import dedup
+from dedup import DedupCache, event_dedup_key
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    db_path = str(tmp_path / 'dedup.db') if request.param == 'sqlite' else None
+    return DedupCache(ttl=60, db_path=db_path)
+
+
+def test_event_dedup_key_prefers_webhook_event_id():
+    assert event_dedup_key(NS(webhook_event_id='w1', message=NS(id='m1'), reply_token='r1')) == 'w1'
+    assert event_dedup_key(NS(webhook_event_id=None, message=NS(id='m1'), reply_token='r1')) == 'message:m1'
+    assert event_dedup_key(NS(reply_token='r1')) == 'reply:r1'
+    assert event_dedup_key(NS()) is None
+
+
+def test_seen_records_the_key(cache):
+    assert not cache.seen('a')
+    assert cache.seen('a')
+    assert not cache.seen('b')
+    stats = cache.stats()
+    assert (stats['accepted'], stats['duplicates']) == (2, 1)
+
+
+def test_peek_does_not_record(cache):
+    assert not cache.peek('a')
+    assert not cache.is_duplicate(NS(webhook_event_id='a'))
+    assert not cache.seen('a')
+    assert cache.peek('a')
+    assert cache.is_duplicate(NS(webhook_event_id='a'))
+    assert not cache.is_duplicate(NS())
+
+
+def test_forget_lets_the_key_through_again(cache):
+    cache.seen('a')
+    cache.forget('a')
+    assert not cache.peek('a')
+    assert not cache.seen('a')
+
+
+def test_entries_expire_after_ttl(cache, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup.time, 'time', lambda: now[0])
+    cache.seen('a')
+    now[0] += 61
+    assert not cache.peek('a')
+    assert not cache.seen('a')
+
+
+def test_memory_cache_is_bounded():
+    cache = DedupCache(max_entries=2)
+    for key in 'abc':
+        cache.seen(key)
+    assert cache.stats()['size'] == 2
+    assert not cache.peek('a')
+    assert cache.peek('c')
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    db_path = str(tmp_path / 'dedup.db')
+    DedupCache(db_path=db_path).seen('a')
+    assert DedupCache(db_path=db_path).seen('a')
+
+
+def test_once_drops_redeliveries_and_forgets_failures(cache):
+    calls = []
+
+    @cache.once
+    def handle(event):
+        calls.append(event.webhook_event_id)
+        if event.webhook_event_id == 'bad':
+            raise ValueError('failed')
+        return 'handled'
+
+    assert handle(NS(webhook_event_id='a')) == 'handled'
+    assert handle(NS(webhook_event_id='a')) is None
+    with pytest.raises(ValueError):
+        handle(NS(webhook_event_id='bad'))
+    with pytest.raises(ValueError):
+        handle(NS(webhook_event_id='bad'))
+    assert calls == ['a', 'bad', 'bad']
+
+
+def test_once_wraps_coroutines(cache):
+    calls = []
+
+    @cache.once
+    async def handle(event):
+        calls.append(event)
+
+    first, redelivery, keyless = NS(webhook_event_id='a'), NS(webhook_event_id='a'), NS()
+
+    async def main():
+        for event in (first, redelivery, keyless, keyless):
+            await handle(event)
+
+    asyncio.run(main())
+    # Without a key there is nothing to deduplicate on, so it always runs
+    assert calls == [first, keyless, keyless]
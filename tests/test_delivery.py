@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models import Error, TextSendMessage
+
+import app_logging
+from delivery import ReplyDeadlines
+
+
+class Source(object):
+    type = 'user'
+    user_id = 'U1'
+
+
+class Event(object):
+    def __init__(self, age=0.0):
+        self.reply_token = 'token'
+        self.source = Source()
+        self.timestamp = int((time.time() - age) * 1000)
+
+
+class FakeApi(object):
+    def __init__(self, reply_error=None):
+        self.reply_error = reply_error
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def reply_message(self, token, messages):
+        with self.lock:
+            self.sent.append(('reply', token, messages, app_logging.current_correlation_id()))
+        if self.reply_error is not None:
+            raise self.reply_error
+
+    def push_message(self, to, messages):
+        with self.lock:
+            self.sent.append(('push', to, messages, app_logging.current_correlation_id()))
+
+
+def line_error(message):
+    return LineBotApiError(400, {}, error=Error(message=message))
+
+
+def test_reply_while_token_is_good():
+    deadlines = ReplyDeadlines()
+    api = FakeApi()
+    with deadlines.track(api, Event(), 'text') as delivery:
+        delivery.send(TextSendMessage(text='answer'))
+    assert [(kind, to) for kind, to, _, _ in api.sent] == [('reply', 'token')]
+    assert deadlines.stats()['kinds']['text']['replies'] == 1
+
+
+def test_push_once_token_is_too_close_to_expiry():
+    deadlines = ReplyDeadlines(token_ttl=60, margin=5)
+    api = FakeApi()
+    with deadlines.track(api, Event(age=57), 'text') as delivery:
+        delivery.send(TextSendMessage(text='answer'))
+    assert [(kind, to) for kind, to, _, _ in api.sent] == [('push', 'U1')]
+    assert deadlines.stats()['kinds']['text']['expired_tokens'] == 1
+
+
+def test_later_messages_are_pushed():
+    deadlines = ReplyDeadlines()
+    api = FakeApi()
+    with deadlines.track(api, Event(), 'text') as delivery:
+        delivery.send(TextSendMessage(text='one'))
+        delivery.send(TextSendMessage(text='two'))
+    assert [kind for kind, _, _, _ in api.sent] == ['reply', 'push']
+
+
+def test_invalid_reply_token_falls_back_to_push():
+    deadlines = ReplyDeadlines()
+    api = FakeApi(reply_error=line_error('Invalid reply token'))
+    with deadlines.track(api, Event(), 'text') as delivery:
+        delivery.send(TextSendMessage(text='answer'))
+    assert [kind for kind, _, _, _ in api.sent] == ['reply', 'push']
+    assert deadlines.stats()['kinds']['text']['pushes'] == 1
+
+
+def test_other_bad_requests_are_not_pushed():
+    deadlines = ReplyDeadlines()
+    api = FakeApi(reply_error=line_error('The request body has 1 error(s)'))
+    with pytest.raises(LineBotApiError):
+        with deadlines.track(api, Event(), 'text') as delivery:
+            delivery.send(TextSendMessage(text='answer'))
+    assert [kind for kind, _, _, _ in api.sent] == ['reply']
+
+
+def test_ack_before_the_token_expires():
+    deadlines = ReplyDeadlines(token_ttl=0.5, margin=0.1, ack_text='wait')
+    api = FakeApi()
+    with app_logging.correlation_id('req-1'):
+        with deadlines.track(api, Event(), 'text') as delivery:
+            time.sleep(0.45)
+            delivery.send(TextSendMessage(text='answer'))
+    assert [(kind, messages.text) for kind, _, messages, _ in api.sent] == [('reply', 'wait'), ('push', 'answer')]
+    # The ack timer runs with the handler's context
+    assert api.sent[0][3] == 'req-1'
+    assert deadlines.stats()['kinds']['text']['acks'] == 1
+
+
+def test_no_ack_when_answer_is_in_time():
+    deadlines = ReplyDeadlines(token_ttl=1.0, margin=0.1, ack_text='wait')
+    api = FakeApi()
+    with deadlines.track(api, Event(), 'text') as delivery:
+        delivery.send(TextSendMessage(text='answer'))
+    time.sleep(0.9)
+    assert [(kind, messages.text) for kind, _, messages, _ in api.sent] == [('reply', 'answer')]
+
+
+def test_slow_kind_is_acked_at_once():
+    deadlines = ReplyDeadlines(token_ttl=10, margin=1, ack_text='wait', min_samples=3)
+    for _ in range(3):
+        deadlines._finish('image', 20.0)
+    api = FakeApi()
+    with deadlines.track(api, Event(), 'image') as delivery:
+        assert [kind for kind, _, _, _ in api.sent] == ['reply']
+        delivery.send(TextSendMessage(text='answer'))
+    assert [kind for kind, _, _, _ in api.sent] == ['reply', 'push']
+    assert deadlines.stats()['kinds']['image']['early_acks'] == 1
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+from event_queue import AsyncEventQueue, EventQueue
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_events_of_one_key_run_in_order():
+    seen = []
+
+    def dispatch(event, destination):
+        time.sleep(0.001)
+        seen.append(event)
+
+    queue = EventQueue(dispatch, workers=4)
+    events = [('a', i) for i in range(20)] + [('b', i) for i in range(20)]
+    assert queue.submit_all(events, key=lambda event: event[0])
+    queue.shutdown(timeout=5)
+    assert [event for event in seen if event[0] == 'a'] == events[:20]
+    assert [event for event in seen if event[0] == 'b'] == events[20:]
+
+
+def test_slow_key_does_not_hold_up_others():
+    release = threading.Event()
+    seen = []
+
+    def dispatch(event, destination):
+        if event == 'slow':
+            release.wait(5)
+        seen.append(event)
+
+    queue = EventQueue(dispatch, workers=2)
+    queue.submit('slow', key='a')
+    queue.submit('queued', key='a')
+    queue.submit('other', key='b')
+    wait_until(lambda: 'other' in seen)
+    assert seen == ['other']
+    release.set()
+    queue.shutdown(timeout=5)
+    assert seen == ['other', 'slow', 'queued']
+
+
+def test_submit_all_is_all_or_nothing():
+    release = threading.Event()
+    queue = EventQueue(lambda event, destination: release.wait(5), maxsize=3, workers=1)
+    # Hold the only worker so the depth stays put
+    queue.submit(0, key='a')
+    wait_until(lambda: queue.stats()['busy_workers'] == 1)
+    assert queue.submit_all([1, 2], key=lambda event: 'a')
+    assert not queue.submit_all([3, 4], key=lambda event: 'a')
+    assert queue.stats()['rejected'] == 2
+    assert queue.submit(3, key='a')
+    release.set()
+    queue.shutdown(timeout=5)
+    assert queue.stats()['processed'] == 4
+
+
+def test_shutdown_drains_and_refuses_new_events():
+    seen = []
+    queue = EventQueue(lambda event, destination: seen.append((event, destination)), workers=2)
+    for i in range(10):
+        queue.submit(i, destination='reply', key=i % 3)
+    queue.shutdown(timeout=5)
+    assert sorted(seen) == [(i, 'reply') for i in range(10)]
+    assert queue.depth() == 0
+    assert not queue.submit(10)
+
+
+def test_failed_dispatch_is_counted_and_the_key_moves_on():
+    seen = []
+
+    def dispatch(event, destination):
+        if event == 'bad':
+            raise ValueError(event)
+        seen.append(event)
+
+    queue = EventQueue(dispatch, workers=1)
+    queue.submit_all(['bad', 'good'], key=lambda event: 'a')
+    queue.shutdown(timeout=5)
+    assert seen == ['good']
+    assert queue.stats()['failed'] == 1
+    assert queue.stats()['active_keys'] == 0
+
+
+def test_async_queue_keeps_key_order_and_drains():
+    seen = []
+
+    async def dispatch(event, destination):
+        # Later events of a key finish sooner unless they wait their turn
+        await asyncio.sleep(0.01 * (5 - event[1]))
+        seen.append(event)
+
+    async def main():
+        queue = AsyncEventQueue(dispatch, concurrency=10)
+        events = [(key, i) for key in 'ab' for i in range(5)]
+        assert queue.submit_all(events, key=lambda event: event[0])
+        await queue.shutdown(timeout=5)
+        assert not queue.submit(('a', 5))
+        return queue.stats()
+
+    stats = asyncio.run(main())
+    assert [event for event in seen if event[0] == 'a'] == [('a', i) for i in range(5)]
+    assert [event for event in seen if event[0] == 'b'] == [('b', i) for i in range(5)]
+    assert stats['processed'] == 10
+
+
+def test_async_queue_is_all_or_nothing():
+    async def main():
+        queue = AsyncEventQueue(lambda event, destination: asyncio.sleep(0), maxsize=2)
+        assert not queue.submit_all([1, 2, 3])
+        assert queue.stats()['rejected'] == 3
+        assert queue.submit_all([1, 2])
+        await queue.shutdown(timeout=5)
+        return queue.stats()
+
+    assert asyncio.run(main())['processed'] == 2
@@ -0,0 +1,89 @@
+import asyncio
+from functools import partial
+
+import pytest
+import requests
+from linebot import LineBotApi, AsyncLineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient
+from linebot.models import TextSendMessage
+
+import line_http
+from line_http import ResilientHttpClient, ResilientAsyncHttpClient
+from resilience import Upstream
+
+
+class Response(object):
+    # Stands in for the SDK's response wrappers
+    def __init__(self, status_code, body=None):
+        self.status_code = self.status = status_code
+        self.headers = {'X-Line-Request-Id': 'req'}
+        self.json = body or {}
+        self.text = ''
+
+
+def scripted_post(monkeypatch, outcomes, asynchronous=False):
+    # The SDK client's post returns (or raises) the outcomes in turn;
+    # returns the headers of each attempt
+    attempts = []
+
+    def respond(headers):
+        attempts.append(headers)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    if asynchronous:
+        async def post(self, url, headers=None, data=None, timeout=None):
+            return respond(headers)
+        monkeypatch.setattr(line_http.AiohttpAsyncHttpClient, 'post', post)
+    else:
+        def post(self, url, headers=None, data=None, timeout=None):
+            return respond(headers)
+        monkeypatch.setattr(RequestsHttpClient, 'post', post)
+    return attempts
+
+
+def line_api(**kwargs):
+    return LineBotApi('token', http_client=partial(ResilientHttpClient,
+                                                   Upstream('line', base_delay=0.001, **kwargs)))
+
+
+def test_push_is_retried_with_the_same_retry_key(monkeypatch):
+    attempts = scripted_post(monkeypatch, [requests.Timeout(), Response(200)])
+    line_api().push_message('U1', TextSendMessage(text='hi'))
+    assert len(attempts) == 2
+    assert attempts[0]['X-Line-Retry-Key'] == attempts[1]['X-Line-Retry-Key']
+
+
+def test_conflict_on_retried_push_is_success(monkeypatch):
+    # LINE accepted the first attempt and answers the retry with 409
+    attempts = scripted_post(monkeypatch, [Response(503), Response(409, {'message': 'conflict'})])
+    line_api().push_message('U1', TextSendMessage(text='hi'))
+    assert len(attempts) == 2
+
+
+def test_conflict_on_retried_push_is_success_async(monkeypatch):
+    attempts = scripted_post(monkeypatch, [Response(503), Response(409)], asynchronous=True)
+
+    async def main():
+        client = ResilientAsyncHttpClient(None, Upstream('line', base_delay=0.001))
+        await AsyncLineBotApi('token', client).push_message('U1', TextSendMessage(text='hi'))
+    asyncio.run(main())
+    assert len(attempts) == 2
+
+
+def test_reply_is_sent_once(monkeypatch):
+    attempts = scripted_post(monkeypatch, [Response(503, {'message': 'unavailable'})])
+    with pytest.raises(LineBotApiError) as raised:
+        line_api().reply_message('token', TextSendMessage(text='hi'))
+    assert raised.value.status_code == 503
+    assert len(attempts) == 1
+    assert 'X-Line-Retry-Key' not in attempts[0]
+
+
+def test_conflict_without_retry_key_is_an_error(monkeypatch):
+    scripted_post(monkeypatch, [Response(409, {'message': 'conflict'})])
+    with pytest.raises(LineBotApiError):
+        line_api().reply_message('token', TextSendMessage(text='hi'))
@@ -0,0 +1,222 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from models import DeadlineExceeded, ModelPolicy
+from ratelimit import RateLimiter, RateLimited
+from resilience import Upstream, UpstreamError
+
+
+class Message(object):
+    def __init__(self, content):
+        self.content = content
+        self.tool_calls = None
+
+
+class Choice(object):
+    def __init__(self, content):
+        self.message = Message(content)
+
+
+class Usage(object):
+    prompt_tokens = 10
+    completion_tokens = 5
+    total_tokens = 15
+
+
+class Response(object):
+    def __init__(self, content):
+        self.choices = [Choice(content)]
+        self.usage = Usage()
+
+
+class FakeClient(object):
+    # chat.completions.create() answers after `delays[model]` seconds, or
+    # raises TimeoutError once the request's timeout runs out, like the SDK
+    def __init__(self, delays, content='answer'):
+        self.delays = delays
+        self.content = content
+        self.requests = []
+        self.chat = self
+        self.completions = self
+
+    def create(self, model, timeout, **kwargs):
+        self.requests.append((model, timeout))
+        delay = self.delays.get(model, 0.0)
+        if delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"{model} timed out")
+        time.sleep(delay)
+        return Response(self.content)
+
+
+class FakeAsyncClient(FakeClient):
+    async def create(self, model, timeout, **kwargs):
+        self.requests.append((model, timeout))
+        delay = self.delays.get(model, 0.0)
+        if delay > timeout:
+            await asyncio.sleep(timeout)
+            raise TimeoutError(f"{model} timed out")
+        await asyncio.sleep(delay)
+        return Response(self.content)
+
+
+def ask(policy, client, **kwargs):
+    return policy.create(client, policy.large, messages=[{'role': 'user', 'content': 'hi'}], **kwargs)
+
+
+def test_answer_within_deadline():
+    policy = ModelPolicy(answer_deadline=1.0)
+    client = FakeClient({})
+    assert ask(policy, client).choices[0].message.content == 'answer'
+    assert client.requests[0][0] == policy.large.model
+    assert 0 < client.requests[0][1] <= 1.0
+    assert policy.stats()['tiers']['large']['calls'] == 1
+
+
+def test_unhedged_call_runs_on_the_callers_thread():
+    policy = ModelPolicy()
+    threads = []
+    client = FakeClient({})
+    create = client.create
+
+    def record_thread(**kwargs):
+        threads.append(threading.current_thread())
+        return create(**kwargs)
+
+    client.create = record_thread
+    ask(policy, client)
+    assert threads == [threading.current_thread()]
+    assert policy._executor is None
+
+
+def test_queued_call_gets_its_whole_deadline():
+    policy = ModelPolicy(answer_deadline=0.5, hedge=True, hedge_min_samples=5, hedge_workers=1)
+    # Slow enough that no hedge is sent
+    policy.large.latencies.extend([1.0] * 5)
+    policy._get_executor().submit(time.sleep, 0.3)
+    client = FakeClient({'gpt-4': 0.3})
+    assert ask(policy, client).choices[0].message.content == 'answer'
+    assert client.requests[0][1] > 0.4
+
+
+def test_deadline_exceeded():
+    policy = ModelPolicy(answer_deadline=0.2)
+    client = FakeClient({'gpt-4': 5.0})
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        ask(policy, client)
+    assert time.monotonic() - start < 1.0
+    assert policy.stats()['deadline_exceeded'] == 1
+
+
+def test_request_timeout_is_what_is_left_of_the_deadline():
+    # The SDK gives up by the deadline, and nothing is retried after it
+    policy = ModelPolicy(answer_deadline=0.3, upstream=Upstream('openai', base_delay=0.001))
+    client = FakeClient({'gpt-4': 5.0})
+    with pytest.raises(DeadlineExceeded):
+        ask(policy, client)
+    time.sleep(0.1)
+    assert all(timeout <= 0.3 for _, timeout in client.requests)
+    assert sum(timeout for _, timeout in client.requests) <= 0.35
+
+
+def test_no_retry_that_would_start_after_the_deadline():
+    policy = ModelPolicy(answer_deadline=0.2)
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        raise UpstreamError('openai', 'busy', transient=True, retry_after=1.0)
+
+    client = FakeClient({})
+    client.create = create
+    with pytest.raises(UpstreamError):
+        ask(policy, client)
+    assert len(calls) == 1
+
+
+def test_deadline_exceeded_async():
+    policy = ModelPolicy(answer_deadline=0.2)
+    client = FakeAsyncClient({'gpt-4': 5.0})
+
+    async def main():
+        with pytest.raises(DeadlineExceeded):
+            await policy.create_async(client, policy.large, messages=[])
+    asyncio.run(main())
+    assert client.requests[0][1] <= 0.2
+
+
+def test_slow_primary_is_hedged_on_the_fast_tier():
+    policy = ModelPolicy(answer_deadline=2.0, hedge=True, hedge_min_samples=5)
+    policy.large.latencies.extend([0.05] * 5)
+    client = FakeClient({'gpt-4': 1.0, 'gpt-4o-mini': 0.0})
+    start = time.monotonic()
+    ask(policy, client)
+    assert time.monotonic() - start < 0.5
+    assert [model for model, _ in client.requests] == ['gpt-4', 'gpt-4o-mini']
+    hedging = policy.stats()['hedging']
+    assert hedging['hedged'] == 1
+    assert hedging['hedge_wins'] == 1
+
+
+def test_no_hedge_without_enough_samples():
+    policy = ModelPolicy(answer_deadline=2.0, hedge=True, hedge_min_samples=5)
+    client = FakeClient({'gpt-4': 0.2})
+    ask(policy, client)
+    assert [model for model, _ in client.requests] == ['gpt-4']
+    assert policy.stats()['hedging']['hedged'] == 0
+
+
+def test_unacceptable_answer_waits_for_the_other_request():
+    policy = ModelPolicy(answer_deadline=2.0, hedge=True, hedge_min_samples=5)
+    policy.large.latencies.extend([0.05] * 5)
+    answers = {'gpt-4': 'late answer', 'gpt-4o-mini': ''}
+    client = FakeClient({'gpt-4': 0.3, 'gpt-4o-mini': 0.0})
+    lock = threading.Lock()
+
+    def create(model, timeout, **kwargs):
+        with lock:
+            client.requests.append((model, timeout))
+        time.sleep(client.delays[model])
+        return Response(answers[model])
+
+    client.create = create
+    assert ask(policy, client).choices[0].message.content == 'late answer'
+    assert policy.stats()['hedging']['hedge_wins'] == 0
+
+
+def test_hedged_async_loser_is_cancelled():
+    policy = ModelPolicy(answer_deadline=2.0, hedge=True, hedge_min_samples=5)
+    policy.large.latencies.extend([0.05] * 5)
+    client = FakeAsyncClient({'gpt-4': 1.0, 'gpt-4o-mini': 0.0})
+
+    async def main():
+        start = time.monotonic()
+        await policy.create_async(client, policy.large, messages=[])
+        assert time.monotonic() - start < 0.5
+        pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.sleep(0)
+        assert all(t.cancelled() or t.done() for t in pending)
+    asyncio.run(main())
+    assert policy.stats()['hedging']['hedge_wins'] == 1
+
+
+def test_rate_limit_wait_counts_against_the_deadline():
+    limiter = RateLimiter({'openai_requests': (1.0, 1)})
+    policy = ModelPolicy(answer_deadline=0.3, limiter=limiter)
+    client = FakeClient({})
+    ask(policy, client)
+    with pytest.raises(RateLimited):
+        ask(policy, client)
+    assert len(client.requests) == 1
+    assert limiter.stats()['resources']['openai_requests']['charged'] == 1
+
+
+def test_usage_settles_the_token_estimate():
+    limiter = RateLimiter({'openai_tokens': (0.001, 10000)})
+    policy = ModelPolicy(limiter=limiter)
+    ask(policy, FakeClient({}), max_tokens=500)
+    assert limiter.stats()['resources']['openai_tokens']['charged'] == Usage.total_tokens
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+import pipeline as pipeline_module
+from pipeline import AnswerPipeline
+from ratelimit import RateLimiter
+
+
+class Message(object):
+    def __init__(self, content):
+        self.content = content
+        self.tool_calls = None
+
+
+class Choice(object):
+    def __init__(self, content):
+        self.message = Message(content)
+
+
+class Response(object):
+    usage = None
+
+    def __init__(self, content):
+        self.choices = [Choice(content)]
+
+
+class FakeClient(object):
+    # Says yes to every routing question and answers with the prompt's last
+    # user message, so tests can tell which prompt was used
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+        self.prompts = []
+
+    def create(self, model, messages, timeout=None, **kwargs):
+        self.prompts.append(messages)
+        if 'online search' in messages[0]['content']:
+            return Response('yes')
+        return Response(messages[-1]['content'])
+
+
+class FakeAsyncClient(FakeClient):
+    async def create(self, model, messages, timeout=None, **kwargs):
+        return FakeClient.create(self, model, messages, timeout, **kwargs)
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    queries = []
+
+    def google_search(query, api_key, search_engine_id):
+        queries.append(query)
+        return {'items': [{'title': 'Result', 'link': 'https://example.com', 'snippet': 'sunny'}]}
+
+    async def async_google_search(query, api_key, search_engine_id, session):
+        return google_search(query, api_key, search_engine_id)
+
+    monkeypatch.setattr(pipeline_module, 'google_search', google_search)
+    monkeypatch.setattr(pipeline_module, 'async_google_search', async_google_search)
+    return queries
+
+
+def limited_pipeline(quota, **kwargs):
+    limiter = RateLimiter({'google': (quota / 86400.0, quota)}, max_wait=1.0)
+    return AnswerPipeline('key', 'engine', limiter=limiter, **kwargs)
+
+
+def test_daily_quota_can_be_used_at_once(searches):
+    pipeline = limited_pipeline(20)
+    client = FakeClient()
+    for i in range(20):
+        pipeline.answer(f"weather in city {i}", client)
+    assert len(searches) == 20
+    assert pipeline.stats()['searches_rate_limited'] == 0
+
+
+def test_search_over_quota_answers_directly(searches):
+    pipeline = limited_pipeline(1)
+    client = FakeClient()
+    pipeline.answer("weather in Taipei", client)
+    content, search = pipeline._answer("weather in Tokyo", client, ())
+    assert len(searches) == 1
+    # The direct prompt ends with the question itself
+    assert content == "weather in Tokyo"
+    assert search
+    assert pipeline.stats()['searches_rate_limited'] == 1
+
+
+def test_search_over_quota_answers_directly_async(searches):
+    pipeline = limited_pipeline(1)
+    client = FakeAsyncClient()
+
+    async def main():
+        await pipeline.answer_async("weather in Taipei", client, None)
+        return await pipeline._answer_async("weather in Tokyo", client, None, ())
+    content, search = asyncio.run(main())
+    assert content == "weather in Tokyo"
+    assert pipeline.stats()['searches_rate_limited'] == 1
+
+
+def test_speculative_search_over_quota_keeps_the_direct_branch(searches):
+    pipeline = limited_pipeline(1, speculative=True)
+    client = FakeClient()
+    pipeline.answer("weather in Taipei", client)
+    content, search = pipeline._answer("weather in Tokyo", client, ())
+    assert content == "weather in Tokyo"
+    assert pipeline.stats()['speculation']['wasted_searches'] == 0
+
+
+def test_speculative_branches_queue_for_workers(searches):
+    pipeline = AnswerPipeline('key', 'engine', speculative=True, speculative_workers=1)
+    content, search = pipeline._answer("weather in Taipei", FakeClient(), ())
+    assert search
+    speculation = pipeline.stats()['speculation']
+    assert speculation['workers'] == 1
+    assert speculation['max_queued'] >= 2
+    # Every branch was either picked up or cancelled
+    pipeline._executor.shutdown(wait=True)
+    assert pipeline.stats()['speculation']['queued'] == 0
@@ -0,0 +1,78 @@
+from prompts import MIN_RESULT_TOKENS, PromptBuilder, format_result
+from tokens import count_message_tokens, count_tokens
+
+
+def results(count, snippet="The weather in Taipei is sunny with a light breeze from the east. " * 3):
+    return {'items': [{'title': f"Result {i}", 'link': f"https://example.com/{i}", 'snippet': snippet}
+                      for i in range(count)]}
+
+
+def result_tokens(item):
+    return count_tokens(format_result(item)) + 1
+
+
+def test_results_that_fit_are_all_used():
+    prompts = PromptBuilder()
+    search_results = results(3)
+    text = prompts.format_results(search_results, 10000)
+    assert text == "\n".join(format_result(item) for item in search_results['items'])
+    assert prompts.stats()['results_used'] == 3
+
+
+def test_result_over_the_budget_is_cut_and_the_rest_dropped():
+    prompts = PromptBuilder()
+    search_results = results(4)
+    budget = result_tokens(search_results['items'][0]) + MIN_RESULT_TOKENS + 5
+    text = prompts.format_results(search_results, budget)
+    assert count_tokens(text) <= budget
+    assert "Result 0" in text and "Result 1" in text and "Result 2" not in text
+    assert text.endswith("…\n")
+    stats = prompts.stats()
+    assert (stats['results_used'], stats['results_cut'], stats['results_dropped']) == (1, 1, 2)
+
+
+def test_too_little_room_drops_instead_of_cutting():
+    prompts = PromptBuilder()
+    search_results = results(2)
+    budget = result_tokens(search_results['items'][0]) + MIN_RESULT_TOKENS - 1
+    assert "Result 1" not in prompts.format_results(search_results, budget)
+    assert prompts.stats()['results_cut'] == 0
+    assert prompts.stats()['results_dropped'] == 1
+
+
+def test_search_prompt_stays_under_budget():
+    prompts = PromptBuilder(budget=400)
+    history = [{'role': 'user', 'content': "hi"}, {'role': 'assistant', 'content': "hello"}]
+    messages = prompts.search("weather in Taipei", results(10), history)
+    assert count_message_tokens(messages) <= 400
+    assert messages[1:3] == history
+    assert prompts.stats()['kinds']['search']['max_tokens'] <= 400
+    assert prompts.stats()['results_dropped'] > 0
+
+
+def test_long_queries_are_capped():
+    prompts = PromptBuilder(max_query_tokens=10)
+    messages = prompts.direct("word " * 100)
+    assert count_tokens(messages[-1]['content']) <= 10
+    prompts.direct("short question")
+    assert prompts.stats()['truncated_queries'] == 1
+
+
+def test_tool_results_share_what_the_conversation_leaves():
+    prompts = PromptBuilder(budget=600)
+    messages = prompts.tools("weather in Taipei and Tokyo")
+    prompts.tool_result(messages, 'call-1', results(10), share=2)
+    prompts.tool_result(messages, 'call-2', results(10), share=1)
+    assert [message['role'] for message in messages[-2:]] == ['tool', 'tool']
+    assert messages[-1]['tool_call_id'] == 'call-2'
+    assert count_message_tokens(messages) <= 600
+
+
+def test_stats_average_per_kind():
+    prompts = PromptBuilder()
+    prompts.record("direct", [{'role': 'user', 'content': "a" * 40}])
+    prompts.record("direct", [{'role': 'user', 'content': "a" * 80}])
+    kind = prompts.stats()['kinds']['direct']
+    assert kind['prompts'] == 2
+    assert kind['avg_tokens'] == kind['tokens'] / 2
+    assert kind['max_tokens'] == count_message_tokens([{'role': 'user', 'content': "a" * 80}])
@@ -0,0 +1,76 @@
+import pytest
+
+from ratelimit import RateLimiter, RateLimited, charged_to
+
+
+def test_charges_queue_in_arrival_order():
+    limiter = RateLimiter({'openai_requests': (10.0, 2)})
+    waits = [limiter._schedule({'openai_requests': 1}, 0)[0] for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02)
+    assert waits[3] == pytest.approx(0.2, abs=0.02)
+
+
+def test_wait_over_max_wait_is_rejected_without_charging():
+    limiter = RateLimiter({'openai_requests': (1.0, 1)}, max_wait=0.5)
+    limiter.acquire({'openai_requests': 1})
+    with pytest.raises(RateLimited) as raised:
+        limiter.acquire({'openai_requests': 1})
+    assert raised.value.resource == 'openai_requests'
+    stats = limiter.stats()['resources']['openai_requests']
+    assert stats['charged'] == 1
+    assert stats['rejected'] == 1
+
+
+def test_call_max_wait_lowers_the_limiters_own():
+    limiter = RateLimiter({'openai_requests': (10.0, 1)}, max_wait=20.0)
+    limiter.acquire({'openai_requests': 1})
+    with pytest.raises(RateLimited):
+        limiter.acquire({'openai_requests': 1}, max_wait=0.01)
+    # Still within the limiter's max_wait without the per-call cap
+    limiter.acquire({'openai_requests': 1})
+
+
+def test_unknown_resources_are_not_limited():
+    limiter = RateLimiter({'openai_requests': (1.0, 1)})
+    assert limiter._schedule({'google': 100}, 0)[0] == 0.0
+
+
+def test_nothing_reserved_without_user_rate():
+    limiter = RateLimiter({'openai_tokens': (100.0, 1000)}, reserve=0.5)
+    assert limiter.reserve == 0.0
+    assert limiter._schedule({'openai_tokens': 1000}, 0)[0] == 0.0
+
+
+def test_shared_bucket_holds_at_least_one_call():
+    limiter = RateLimiter({'openai_requests': (1.0, 1)}, user_rate=1.0, reserve=0.5)
+    assert limiter._schedule({'openai_requests': 1}, 0)[0] == 0.0
+
+
+def test_reserve_keeps_fresh_users_ahead_of_heavy_ones():
+    limiter = RateLimiter({'openai_tokens': (1.0, 10)}, user_rate=1.0, user_burst=100, reserve=0.5)
+    with charged_to('heavy'):
+        assert limiter._schedule({'openai_tokens': 5}, user_cost=60)[0] == 0.0
+        # Under half its bucket left, so only the shared share, now empty
+        assert limiter._schedule({'openai_tokens': 5}, user_cost=5)[0] > 1.0
+    with charged_to('light'):
+        assert limiter._schedule({'openai_tokens': 5}, user_cost=5)[0] == 0.0
+    assert limiter.stats()['resources']['openai_tokens']['reserved_uses'] == 1
+
+
+def test_settle_corrects_the_estimate():
+    limiter = RateLimiter({'openai_tokens': (0.001, 1000)})
+    charge = limiter.acquire({'openai_tokens': 800})
+    limiter.settle(charge, 'openai_tokens', 300)
+    stats = limiter.stats()['resources']['openai_tokens']
+    assert stats['available'] == pytest.approx(700, abs=1)
+    assert stats['charged'] == 300
+    assert stats['estimate_error'] == 500
+
+
+def test_settle_also_corrects_the_users_bucket():
+    limiter = RateLimiter({'openai_tokens': (0.001, 1000)}, user_rate=0.001, user_burst=1000)
+    with charged_to('U1'):
+        charge = limiter.acquire({'openai_tokens': 800}, user_cost=800)
+    limiter.settle(charge, 'openai_tokens', 300)
+    assert charge.user_bucket.tokens == pytest.approx(700, abs=1)
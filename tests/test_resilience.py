@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, Upstream, UpstreamError
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.allow()
+        breaker.failure()
+    assert breaker.state == 'closed'
+    breaker.failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker('test', failure_threshold=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == 'closed'
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    assert breaker.state == 'half_open'
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_probe_success_closes():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed'
+    breaker.allow()
+
+
+def test_probe_failure_opens_again():
+    breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=0.05)
+    for _ in range(5):
+        breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert breaker.stats()['opens'] == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_abandoned_probe_expires():
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.allow()
+    time.sleep(0.06)
+    breaker.allow()
+
+
+def failing(errors):
+    calls = []
+
+    def func():
+        calls.append(time.monotonic())
+        raise errors.pop(0) if errors else UpstreamError('test', 'down', transient=True)
+    return func, calls
+
+
+def test_upstream_retries_transient_errors():
+    upstream = Upstream('test', max_attempts=3, base_delay=0.001)
+    func, calls = failing([])
+    with pytest.raises(UpstreamError):
+        upstream.call(func)
+    assert len(calls) == 3
+    assert upstream.stats()['retries'] == 2
+
+
+def test_upstream_does_not_retry_permanent_errors():
+    upstream = Upstream('test', max_attempts=3)
+    func, calls = failing([UpstreamError('test', 'bad request', status=400)])
+    with pytest.raises(UpstreamError):
+        upstream.call(func)
+    assert len(calls) == 1
+
+
+def test_upstream_stops_retrying_at_the_deadline():
+    upstream = Upstream('test', max_attempts=5)
+    func, calls = failing([UpstreamError('test', 'busy', transient=True, retry_after=0.5)])
+    with pytest.raises(UpstreamError):
+        upstream.call(func, deadline=time.monotonic() + 0.2)
+    assert len(calls) == 1
+
+
+def test_upstream_fails_fast_while_open():
+    upstream = Upstream('test', max_attempts=1, failure_threshold=1, reset_timeout=60)
+    func, calls = failing([])
+    with pytest.raises(UpstreamError):
+        upstream.call(func)
+    with pytest.raises(CircuitOpenError):
+        upstream.call(func)
+    assert len(calls) == 1
@@ -0,0 +1,93 @@
+from types import SimpleNamespace as NS
+
+import pytest
+
+from pipeline import AnswerPipeline
+from router import DecisionLog, QueryRouter, load_examples
+
+SEARCH = ["weather in Taipei today", "latest news about the election", "stock price of TSMC now",
+          "today's weather forecast", "news today", "current exchange rate of the yen"]
+DIRECT = ["tell me a joke", "write a poem about cats", "translate hello into French",
+          "explain recursion", "what is 2 plus 2", "say something nice"]
+
+
+def examples():
+    return [(query, True) for query in SEARCH] + [(query, False) for query in DIRECT]
+
+
+@pytest.fixture(scope='module')
+def router():
+    return QueryRouter.train(examples(), dims=1 << 12)
+
+
+def test_router_learns_its_training_data(router):
+    for query, search in examples():
+        decision, confidence = router.predict(query)
+        assert decision == search
+        assert 0.5 <= confidence <= 1.0
+
+
+def test_router_is_case_and_space_insensitive(router):
+    assert router.probability("Weather  in TAIPEI today") == pytest.approx(router.probability("weather in taipei today"))
+
+
+def test_saved_router_predicts_the_same(router, tmp_path):
+    path = str(tmp_path / 'router.npz')
+    router.save(path)
+    loaded = QueryRouter.load(path, threshold=0.7)
+    assert loaded.threshold == 0.7
+    assert loaded.dims == router.dims
+    for query in ["weather tomorrow", "a poem about dogs"]:
+        assert loaded.predict(query) == pytest.approx(router.predict(query), rel=1e-5)
+
+
+def test_training_needs_examples():
+    with pytest.raises(ValueError):
+        QueryRouter.train([])
+
+
+def test_decision_log_is_training_data(tmp_path):
+    path = str(tmp_path / 'decisions.jsonl')
+    log = DecisionLog(path)
+    log.record("天氣如何", 1)
+    log.record("tell me a joke", False)
+    assert list(load_examples(path)) == [("天氣如何", True), ("tell me a joke", False)]
+
+
+class StubRouter(object):
+    def __init__(self, search, confidence, threshold=0.9):
+        self.decision = (search, confidence)
+        self.threshold = threshold
+
+    def predict(self, query):
+        return self.decision
+
+
+class RoutingClient(object):
+    def __init__(self, answer):
+        self.chat = self.completions = self
+        self.answer = answer
+        self.calls = 0
+
+    def create(self, model, messages, timeout=None, **kwargs):
+        self.calls += 1
+        return NS(choices=[NS(message=NS(content=self.answer, tool_calls=None))], usage=None)
+
+
+def test_confident_router_skips_the_llm():
+    pipeline = AnswerPipeline('key', 'engine', router=StubRouter(False, 0.95))
+    client = RoutingClient('yes')
+    assert pipeline.should_search("tell me a joke", client) is False
+    assert client.calls == 0
+    assert pipeline.stats()['routed_locally'] == 1
+
+
+def test_unsure_router_asks_the_llm_and_logs_it(tmp_path):
+    path = str(tmp_path / 'decisions.jsonl')
+    pipeline = AnswerPipeline('key', 'engine', router=StubRouter(False, 0.6),
+                              decision_log=DecisionLog(path))
+    client = RoutingClient('yes')
+    assert pipeline.should_search("weather in Taipei", client) is True
+    assert client.calls == 1
+    assert pipeline.stats()['routed_by_llm'] == 1
+    assert list(load_examples(path)) == [("weather in Taipei", True)]
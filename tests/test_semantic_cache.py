@@ -0,0 +1,146 @@
+import time
+
+import numpy as np
+import pytest
+
+from ratelimit import RateLimiter
+from resilience import Upstream
+from semantic_cache import SemanticCache, openai_embedding
+
+DIMS = 8
+
+# Questions that mean the same thing share a direction
+TOPICS = {
+    "weather in taipei": 0,
+    "what's the weather in taipei": 0,
+    "explain hash maps": 1,
+    "capital of france": 2,
+    "tallest mountain": 3,
+}
+
+
+def embed(texts):
+    vectors = np.zeros((len(texts), DIMS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        vectors[row, TOPICS[text]] = 1.0
+    return vectors
+
+
+def cached(cache, query, route='direct'):
+    answer, vector = cache.lookup(query)
+    if answer is None:
+        cache.insert(vector, route, 'answer to ' + query, query)
+    return answer
+
+
+def test_reworded_question_hits():
+    cache = SemanticCache(embed, DIMS, capacity=10)
+    assert cached(cache, "weather in taipei") is None
+    assert cached(cache, "what's the weather in taipei") == "answer to weather in taipei"
+    assert cached(cache, "explain hash maps") is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+
+
+def test_expired_answers_miss():
+    cache = SemanticCache(embed, DIMS, capacity=10, search_ttl=0)
+    cached(cache, "weather in taipei", route='search')
+    assert cached(cache, "weather in taipei") is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = SemanticCache(embed, DIMS, capacity=2)
+    cached(cache, "weather in taipei")
+    cached(cache, "explain hash maps")
+    cached(cache, "weather in taipei")
+    cached(cache, "capital of france")
+    assert cache.stats()['evictions'] == 1
+    assert cache.lookup("weather in taipei")[0] is not None
+    assert cache.lookup("explain hash maps")[0] is None
+
+
+def test_saved_index_is_loaded(tmp_path):
+    path = str(tmp_path / 'index')
+    cache = SemanticCache(embed, DIMS, capacity=10, path=path)
+    cached(cache, "weather in taipei")
+    cache.save()
+    loaded = SemanticCache(embed, DIMS, capacity=10, path=path)
+    assert loaded.lookup("what's the weather in taipei")[0] == "answer to weather in taipei"
+
+
+def test_saves_from_workers_are_merged(tmp_path):
+    path = str(tmp_path / 'index')
+    first = SemanticCache(embed, DIMS, capacity=10, path=path)
+    second = SemanticCache(embed, DIMS, capacity=10, path=path)
+    cached(first, "weather in taipei")
+    cached(second, "explain hash maps")
+    first.save()
+    second.save()
+    loaded = SemanticCache(embed, DIMS, capacity=10, path=path)
+    assert loaded.stats()['entries'] == 2
+    assert loaded.lookup("weather in taipei")[0] == "answer to weather in taipei"
+    assert loaded.lookup("explain hash maps")[0] == "answer to explain hash maps"
+
+
+def test_merged_save_keeps_the_entries_expiring_last(tmp_path):
+    path = str(tmp_path / 'index')
+    first = SemanticCache(embed, DIMS, capacity=2, path=path, search_ttl=600, direct_ttl=86400)
+    second = SemanticCache(embed, DIMS, capacity=2, path=path, search_ttl=600, direct_ttl=86400)
+    cached(first, "weather in taipei", route='search')
+    cached(first, "explain hash maps")
+    cached(second, "capital of france")
+    first.save()
+    second.save()
+    loaded = SemanticCache(embed, DIMS, capacity=2, path=path)
+    assert loaded.lookup("weather in taipei")[0] is None
+    assert loaded.lookup("explain hash maps")[0] is not None
+    assert loaded.lookup("capital of france")[0] is not None
+
+
+class Item(object):
+    def __init__(self, vector):
+        self.embedding = list(vector)
+
+
+class Usage(object):
+    total_tokens = 3
+
+
+class Embeddings(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.timeouts = []
+        self.embeddings = self
+
+    def create(self, model, input, dimensions, timeout):
+        self.timeouts.append(timeout)
+        if self.delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("embeddings timed out")
+        response = type('Response', (), {})()
+        response.data = [Item(vector) for vector in embed(input)]
+        response.usage = Usage()
+        return response
+
+
+def test_embedding_call_has_the_deadline_as_timeout():
+    client = Embeddings()
+    vectors = openai_embedding(lambda: client, dims=DIMS, deadline=2.0)(["tallest mountain"])
+    assert vectors.shape == (1, DIMS)
+    assert 0 < client.timeouts[0] <= 2.0
+
+
+def test_stalled_embedding_gives_up_at_the_deadline():
+    client = Embeddings(delay=10.0)
+    embed_call = openai_embedding(lambda: client, dims=DIMS, upstream=Upstream('openai', base_delay=0.001),
+                                  deadline=0.2)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        embed_call(["tallest mountain"])
+    assert time.monotonic() - start < 0.5
+
+
+def test_embedding_is_charged_and_settled():
+    limiter = RateLimiter({'openai_tokens': (0.001, 1000)})
+    openai_embedding(lambda: Embeddings(), dims=DIMS, limiter=limiter)(["tallest mountain"])
+    assert limiter.stats()['resources']['openai_tokens']['charged'] == Usage.total_tokens
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert condition()
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def answer(question):
+        calls.append(question)
+        release.wait(5)
+        return f"answer to {question}"
+
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(flight.do, 'weather', answer, 'weather')]
+        wait_until(lambda: calls)
+        futures += [executor.submit(flight.do, 'weather', answer, 'weather') for _ in range(3)]
+        wait_until(lambda: flight.stats()['coalesced'] == 3)
+        release.set()
+        assert [future.result() for future in futures] == ["answer to weather"] * 4
+    assert calls == ['weather']
+    assert flight.stats()['leaders'] == 1
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_finished_flights_are_not_reused():
+    flight = SingleFlight()
+    assert flight.do('k', lambda: 1) == 1
+    assert flight.do('k', lambda: 2) == 2
+    assert flight.stats()['coalesced'] == 0
+
+
+def test_leader_error_reaches_followers():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    with ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(flight.do, 'k', fail)
+        wait_until(lambda: flight.stats()['in_flight'])
+        follower = executor.submit(flight.do, 'k', fail)
+        wait_until(lambda: flight.stats()['coalesced'] == 1)
+        release.set()
+        for future in (leader, follower):
+            with pytest.raises(ValueError):
+                future.result()
+
+
+def test_follower_runs_its_own_call_after_max_wait():
+    flight = SingleFlight(max_wait=0.05)
+    release = threading.Event()
+    with ThreadPoolExecutor(1) as executor:
+        leader = executor.submit(flight.do, 'k', lambda: release.wait(5) and 'leader')
+        wait_until(lambda: flight.stats()['in_flight'])
+        assert flight.do('k', lambda: 'own') == 'own'
+        release.set()
+        assert leader.result() == 'leader'
+    assert flight.stats()['follower_timeouts'] == 1
+
+
+def test_async_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+
+    async def answer(question):
+        calls.append(question)
+        await asyncio.sleep(0.01)
+        return f"answer to {question}"
+
+    async def main():
+        return await asyncio.gather(*[flight.do_async('weather', answer, 'weather') for _ in range(4)])
+
+    assert asyncio.run(main()) == ["answer to weather"] * 4
+    assert calls == ['weather']
+    assert flight.stats()['coalesced'] == 3
+
+
+def test_async_follower_gives_up_after_max_wait():
+    flight = SingleFlight(max_wait=0.01)
+
+    async def slow():
+        await asyncio.sleep(0.2)
+        return 'leader'
+
+    async def fast():
+        return 'own'
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do_async('k', slow))
+        await asyncio.sleep(0)
+        own = await flight.do_async('k', fast)
+        return own, await leader
+
+    assert asyncio.run(main()) == ('own', 'leader')
+    assert flight.stats()['follower_timeouts'] == 1
@@ -0,0 +1,72 @@
+import asyncio
+
+from streaming import SentenceChunker, deliver, deliver_async
+
+
+def feed_all(chunker, deltas):
+    messages = []
+    for delta in deltas:
+        messages.extend(chunker.feed(delta))
+    return messages + chunker.flush()
+
+
+def test_first_message_goes_out_at_the_first_sentence():
+    chunker = SentenceChunker(first_chars=10, chunk_chars=1000)
+    assert chunker.feed("Hello there") == []
+    assert chunker.feed(", friend. How are") == ["Hello there, friend."]
+    assert chunker.feed(" you? Fine.") == []
+    assert chunker.flush() == ["How are you? Fine."]
+
+
+def test_later_messages_collect_chunk_chars():
+    chunker = SentenceChunker(first_chars=1, chunk_chars=30)
+    text = "One. Two is here. Three is here. Four is here. Five."
+    messages = feed_all(chunker, [word + ' ' for word in text.split(' ')])
+    assert messages == ["One.", "Two is here. Three is here. Four is here.", "Five."]
+    assert chunker.chunks == 3
+
+
+def test_cjk_full_stops_end_sentences():
+    chunker = SentenceChunker(first_chars=2, chunk_chars=4)
+    assert feed_all(chunker, ["今天天氣", "很好。明天", "會下雨！", "後天呢"]) == \
+        ["今天天氣很好。", "明天會下雨！", "後天呢"]
+
+
+def test_decimal_points_do_not_end_sentences():
+    chunker = SentenceChunker(first_chars=1)
+    assert chunker.feed("It costs 3.5 dollars") == []
+
+
+def test_no_message_exceeds_max_chars():
+    chunker = SentenceChunker(first_chars=5, chunk_chars=5, max_chars=20)
+    text = "word " * 30 + "x" * 50
+    messages = feed_all(chunker, [text[i:i + 7] for i in range(0, len(text), 7)])
+    assert all(len(message) <= 20 for message in messages)
+    assert ''.join(messages).replace(' ', '') == text.replace(' ', '')
+    # Words are cut at a space; a run without one at max_chars
+    assert messages[:7] == ["word word word word"] * 7
+    assert messages[-2:] == ["x" * 20] * 2
+
+
+def test_deliver_replies_once_then_pushes():
+    sent = []
+    text = deliver(iter(["First sentence here. ", "Second one.", " Third."]),
+                   lambda text, first: sent.append((text, first)),
+                   SentenceChunker(first_chars=5, chunk_chars=1000))
+    assert text == "First sentence here. Second one. Third."
+    assert sent == [("First sentence here.", True), ("Second one. Third.", False)]
+
+
+def test_deliver_async_matches_deliver():
+    sent = []
+
+    async def deltas():
+        for delta in ["短い。", "長い文です。"]:
+            yield delta
+
+    async def send(text, first):
+        sent.append((text, first))
+
+    text = asyncio.run(deliver_async(deltas(), send, SentenceChunker(first_chars=1, chunk_chars=1000)))
+    assert text == "短い。長い文です。"
+    assert sent == [("短い。", True), ("長い文です。", False)]
@@ -0,0 +1,42 @@
+# Token estimates for budgeting prompts. tiktoken is optional; without it
+# the count is approximate: about four characters per token for Latin text
+# and one token per CJK character.
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Fixed cost of a chat message (role and separators) on top of its content
+MESSAGE_OVERHEAD = 4
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    wide = sum(1 for ch in text if ord(ch) >= 0x2e80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD for message in messages)
+
+
+def truncate_to_tokens(text, max_tokens):
+    # The longest prefix of `text` that fits in `max_tokens`
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens])
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
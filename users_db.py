@@ -0,0 +1,23 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# Connect to your database
+DATABASE = 'line_bot_users.db'
+
+def create_connection():
+    conn = sqlite3.connect(DATABASE)
+    return conn
+
+def save_user_to_db(user_id, username):
+    conn = create_connection()
+    cursor = conn.cursor()
+    try:
+        # Insert user_id and username into the database
+        cursor.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to insert user: {e}")
+    finally:
+        conn.close()
@@ -0,0 +1,200 @@
+import base64
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot import WebhookHandler
+from linebot.exceptions import InvalidSignatureError
+from linebot.models.events import (
+    MessageEvent, FollowEvent, UnfollowEvent, JoinEvent, LeaveEvent, PostbackEvent,
+    BeaconEvent, AccountLinkEvent, MemberJoinedEvent, MemberLeftEvent, ThingsEvent,
+    UnsendEvent, VideoPlayCompleteEvent,
+)
+from linebot.webhook import WebhookPayload
+
+from app_logging import correlation_id
+from lazy_events import LazyEvent
+
+# orjson is optional; it parses bytes directly and is several times faster
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+EVENT_TYPES = {
+    'message': MessageEvent,
+    'follow': FollowEvent,
+    'unfollow': UnfollowEvent,
+    'join': JoinEvent,
+    'leave': LeaveEvent,
+    'postback': PostbackEvent,
+    'beacon': BeaconEvent,
+    'accountLink': AccountLinkEvent,
+    'memberJoined': MemberJoinedEvent,
+    'memberLeft': MemberLeftEvent,
+    'things': ThingsEvent,
+    'unsend': UnsendEvent,
+    'videoPlayComplete': VideoPlayCompleteEvent,
+}
+
+
+def event_key(event):
+    # Events from the same user, group or room must be handled in order;
+    # events from different sources are independent of each other
+    source = getattr(event, 'source', None)
+    if source is None:
+        return None
+    return (getattr(source, 'group_id', None)
+            or getattr(source, 'room_id', None)
+            or getattr(source, 'user_id', None))
+
+
+class AppWebhookHandler(WebhookHandler):
+    # Same decorator API as linebot's WebhookHandler (`@handler.add(...)`), but
+    # parsing and dispatching are separate steps so events can be handed off
+    # to workers once the signature has been checked.
+    #
+    # With concurrency > 1, handle() and dispatch_all() run the events of a
+    # payload on a thread pool: events of one source stay in order, different
+    # sources run in parallel, and they return once every event has been
+    # handled.
+    #
+    # Bodies are taken as raw bytes: the HMAC is computed over them and they
+    # are parsed once, instead of decoding to str, re-encoding for the
+    # signature check and parsing the str.
+    #
+    # With lazy=True, events become LazyEvent views over the parsed JSON and
+    # events nobody registered a handler for are dropped before anything is
+    # built for them.
+    #
+    # Every parsed event carries `received_at`, the time.time() it arrived,
+    # so its reply token's age is known however long it waits in a queue, and
+    # `callback_host`, the host the webhook was posted to, for handlers that
+    # build public URLs outside of the request.
+
+    def __init__(self, channel_secret, concurrency=1, lazy=False):
+        super(AppWebhookHandler, self).__init__(channel_secret)
+        self.channel_secret = channel_secret.encode('utf-8')
+        self.concurrency = concurrency
+        self.lazy = lazy
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix='webhook-dispatch')
+            return self._executor
+
+    def validate(self, body, signature):
+        digest = hmac.new(self.channel_secret, body, hashlib.sha256).digest()
+        return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(digest))
+
+    def parse(self, body, signature, host=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not self.validate(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+
+        received_at = time.time()
+        body_json = json_loads(body)
+        events = []
+        for event in body_json['events']:
+            event_class = EVENT_TYPES.get(event['type'])
+            if event_class is None:
+                logger.warning('Unknown event type. type=' + event['type'])
+                continue
+            if self.lazy:
+                lazy_event = LazyEvent(event, event_class)
+                if self.find_handler(lazy_event) is not None:
+                    lazy_event.received_at = received_at
+                    lazy_event.callback_host = host
+                    events.append(lazy_event)
+            else:
+                event = event_class.new_from_json_dict(event)
+                event.received_at = received_at
+                event.callback_host = host
+                events.append(event)
+        return WebhookPayload(events=events, destination=body_json.get('destination'))
+
+    def find_handler(self, event):
+        func = None
+        if isinstance(event, LazyEvent):
+            for key in event.handler_keys():
+                func = self._handlers.get(key)
+                if func is not None:
+                    return func
+            return self._default
+
+        if isinstance(event, MessageEvent):
+            key = event.__class__.__name__ + '_' + event.message.__class__.__name__
+            func = self._handlers.get(key)
+        if func is None:
+            func = self._handlers.get(event.__class__.__name__)
+        if func is None:
+            func = self._default
+        return func
+
+    def dispatch(self, event, destination=None):
+        func = self.find_handler(event)
+        if func is None:
+            logger.info(f"No handler of {event.__class__.__name__} and no default handler")
+            return
+
+        arg_spec = inspect.getfullargspec(func)
+        with correlation_id(getattr(event, 'webhook_event_id', None)):
+            if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+                func(event, destination)
+            elif len(arg_spec.args) == 1:
+                func(event)
+            else:
+                func()
+
+    async def dispatch_async(self, event, destination=None):
+        # For handlers registered as coroutine functions (async_app.py)
+        func = self.find_handler(event)
+        if func is None:
+            logger.info(f"No handler of {event.__class__.__name__} and no default handler")
+            return
+
+        arg_spec = inspect.getfullargspec(func)
+        with correlation_id(getattr(event, 'webhook_event_id', None)):
+            if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+                await func(event, destination)
+            elif len(arg_spec.args) == 1:
+                await func(event)
+            else:
+                await func()
+
+    def _dispatch_in_order(self, events, destination):
+        for event in events:
+            self.dispatch(event, destination)
+
+    def handle(self, body, signature, host=None):
+        payload = self.parse(body, signature, host)
+        self.dispatch_all(payload.events, payload.destination)
+
+    def dispatch_all(self, events, destination=None):
+        # Group the events by source, keeping delivery order inside each group
+        groups = {}
+        for event in events:
+            groups.setdefault(event_key(event), []).append(event)
+
+        if self.concurrency <= 1 or len(groups) <= 1:
+            self._dispatch_in_order(events, destination)
+            return
+
+        executor = self._get_executor()
+        futures = [executor.submit(self._dispatch_in_order, group, destination)
+                   for group in groups.values()]
+        for future in futures:
+            future.result()